@@ -11,4 +11,32 @@ from .data import Alphabet, BatchConverter, FastaBatchedDataset  # noqa
 # from .model.msa_transformer import MSATransformer  #noqa
 #from . import pretrained  # noqa
 #from .downstream import *
-from . import mamba2_pretrained, mamba2_pretrained1, mamba2_pretrained2, mamba2_pretrained3
+
+import importlib
+
+# The model modules pull in einops, the model code and, on first use, the optional
+# kernels; import them when they are first accessed (DGRNA.mamba2_pretrained, ...) so
+# that "import DGRNA" for the data utilities stays cheap.
+_SUBMODULES = (
+    "backends",
+    "cache",
+    "mamba2_pretrained",
+    "mamba2_torch",
+    "multihead_attention_mha",
+    "pooling",
+    "profiling",
+    "quantization",
+    "server",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
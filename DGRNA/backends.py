@@ -0,0 +1,123 @@
+"""Registry of the optional kernel libraries.
+
+mamba_ssm, its Triton norms and flash_attn are slow to import and often missing (CPU
+machines, no matching CUDA build). The modules of DGRNA import them through this
+registry instead of at import time: each library is probed on first use, once per
+process, and ``select`` picks the fastest implementation of a component that can run,
+falling back to the pure-PyTorch ones. ``python -m DGRNA.backends`` prints what is
+available.
+"""
+import functools
+import importlib
+import types
+
+import torch
+
+# name -> (module, symbols); the symbols become the attributes of load(name)
+LIBRARIES = {
+    "mamba_ssm": [
+        ("mamba_ssm.models.config_mamba", ["MambaConfig"]),
+        ("mamba_ssm.modules.mamba_simple", ["Mamba"]),
+        ("mamba_ssm.modules.mamba2", ["Mamba2"]),
+        ("mamba_ssm.modules.mha", ["MHA"]),
+        ("mamba_ssm.modules.mlp", ["GatedMLP"]),
+        ("mamba_ssm.modules.block", ["Block"]),
+        ("mamba_ssm.utils.hf", ["load_config_hf", "load_state_dict_hf"]),
+    ],
+    "triton_norm": [("mamba_ssm.ops.triton.layer_norm", ["RMSNorm", "layer_norm_fn", "rms_norm_fn"])],
+    "flash_attn": [
+        (
+            "flash_attn",
+            [
+                "flash_attn_kvpacked_func",
+                "flash_attn_qkvpacked_func",
+                "flash_attn_varlen_kvpacked_func",
+                "flash_attn_varlen_qkvpacked_func",
+            ],
+        )
+    ],
+    "flash_attn_rotary": [("flash_attn.layers.rotary", ["RotaryEmbedding"])],
+    "flash_attn_fused_dense": [
+        ("flash_attn.ops.fused_dense", ["ColumnParallelLinear", "FusedDense", "RowParallelLinear"])
+    ],
+    "flash_attn_distributed": [("flash_attn.utils.distributed", ["get_dim_for_local_rank"])],
+    "ft_attention": [("ft_attention", ["single_query_attention"])],
+}
+
+# Implementations of each component, fastest first:
+# (implementation, library it needs or None, whether it needs a CUDA device)
+IMPLEMENTATIONS = {
+    "mamba2": [("cuda", "mamba_ssm", True), ("torch", None, False)],
+    "norm": [("triton", "triton_norm", True), ("torch", None, False)],
+    "attention": [("flash", "flash_attn", True), ("sdpa", None, False), ("chunked", None, False)],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def load(name):
+    """Namespace with the symbols of library name, or None if it cannot be imported."""
+    symbols = {}
+    try:
+        for module_name, names in LIBRARIES[name]:
+            module = importlib.import_module(module_name)
+            for symbol in names:
+                symbols[symbol] = getattr(module, symbol)
+    except (ImportError, OSError, AttributeError):
+        # Not installed, or built against another CUDA / torch version
+        return None
+    return types.SimpleNamespace(**symbols)
+
+
+def available(name):
+    return load(name) is not None
+
+
+def get(name, symbol):
+    """One symbol of library name, or None if the library is not available."""
+    library = load(name)
+    return getattr(library, symbol) if library is not None else None
+
+
+def require(name):
+    library = load(name)
+    if library is None:
+        raise ImportError(f"{name} is required but cannot be imported")
+    return library
+
+
+def usable(kind, implementation, device=None):
+    """Whether implementation of kind can run on device (None: the default CUDA device
+    if there is one, else the CPU).
+    """
+    for impl, library, needs_cuda in IMPLEMENTATIONS[kind]:
+        if impl == implementation:
+            if needs_cuda:
+                is_cuda = torch.cuda.is_available() if device is None else torch.device(device).type == "cuda"
+                if not is_cuda:
+                    return False
+            return library is None or available(library)
+    raise ValueError(
+        f"Unknown {kind} implementation: {implementation}, only support "
+        f"{', '.join(impl for impl, _, _ in IMPLEMENTATIONS[kind])}"
+    )
+
+
+def select(kind, device=None):
+    """The fastest implementation of kind that can run on device, see usable."""
+    for implementation, _, _ in IMPLEMENTATIONS[kind]:
+        if usable(kind, implementation, device):
+            return implementation
+    raise RuntimeError(f"No usable {kind} implementation")
+
+
+def report():
+    return {
+        "libraries": {name: available(name) for name in LIBRARIES},
+        "selected": {kind: select(kind) for kind in IMPLEMENTATIONS},
+    }
+
+
+if __name__ == "__main__":
+    import json
+
+    print(json.dumps(report(), indent=2))
@@ -0,0 +1,272 @@
+"""Content-addressed cache of per-sequence embeddings.
+
+An entry is keyed by the hash of the normalized sequence and of a fingerprint of the
+model weights and embedding options, so the same sequence under another label hits,
+and changing the weights, the precision or the requested outputs never returns stale
+embeddings. ``EmbeddingCache`` keeps an in-memory LRU bounded by bytes, backed by an
+optional on-disk tier; ``CachedEmbedder`` puts it in front of the model call.
+"""
+import collections
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import torch
+
+from .data import BatchConverter, batch_indices_by_length, normalize_sequence
+from .pooling import pool
+
+OUTPUTS = ("mean", "max", "per_tok", "bos")
+
+
+def _update_with_tensor(digest, tensor):
+    tensor = tensor.detach()
+    if tensor.is_quantized:
+        tensor = tensor.dequantize()
+    tensor = tensor.cpu().contiguous().reshape(-1)
+    digest.update(f"{tensor.dtype}{tuple(tensor.shape)}".encode())
+    digest.update(tensor.view(torch.uint8).numpy().tobytes() if tensor.numel() else b"")
+
+
+def model_fingerprint(model):
+    """sha256 of the names, dtypes, shapes and values of the model state dict. Hashing
+    the values reads every weight once, so compute it once per loaded model.
+    """
+    digest = hashlib.sha256()
+
+    def update(name, value):
+        digest.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            _update_with_tensor(digest, value)
+        elif isinstance(value, (tuple, list)):
+            # e.g. the packed (weight, bias) of a dynamic quantized Linear
+            for i, v in enumerate(value):
+                update(f"{name}.{i}", v)
+        else:
+            digest.update(repr(value).encode())
+
+    for name, value in model.state_dict().items():
+        update(name, value)
+    return digest.hexdigest()
+
+
+def sequence_key(seq_str, fingerprint):
+    return hashlib.sha256(f"{fingerprint}\0{seq_str}".encode()).hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    return sum(_nbytes(v) for v in value.values())
+
+
+class EmbeddingCache(object):
+    """Thread-safe LRU of embeddings (a tensor or a dict of tensors per key).
+    max_bytes: bound of the in-memory tier; the least recently used entries are evicted
+        beyond it. Entries larger than max_bytes only go to disk.
+    directory: optional on-disk tier. Every entry is also written there (one file per
+        key, never evicted), and memory misses are looked up there before counting as
+        misses, so the cache survives restarts and can be shared by processes.
+    """
+
+    def __init__(self, max_bytes=1 << 30, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory is not None else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.directory is not None and self._path(key).exists()
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.pt"
+
+    def _insert(self, key, value, size):
+        # Caller holds the lock
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key):
+        """The cached value, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+        if self.directory is not None:
+            path = self._path(key)
+            try:
+                value = torch.load(str(path), map_location="cpu")
+            except (OSError, RuntimeError, EOFError):
+                # Not cached, or a corrupt file that the recomputed entry will overwrite
+                pass
+            else:
+                with self._lock:
+                    self._insert(key, value, _nbytes(value))
+                    self.disk_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value, _nbytes(value))
+        if self.directory is not None:
+            path = self._path(key)
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            torch.save(value, str(tmp_path))
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        """Empty the in-memory tier (the on-disk tier is kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def sequence_outputs(hidden_states, strs, include, bos=1):
+    """Per-sequence outputs of a (B, L, D) batch: a dict with the requested "mean", "max"
+    and "bos" (D,) and "per_tok" (len, D) CPU embeddings for each sequence of strs. The
+    pooled embeddings are computed on the device of hidden_states, so only (B, D) tensors
+    are transferred unless per_tok is requested.
+    """
+    if "bos" in include and not bos:
+        raise ValueError("bos output requires an alphabet that prepends a BOS token")
+    positions = torch.arange(hidden_states.shape[1], device=hidden_states.device)
+    lengths = torch.tensor([len(seq_str) for seq_str in strs], device=hidden_states.device)
+    mask = (positions >= bos) & (positions < bos + lengths[:, None])
+    pooled = {name: pool(hidden_states, mask, name).cpu() for name in include if name != "per_tok"}
+    per_tok = hidden_states.cpu() if "per_tok" in include else None
+    outputs = []
+    for i, seq_str in enumerate(strs):
+        # Copies, so that an entry does not keep the whole batch alive
+        result = {name: x[i].clone() for name, x in pooled.items()}
+        if per_tok is not None:
+            result["per_tok"] = per_tok[i, bos : bos + len(seq_str)].clone()
+        outputs.append(result)
+    return outputs
+
+
+class CachedEmbedder(object):
+    """Embeds (label, sequence) batches through a MambaLMHeadModel, computing only the
+    sequences that are not in the cache. Returns one dict of CPU embeddings per item, in
+    input order, see sequence_outputs. They are fp32 as _compute calls the model with
+    out_dtype=torch.float32; entries of an on-disk tier keep the dtype they were saved with.
+    Each dict is a copy, but its tensors are shared with the cache: treat them as read-only
+    and clone before modifying them in place.
+    """
+
+    def __init__(
+        self,
+        model,
+        alphabet,
+        cache=None,
+        include=("mean",),
+        toks_per_batch=4096,
+        to_upper=False,
+        t_to_u=False,
+        fingerprint=None,
+        **forward_kwargs,
+    ):
+        """
+        cache: an EmbeddingCache, by default an in-memory one of 1 GiB.
+        fingerprint: identifies the weights, model_fingerprint(model) if None. Pass a
+            stable name (e.g. of the checkpoint file) to skip hashing the weights.
+        forward_kwargs: passed to the model (e.g. seq_chunk_len), and part of the key.
+        """
+        for name in include:
+            if name not in OUTPUTS:
+                raise ValueError(f"Unknown output: {name}, only support {', '.join(OUTPUTS)}")
+        self.model = model
+        self.alphabet = alphabet
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.include = tuple(sorted(include))
+        self.toks_per_batch = toks_per_batch
+        self.to_upper = to_upper
+        self.t_to_u = t_to_u
+        self.forward_kwargs = forward_kwargs
+        self.duplicates = 0
+        self.batch_converter = BatchConverter(alphabet, to_upper=to_upper, t_to_u=t_to_u)
+        if fingerprint is None:
+            fingerprint = model_fingerprint(model)
+        options = {k: v for k, v in forward_kwargs.items() if k != "seq_chunk_len"}  # seq_chunk_len is exact
+        self.fingerprint = f"{fingerprint}:{','.join(self.include)}:{sorted(options.items())}"
+
+    def key(self, seq_str):
+        return sequence_key(normalize_sequence(seq_str, self.to_upper, self.t_to_u), self.fingerprint)
+
+    @torch.no_grad()
+    def _compute(self, raw_batch):
+        device = next(self.model.parameters()).device
+        extra_toks_per_seq = int(self.alphabet.prepend_bos) + int(self.alphabet.append_eos)
+        outputs = [None] * len(raw_batch)
+        for batch in batch_indices_by_length(
+            [len(seq_str) for _, seq_str in raw_batch], self.toks_per_batch, extra_toks_per_seq
+        ):
+            _, strs, tokens = self.batch_converter([raw_batch[i] for i in batch])
+            hidden_states = self.model(tokens.to(device), out_dtype=torch.float32, **self.forward_kwargs)
+            results = sequence_outputs(hidden_states, strs, self.include, int(self.alphabet.prepend_bos))
+            for i, result in zip(batch.tolist(), results):
+                outputs[i] = result
+        return outputs
+
+    def __call__(self, raw_batch):
+        # Duplicates within the batch are looked up and computed once
+        keys = [self.key(seq_str) for _, seq_str in raw_batch]
+        first = {}
+        for i, key in enumerate(keys):
+            first.setdefault(key, i)
+        self.duplicates += len(keys) - len(first)
+        found = {key: self.cache.get(key) for key in first}
+        misses = [key for key, output in found.items() if output is None]
+        if misses:
+            for key, output in zip(misses, self._compute([raw_batch[first[key]] for key in misses])):
+                self.cache.put(key, output)
+                found[key] = output
+        # Shallow copies, so that callers adding or removing outputs do not change the cache
+        return [dict(found[key]) for key in keys]
+
+    def stats(self):
+        """Cache statistics, and duplicates: items served by another item of their batch."""
+        return {**self.cache.stats(), "duplicates": self.duplicates}
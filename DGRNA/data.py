@@ -4,10 +4,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import array
+import json
+import mmap
 from typing import Sequence, Tuple, List, Union
 import pickle
 import re
 import shutil
+import numpy as np
 import torch
 from pathlib import Path
 from .constants import proteinseq_toks, rnaseq_toks
@@ -60,29 +64,312 @@ class FastaBatchedDataset(object):
         return self.sequence_labels[idx], self.sequence_strs[idx]
 
     def get_batch_indices(self, toks_per_batch, extra_toks_per_seq=0):
-        sizes = [(len(s), i) for i, s in enumerate(self.sequence_strs)]
-        sizes.sort()
-        batches = []
-        buf = []
-        max_len = 0
+        lengths = [len(s) for s in self.sequence_strs]
+        return [
+            batch.tolist()
+            for batch in batch_indices_by_length(lengths, toks_per_batch, extra_toks_per_seq)
+        ]
 
-        def _flush_current_buf():
-            nonlocal max_len, buf
-            if len(buf) == 0:
-                return
-            batches.append(buf)
-            buf = []
-            max_len = 0
 
-        for sz, i in sizes:
-            sz += extra_toks_per_seq
-            if max(sz, max_len) * (len(buf) + 1) > toks_per_batch:
-                _flush_current_buf()
+def batch_indices_by_length(lengths, toks_per_batch, extra_toks_per_seq=0):
+    """Greedy token-budget batching shared by the datasets: indices are sorted by
+    (length, index) and a batch is closed when max length * number of sequences
+    would exceed toks_per_batch. Returns a list of int64 index arrays.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64).reshape(-1)
+    if len(lengths) == 0:
+        return []
+    order = np.argsort(lengths, kind="stable")
+    sizes = lengths[order] + extra_toks_per_seq
+    boundaries = []
+    count = 0
+    max_len = 0
+    block = 1 << 20  # bounds the Python ints alive at once for very large datasets
+    for start in range(0, len(sizes), block):
+        for pos, sz in enumerate(sizes[start : start + block].tolist(), start):
+            if count > 0 and max(sz, max_len) * (count + 1) > toks_per_batch:
+                boundaries.append(pos)
+                count = 0
+                max_len = 0
             max_len = max(max_len, sz)
-            buf.append(i)
+            count += 1
+    return np.split(order, boundaries)
+
+
+class IndexedFastaDataset(object):
+    """FASTA dataset that reads records on demand through a byte-offset index.
+
+    The index is built in one pass over the file and saved beside it as
+    ``<fasta_file>.idx.npy``. It is rebuilt when the FASTA file is newer. Each row
+    holds (header line number, label offset, label length, sequence offset,
+    sequence span in bytes, sequence length). The index is memory-mapped and
+    records are sliced out of a memory-mapped file, so startup time and RAM do not
+    grow with the corpus. Unlike FastaBatchedDataset.from_file, labels are not
+    checked for uniqueness.
+    """
+
+    index_suffix = ".idx.npy"
+
+    def __init__(self, fasta_file, index_file=None, rebuild=False):
+        self.fasta_file = str(fasta_file)
+        self.index_file = (
+            str(index_file) if index_file is not None else self.fasta_file + self.index_suffix
+        )
+        if (
+            rebuild
+            or not os.path.exists(self.index_file)
+            or os.path.getmtime(self.index_file) < os.path.getmtime(self.fasta_file)
+        ):
+            self.build_index(self.fasta_file, self.index_file)
+        self._open()
+
+    @classmethod
+    def from_file(cls, fasta_file):
+        return cls(fasta_file)
+
+    def _open(self):
+        self.index = np.load(self.index_file, mmap_mode="r")
+        self._mmap = None
+
+    def __getstate__(self):
+        # Memory maps are reopened in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        del state["index"], state["_mmap"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @staticmethod
+    def build_index(fasta_file, index_file):
+        columns = [array.array("q") for _ in range(6)]
+        record = None
+
+        def _flush_current_record():
+            if record is None:
+                return
+            line_idx, label_offset, label_length, seq_offset, seq_end, seq_length = record
+            for column, value in zip(
+                columns,
+                (line_idx, label_offset, label_length, seq_offset, seq_end - seq_offset, seq_length),
+            ):
+                column.append(value)
+
+        offset = 0
+        with open(fasta_file, "rb") as infile:
+            for line_idx, line in enumerate(infile):
+                if line.startswith(b">"):  # label line
+                    _flush_current_record()
+                    label = line[1:].lstrip()
+                    label_offset = offset + len(line) - len(label)
+                    end = offset + len(line)
+                    record = [line_idx, label_offset, len(label.rstrip()), end, end, 0]
+                elif record is not None:  # sequence line
+                    record[4] = offset + len(line)
+                    record[5] += len(line.strip())
+                offset += len(line)
+        _flush_current_record()
+
+        index = np.stack([np.frombuffer(column, dtype=np.int64) for column in columns], axis=1)
+        tmp_file = index_file + ".tmp.npy"
+        np.save(tmp_file, index)
+        os.replace(tmp_file, index_file)
+
+    @property
+    def sequence_lengths(self):
+        return self.index[:, 5]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, idx):
+        line_idx, label_offset, label_length, seq_offset, seq_span, _ = self.index[idx].tolist()
+        if self._mmap is None:
+            with open(self.fasta_file, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if label_length > 0:
+            label = self._mmap[label_offset : label_offset + label_length].decode()
+        else:
+            label = f"seqnum{line_idx:09d}"
+        seq = self._mmap[seq_offset : seq_offset + seq_span]
+        return label, b"".join(line.strip() for line in seq.split(b"\n")).decode()
+
+    def get_batch_indices(self, toks_per_batch, extra_toks_per_seq=0):
+        """Same batches as FastaBatchedDataset.get_batch_indices, as int64 arrays,
+        computed from the stored lengths without reading any sequence.
+        """
+        return batch_indices_by_length(self.sequence_lengths, toks_per_batch, extra_toks_per_seq)
+
+
+def write_tokenized_corpus(fasta_file, prefix, alphabet, to_upper=False, t_to_u=False, block_size=65536):
+    """One-time conversion of a FASTA file to the memory-mapped format of TokenizedDataset:
+
+        <prefix>.tokens.bin           uint8 token indices of all sequences, back to back
+        <prefix>.offsets.npy          int64 (N + 1,), sequence i is tokens[offsets[i]:offsets[i + 1]]
+        <prefix>.labels.txt           one label per line
+        <prefix>.label_offsets.npy    int64 (N + 1,), byte offsets of the labels
+        <prefix>.json                 the alphabet tokens and the normalization applied
+
+    BOS/EOS are not stored, TokenizedBatchConverter adds them per the alphabet.
+    """
+    if len(alphabet) > 256:
+        raise ValueError("Token indices must fit in uint8")
+    prefix = str(prefix)
+    table = alphabet.get_lookup_table(to_upper=to_upper, t_to_u=t_to_u).astype(np.uint8)
+    dataset = IndexedFastaDataset(fasta_file)
+    offsets = np.lib.format.open_memmap(
+        prefix + ".offsets.npy", mode="w+", dtype=np.int64, shape=(len(dataset) + 1,)
+    )
+    label_offsets = np.lib.format.open_memmap(
+        prefix + ".label_offsets.npy", mode="w+", dtype=np.int64, shape=(len(dataset) + 1,)
+    )
+    offsets[0] = label_offsets[0] = 0
+    with open(prefix + ".tokens.bin", "wb") as tokens_out, open(prefix + ".labels.txt", "wb") as labels_out:
+        for start in range(0, len(dataset), block_size):
+            end = min(start + block_size, len(dataset))
+            records = [dataset[i] for i in range(start, end)]
+            seqs = "".join(seq_str for _, seq_str in records).encode("ascii", errors="replace")
+            tokens_out.write(table[np.frombuffer(seqs, dtype=np.uint8)].tobytes())
+            labels = [(label + "\n").encode() for label, _ in records]
+            labels_out.write(b"".join(labels))
+            offsets[start + 1 : end + 1] = offsets[start] + np.cumsum(
+                [len(seq_str) for _, seq_str in records]
+            )
+            label_offsets[start + 1 : end + 1] = label_offsets[start] + np.cumsum(
+                [len(label) for label in labels]
+            )
+    offsets.flush()
+    label_offsets.flush()
+    with open(prefix + ".json", "w") as f:
+        json.dump({"all_toks": alphabet.all_toks, "to_upper": to_upper, "t_to_u": t_to_u}, f)
+    return prefix
 
-        _flush_current_buf()
-        return batches
+
+class TokenizedDataset(object):
+    """Pre-tokenized corpus written by write_tokenized_corpus.
+
+    All files are memory-mapped. __getitem__ returns (label, tokens), where tokens is
+    a zero-copy uint8 view of the residue indices (no BOS/EOS), so repeat epochs and
+    jobs skip FASTA parsing and tokenization entirely. Collate the items with
+    TokenizedBatchConverter.
+    """
+
+    def __init__(self, prefix, alphabet=None):
+        self.prefix = str(prefix)
+        with open(self.prefix + ".json") as f:
+            self.metadata = json.load(f)
+        if alphabet is not None and list(alphabet.all_toks) != self.metadata["all_toks"]:
+            raise ValueError(f"{self.prefix} was tokenized with a different alphabet")
+        self._open()
+
+    def _open(self):
+        self.offsets = np.load(self.prefix + ".offsets.npy", mmap_mode="r")
+        self.label_offsets = np.load(self.prefix + ".label_offsets.npy", mmap_mode="r")
+        if os.path.getsize(self.prefix + ".tokens.bin") > 0:
+            self.tokens = np.memmap(self.prefix + ".tokens.bin", dtype=np.uint8, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.uint8)
+        self._labels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("offsets", "label_offsets", "tokens", "_labels"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self._labels is None:
+            with open(self.prefix + ".labels.txt", "rb") as f:
+                self._labels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start, end = self.offsets[idx : idx + 2].tolist()
+        label_start, label_end = self.label_offsets[idx : idx + 2].tolist()
+        label = self._labels[label_start : label_end - 1].decode()
+        return label, self.tokens[start:end]
+
+    def get_batch_indices(self, toks_per_batch, extra_toks_per_seq=0):
+        return batch_indices_by_length(np.diff(self.offsets), toks_per_batch, extra_toks_per_seq)
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """batch_sampler over the length-sorted, token-budget batches of
+    FastaBatchedDataset.get_batch_indices.
+    """
+
+    def __init__(self, dataset, toks_per_batch, extra_toks_per_seq=0, shuffle=False, seed=0):
+        self.batches = dataset.get_batch_indices(toks_per_batch, extra_toks_per_seq)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Reshuffle the batch order for a new epoch when shuffle=True."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(len(self.batches), generator=generator).tolist()
+        else:
+            order = range(len(self.batches))
+        for i in order:
+            yield list(self.batches[i])
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def create_batch_dataloader(
+    dataset,
+    alphabet,
+    toks_per_batch,
+    num_workers=2,
+    prefetch_factor=2,
+    pin_memory=None,
+    shuffle=False,
+    collate_fn=None,
+    **converter_kwargs,
+):
+    """DataLoader over token-budget batches of a FastaBatchedDataset (or
+    IndexedFastaDataset / TokenizedDataset) that yields (labels, strs, tokens)
+    exactly like BatchConverter.
+
+    Tokenization runs in num_workers worker processes. At most
+    num_workers * prefetch_factor batches are prepared ahead of the consumer, so the
+    next batches are tokenized while the model runs on the current one. pin_memory
+    (default: when CUDA is available) places the tokens in page-locked memory, so
+    tokens.to(device, non_blocking=True) does not block the host.
+    collate_fn defaults to TokenizedBatchConverter for a TokenizedDataset and to
+    Alphabet.get_batch_converter(**converter_kwargs) otherwise.
+    """
+    batch_sampler = TokenBudgetBatchSampler(
+        dataset,
+        toks_per_batch,
+        extra_toks_per_seq=int(alphabet.prepend_bos) + int(alphabet.append_eos),
+        shuffle=shuffle,
+    )
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    if collate_fn is None:
+        if isinstance(dataset, TokenizedDataset):
+            collate_fn = TokenizedBatchConverter(alphabet)
+        else:
+            collate_fn = alphabet.get_batch_converter(**converter_kwargs)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        pin_memory=pin_memory,
+    )
 
 
 class Alphabet(object):
@@ -115,6 +402,7 @@ class Alphabet(object):
         self.cls_idx = self.get_idx("<cls>")
         self.mask_idx = self.get_idx("<mask>")
         self.eos_idx = self.get_idx("<eos>")
+        self._lookup_tables = {}
 
     def __len__(self):
         return len(self.all_toks)
@@ -125,18 +413,64 @@ class Alphabet(object):
     def get_tok(self, ind):
         return self.all_toks[ind]
 
-    def to_dict(self):
-        return {"toks": self.toks}
-
-    def get_batch_converter(self):
+    def get_lookup_table(self, to_upper=False, t_to_u=False):
+        """256-entry byte -> token index array. Bytes that are not a single-character
+        token map to unk_idx, exactly like calling get_idx on each character.
+        to_upper: look lowercase letters up as uppercase.
+        t_to_u: look T (and t) up as U (and u), for DNA input.
+        """
+        key = (to_upper, t_to_u)
+        if key not in self._lookup_tables:
+            table = np.full(256, self.unk_idx, dtype=np.int64)
+            for byte in range(128):
+                char = chr(byte)
+                if to_upper:
+                    char = char.upper()
+                if t_to_u:
+                    char = {"T": "U", "t": "u"}.get(char, char)
+                table[byte] = self.get_idx(char)
+            self._lookup_tables[key] = table
+        return self._lookup_tables[key]
+
+    def encode_batch(self, seq_strs, tokens, start=0, to_upper=False, t_to_u=False, row_offsets=None):
+        """Write the token indices of seq_strs[i] to tokens[i, start:start + len(seq_strs[i])]
+        with one table lookup over the concatenated batch.
+        tokens: contiguous int64 CPU tensor (or numpy array) of shape (len(seq_strs), width).
+        row_offsets: flat offsets of the rows in tokens, see _fill_rows.
+        """
+        table = self.get_lookup_table(to_upper=to_upper, t_to_u=t_to_u)
+        lengths = np.fromiter((len(s) for s in seq_strs), dtype=np.int64, count=len(seq_strs))
+        # Non-ASCII characters become one "?" each, which maps to unk_idx
+        buf = np.frombuffer("".join(seq_strs).encode("ascii", errors="replace"), dtype=np.uint8)
+        _fill_rows(tokens, table[buf], lengths, start, row_offsets)
+        return tokens
+
+    def get_batch_converter(self, to_upper=False, t_to_u=False, pin_memory=False, packed=False, dedup=False):
+        if packed and dedup:
+            raise ValueError("packed and dedup cannot be combined")
+        if packed:
+            return PackedBatchConverter(self, to_upper=to_upper, t_to_u=t_to_u, pin_memory=pin_memory)
+        if dedup:
+            return DedupBatchConverter(self, to_upper=to_upper, t_to_u=t_to_u, pin_memory=pin_memory)
         if self.use_msa:
-            return MSABatchConverter(self)
+            return MSABatchConverter(self, to_upper=to_upper, t_to_u=t_to_u, pin_memory=pin_memory)
         else:
-            return BatchConverter(self)
+            return BatchConverter(self, to_upper=to_upper, t_to_u=t_to_u, pin_memory=pin_memory)
+
+    def to_dict(self):
+        """Constructor arguments as plain data, the inverse of from_dict."""
+        return {
+            "toks": list(self.standard_toks),
+            "prepend_toks": list(self.prepend_toks),
+            "append_toks": list(self.append_toks),
+            "prepend_bos": self.prepend_bos,
+            "append_eos": self.append_eos,
+            "use_msa": self.use_msa,
+        }
 
     @classmethod
     def from_dict(cls, d, **kwargs):
-        return cls(standard_toks=d["toks"], **kwargs)
+        return cls(standard_toks=d["toks"], **{k: v for k, v in d.items() if k != "toks"}, **kwargs)
 
     @classmethod
     def from_architecture(cls, name: str, theme="rna") -> "Alphabet":
@@ -173,47 +507,184 @@ class BatchConverter(object):
     processed (labels + tensor) batch.
     """
 
-    def __init__(self, alphabet):
+    def __init__(self, alphabet, to_upper=False, t_to_u=False, pin_memory=False):
+        """
+        to_upper, t_to_u: normalization applied while tokenizing, see Alphabet.get_lookup_table.
+            The returned strs are the input strings, unchanged.
+        pin_memory: allocate the tokens in page-locked memory (when CUDA is available)
+            so the host to device copy can be asynchronous.
+        """
         self.alphabet = alphabet
+        self.to_upper = to_upper
+        self.t_to_u = t_to_u
+        self.pin_memory = pin_memory
 
     def __call__(self, raw_batch: Sequence[Tuple[str, str]]):
         # RoBERTa uses an eos token, while ESM-1 does not.
         batch_size = len(raw_batch)
-        max_len = max(len(seq_str) for _, seq_str in raw_batch)
-        tokens = torch.empty(
+        labels = [label for label, _ in raw_batch]
+        strs = [seq_str for _, seq_str in raw_batch]
+        lengths = torch.tensor([len(seq_str) for seq_str in strs], dtype=torch.int64)
+        max_len = int(lengths.max())
+        tokens = torch.full(
             (
                 batch_size,
                 max_len
                 + int(self.alphabet.prepend_bos)
                 + int(self.alphabet.append_eos),
             ),
+            self.alphabet.padding_idx,
             dtype=torch.int64,
+            pin_memory=self.pin_memory and torch.cuda.is_available(),
         )
-        tokens.fill_(self.alphabet.padding_idx)
-        labels = []
-        strs = []
-
-        for i, (label, seq_str) in enumerate(raw_batch):
-            labels.append(label)
-            strs.append(seq_str)
-            if self.alphabet.prepend_bos:
-                tokens[i, 0] = self.alphabet.cls_idx
-            seq = torch.tensor(
-                [self.alphabet.get_idx(s) for s in seq_str], dtype=torch.int64
-            )
+        if self.alphabet.prepend_bos:
+            tokens[:, 0] = self.alphabet.cls_idx
+        self.alphabet.encode_batch(
+            strs,
+            tokens,
+            start=int(self.alphabet.prepend_bos),
+            to_upper=self.to_upper,
+            t_to_u=self.t_to_u,
+        )
+        if self.alphabet.append_eos:
             tokens[
-                i,
-                int(self.alphabet.prepend_bos) : len(seq_str)
-                + int(self.alphabet.prepend_bos),
-            ] = seq
-            if self.alphabet.append_eos:
-                tokens[
-                    i, len(seq_str) + int(self.alphabet.prepend_bos)
-                ] = self.alphabet.eos_idx
+                torch.arange(batch_size), lengths + int(self.alphabet.prepend_bos)
+            ] = self.alphabet.eos_idx
 
         return labels, strs, tokens
 
 
+class PackedBatchConverter(BatchConverter):
+    """Like BatchConverter, but the tokenized sequences (each with its own BOS/EOS) are
+    concatenated into a single (1, total) row instead of being padded to the longest one.
+    Returns labels, strs, tokens and cu_seqlens, the (batch_size + 1,) int32 cumulative
+    lengths of the packed sequences, for model(tokens, cu_seqlens=cu_seqlens).
+    """
+
+    def __call__(self, raw_batch: Sequence[Tuple[str, str]]):
+        labels = [label for label, _ in raw_batch]
+        strs = [seq_str for _, seq_str in raw_batch]
+        bos = int(self.alphabet.prepend_bos)
+        lengths = np.fromiter((len(seq_str) for seq_str in strs), dtype=np.int64, count=len(strs))
+        cu_seqlens = np.zeros(len(strs) + 1, dtype=np.int64)
+        np.cumsum(lengths + bos + int(self.alphabet.append_eos), out=cu_seqlens[1:])
+        tokens = torch.empty(
+            (1, int(cu_seqlens[-1])),
+            dtype=torch.int64,
+            pin_memory=self.pin_memory and torch.cuda.is_available(),
+        )
+        if self.alphabet.prepend_bos:
+            tokens[0, torch.from_numpy(cu_seqlens[:-1])] = self.alphabet.cls_idx
+        self.alphabet.encode_batch(
+            strs,
+            tokens,
+            start=bos,
+            to_upper=self.to_upper,
+            t_to_u=self.t_to_u,
+            row_offsets=cu_seqlens[:-1],
+        )
+        if self.alphabet.append_eos:
+            tokens[0, torch.from_numpy(cu_seqlens[1:] - 1)] = self.alphabet.eos_idx
+
+        return labels, strs, tokens, torch.from_numpy(cu_seqlens).to(torch.int32)
+
+
+class DedupBatchConverter(BatchConverter):
+    """Like BatchConverter, but identical sequences (after the to_upper / t_to_u
+    normalization) are tokenized once. Returns labels, strs, tokens and inverse:
+    labels has one entry per item, strs and the rows of tokens one per unique sequence,
+    and item i has sequence strs[inverse[i]] (inverse: (batch_size,) int64). Run the model
+    on tokens and scatter its outputs back with inverse.
+    """
+
+    def __call__(self, raw_batch: Sequence[Tuple[str, str]]):
+        labels = [label for label, _ in raw_batch]
+        unique_indices, inverse = deduplicate(
+            [seq_str for _, seq_str in raw_batch], to_upper=self.to_upper, t_to_u=self.t_to_u
+        )
+        _, strs, tokens = super().__call__([raw_batch[i] for i in unique_indices])
+        return labels, strs, tokens, torch.tensor(inverse, dtype=torch.int64)
+
+
+def normalize_sequence(seq_str, to_upper=False, t_to_u=False):
+    """The sequence as the tokenizer sees it, see Alphabet.get_lookup_table."""
+    if to_upper:
+        seq_str = seq_str.upper()
+    if t_to_u:
+        seq_str = seq_str.replace("T", "U").replace("t", "u")
+    return seq_str
+
+
+def deduplicate(seq_strs, to_upper=False, t_to_u=False):
+    """Identical sequences of seq_strs, compared after normalize_sequence.
+    Returns unique_indices, the index of the first occurrence of each unique sequence in
+    order of appearance, and inverse, such that seq_strs[i] is the same sequence as
+    seq_strs[unique_indices[inverse[i]]].
+    """
+    first = {}
+    unique_indices, inverse = [], []
+    for i, seq_str in enumerate(seq_strs):
+        j = first.setdefault(normalize_sequence(seq_str, to_upper, t_to_u), len(unique_indices))
+        if j == len(unique_indices):
+            unique_indices.append(i)
+        inverse.append(j)
+    return unique_indices, inverse
+
+
+class TokenizedBatchConverter(object):
+    """Collate (label, uint8 tokens) items of a TokenizedDataset into the same
+    (labels, strs, tokens) batch as BatchConverter. strs are decoded from the tokens,
+    so characters that were outside the alphabet come back as "?".
+    """
+
+    def __init__(self, alphabet, pin_memory=False):
+        self.alphabet = alphabet
+        self.pin_memory = pin_memory
+        chars = "".join(tok if len(tok) == 1 else "?" for tok in alphabet.all_toks)
+        self._chars = np.frombuffer(chars.encode("ascii", errors="replace"), dtype=np.uint8)
+
+    def __call__(self, raw_batch):
+        batch_size = len(raw_batch)
+        labels = [label for label, _ in raw_batch]
+        seqs = [np.asarray(seq_toks) for _, seq_toks in raw_batch]
+        lengths = np.array([len(seq_toks) for seq_toks in seqs], dtype=np.int64)
+        tokens = torch.full(
+            (
+                batch_size,
+                int(lengths.max())
+                + int(self.alphabet.prepend_bos)
+                + int(self.alphabet.append_eos),
+            ),
+            self.alphabet.padding_idx,
+            dtype=torch.int64,
+            pin_memory=self.pin_memory and torch.cuda.is_available(),
+        )
+        if self.alphabet.prepend_bos:
+            tokens[:, 0] = self.alphabet.cls_idx
+        _fill_rows(tokens, np.concatenate(seqs), lengths, int(self.alphabet.prepend_bos))
+        if self.alphabet.append_eos:
+            tokens[
+                torch.arange(batch_size), torch.from_numpy(lengths) + int(self.alphabet.prepend_bos)
+            ] = self.alphabet.eos_idx
+        strs = [self._chars[seq_toks].tobytes().decode() for seq_toks in seqs]
+        return labels, strs, tokens
+
+
+def _fill_rows(tokens, values, lengths, start, row_offsets=None):
+    """tokens[i, start:start + lengths[i]] = the i-th run of values, in one scatter.
+    tokens: contiguous 2D CPU tensor or numpy array.
+    row_offsets: flat offsets of the rows in tokens, by default i * tokens.shape[1].
+        Used to write sequences packed back to back in a single row.
+    """
+    out = tokens.numpy() if isinstance(tokens, torch.Tensor) else tokens
+    out = out.reshape(-1)
+    if row_offsets is None:
+        row_offsets = np.arange(len(lengths), dtype=np.int64) * tokens.shape[1]
+    row_starts = np.asarray(row_offsets, dtype=np.int64) + start
+    seq_starts = np.cumsum(lengths) - lengths
+    out[np.repeat(row_starts - seq_starts, lengths) + np.arange(len(values))] = values
+
+
 class MSABatchConverter(BatchConverter):
     def __call__(self, inputs: Union[Sequence[RawMSA], RawMSA]):
         if isinstance(inputs[0][0], str):
@@ -2,11 +2,16 @@
 #
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
+import argparse
+import contextlib
+import inspect
+import itertools
 import json
 import math
 import os
 import re
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from functools import partial
 import torch
@@ -15,24 +20,41 @@ import torch.nn as nn
 
 import copy
 
-from mamba_ssm.models.config_mamba import MambaConfig
-from mamba_ssm.modules.mamba_simple import Mamba
-from mamba_ssm.modules.mamba2 import Mamba2
-from mamba_ssm.modules.mha import MHA
-from mamba_ssm.modules.mlp import GatedMLP
-from mamba_ssm.modules.block import Block
-from mamba_ssm.utils.hf import load_config_hf, load_state_dict_hf
-
-try:
-    from mamba_ssm.ops.triton.layer_norm import RMSNorm, layer_norm_fn, rms_norm_fn
-except ImportError:
-    RMSNorm, layer_norm_fn, rms_norm_fn = None, None, None
+# mamba_ssm and its Triton kernels are imported on first use, see DGRNA.backends
+from . import backends
+from . import mamba2_torch
 from .multihead_attention_mha import MultiheadAttention
+from .pooling import pool, token_mask
 # from .esm2 import ESM2, MAMBA2
 # from .mamba2 import MambaLMHeadModel
 import DGRNA.data as DGdata
 
 
+BACKENDS = ("cuda", "torch")
+
+
+def __getattr__(name):
+    # The mamba_ssm symbols this module used to import eagerly (None when not installed)
+    for library in ("mamba_ssm", "triton_norm"):
+        if any(name in names for _, names in backends.LIBRARIES[library]):
+            return backends.get(library, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def resolve_backend(backend=None):
+    """Pick the block implementation: "cuda" runs the mamba_ssm Triton/CUDA kernels,
+    "torch" runs the pure-PyTorch chunked SSD scan from mamba2_torch and works on any device.
+    None selects "cuda" when mamba_ssm is installed and a GPU is visible, else "torch".
+    """
+    if backend is None:
+        return backends.select("mamba2")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}, only support {', '.join(BACKENDS)}")
+    if backend == "cuda" and not backends.available("mamba_ssm"):
+        raise ImportError("The cuda backend requires mamba_ssm")
+    return backend
+
+
 def create_block(
     d_model,
     d_intermediate,
@@ -44,9 +66,18 @@ def create_block(
     residual_in_fp32=False,
     fused_add_norm=False,
     layer_idx=None,
+    backend="cuda",
     device=None,
     dtype=None,
 ):
+    if backend == "torch":
+        mamba2_cls, block_cls, mlp_cls, rms_norm_cls = (
+            mamba2_torch.Mamba2, mamba2_torch.Block, mamba2_torch.GatedMLP, mamba2_torch.RMSNorm
+        )
+    else:
+        ssm = backends.require("mamba_ssm")
+        mamba2_cls, block_cls, mlp_cls = ssm.Mamba2, ssm.Block, ssm.GatedMLP
+        rms_norm_cls = backends.get("triton_norm", "RMSNorm")
     if ssm_cfg is None:
         ssm_cfg = {}
     if attn_layer_idx is None:
@@ -61,23 +92,25 @@ def create_block(
         if ssm_layer not in ["Mamba1", "Mamba2"]:
             raise ValueError(f"Invalid ssm_layer: {ssm_layer}, only support Mamba1 and Mamba2")
         mixer_cls = partial(
-            Mamba2 if ssm_layer == "Mamba2" else Mamba,
+            mamba2_cls if ssm_layer == "Mamba2" else backends.require("mamba_ssm").Mamba,
             layer_idx=layer_idx,
             **ssm_cfg,
             **factory_kwargs
         )
     else:
-        mixer_cls = partial(MHA, layer_idx=layer_idx, **attn_cfg, **factory_kwargs)
+        if backend == "torch":
+            raise ValueError("Attention blocks (attn_layer_idx) are not supported by the torch backend")
+        mixer_cls = partial(backends.require("mamba_ssm").MHA, layer_idx=layer_idx, **attn_cfg, **factory_kwargs)
     norm_cls = partial(
-        nn.LayerNorm if not rms_norm else RMSNorm, eps=norm_epsilon, **factory_kwargs
+        nn.LayerNorm if not rms_norm else rms_norm_cls, eps=norm_epsilon, **factory_kwargs
     )
     if d_intermediate == 0:
         mlp_cls = nn.Identity
     else:
         mlp_cls = partial(
-            GatedMLP, hidden_features=d_intermediate, out_features=d_model, **factory_kwargs
+            mlp_cls, hidden_features=d_intermediate, out_features=d_model, **factory_kwargs
         )
-    block = Block(
+    block = block_cls(
         d_model,
         mixer_cls,
         mlp_cls,
@@ -153,7 +186,7 @@ class MixerModel(nn.Module):
         # This is for performance reason: we can fuse add + layer_norm.
         self.fused_add_norm = fused_add_norm
         if self.fused_add_norm:
-            if layer_norm_fn is None or rms_norm_fn is None:
+            if not backends.available("triton_norm"):
                 raise ImportError("Failed to import Triton LayerNorm / RMSNorm kernels")
 
         self.layers = nn.ModuleList(
@@ -175,7 +208,7 @@ class MixerModel(nn.Module):
             ]
         )
 
-        self.norm_f = (nn.LayerNorm if not rms_norm else RMSNorm)(
+        self.norm_f = (nn.LayerNorm if not rms_norm else backends.get("triton_norm", "RMSNorm"))(
             d_model, eps=norm_epsilon, **factory_kwargs
         )
 
@@ -206,7 +239,8 @@ class MixerModel(nn.Module):
             hidden_states = self.norm_f(residual.to(dtype=self.norm_f.weight.dtype))
         else:
             # Set prenorm=False here since we don't need the residual
-            hidden_states = layer_norm_fn(
+            triton_norm = backends.require("triton_norm")
+            hidden_states = triton_norm.layer_norm_fn(
                 hidden_states,
                 self.norm_f.weight,
                 self.norm_f.bias,
@@ -214,11 +248,43 @@ class MixerModel(nn.Module):
                 residual=residual,
                 prenorm=False,
                 residual_in_fp32=self.residual_in_fp32,
-                is_rms_norm=isinstance(self.norm_f, RMSNorm)
+                is_rms_norm=isinstance(self.norm_f, triton_norm.RMSNorm)
             )
         return hidden_states
 
 
+_SIDE_STREAMS = {}
+_DIRECTION_POOL = None
+# Stage context when no profiler is attached, see DGRNA.profiling
+_NO_STAGE = contextlib.nullcontext()
+
+
+def _side_stream(device):
+    if device not in _SIDE_STREAMS:
+        _SIDE_STREAMS[device] = torch.cuda.Stream(device)
+    return _SIDE_STREAMS[device]
+
+
+def _direction_pool():
+    """Two worker threads shared by all models of the process. They leave the intra-op
+    thread count alone: torch.set_num_threads is process-wide, not per thread.
+    """
+    global _DIRECTION_POOL
+    if _DIRECTION_POOL is None:
+        _DIRECTION_POOL = ThreadPoolExecutor(max_workers=2)
+    return _DIRECTION_POOL
+
+
+def _reverse_index(key_padding_mask):
+    """(B, L) index that reverses the valid prefix of every row of a right-padded batch
+    and leaves the padding in place. Applying it twice is the identity.
+    """
+    lengths = key_padding_mask.sum(-1, keepdim=True)
+    positions = torch.arange(key_padding_mask.shape[1], device=key_padding_mask.device)
+    positions = positions.expand_as(key_padding_mask)
+    return torch.where(key_padding_mask, lengths - 1 - positions, positions)
+
+
 class BiDirectionMixerModel(nn.Module):
     """
     ref to https://github.com/programmablebio/ptm-mamba/blob/main/protein_lm/modeling/models/mamba/lm.py
@@ -237,12 +303,27 @@ class BiDirectionMixerModel(nn.Module):
         initializer_cfg=None,
         fused_add_norm=False,
         residual_in_fp32=False,
+        backend=None,
+        padding_idx=None,
+        concurrent_directions=False,
+        attn_backend=None,
         device=None,
         dtype=None,
     ) -> None:
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
         self.residual_in_fp32 = residual_in_fp32
+        # Right-padded batches are detected from this token, see forward
+        self.padding_idx = padding_idx
+        # Run the forward and backward branch of each layer at the same time, see _run_directions
+        self.concurrent_directions = concurrent_directions
+        # DGRNA.profiling.Profiler recording the forward stages, see DGRNA.profiling.profile
+        self.profiler = None
+        self.backend = resolve_backend(backend)
+        if self.backend == "torch":
+            # Same math as the fused kernel, computed as separate add and norm
+            fused_add_norm = False
+        rms_norm_cls = mamba2_torch.RMSNorm if self.backend == "torch" else backends.get("triton_norm", "RMSNorm")
 
         self.embedding = nn.Embedding(vocab_size, d_model, **factory_kwargs)
         self.gate = nn.Linear(d_model, 1, )
@@ -254,7 +335,7 @@ class BiDirectionMixerModel(nn.Module):
         # This is for performance reason: we can fuse add + layer_norm.
         self.fused_add_norm = fused_add_norm
         if self.fused_add_norm:
-            if layer_norm_fn is None or rms_norm_fn is None:
+            if not backends.available("triton_norm"):
                 raise ImportError("Failed to import Triton LayerNorm / RMSNorm kernels")
 
         self.forward_layers = nn.ModuleList(
@@ -270,6 +351,7 @@ class BiDirectionMixerModel(nn.Module):
                     residual_in_fp32=residual_in_fp32,
                     fused_add_norm=fused_add_norm,
                     layer_idx=i,
+                    backend=self.backend,
                     **factory_kwargs,
                 )
                 for i in range(n_layer)
@@ -288,6 +370,7 @@ class BiDirectionMixerModel(nn.Module):
                     residual_in_fp32=residual_in_fp32,
                     fused_add_norm=fused_add_norm,
                     layer_idx=i,
+                    backend=self.backend,
                     **factory_kwargs,
                 )
                 for i in range(n_layer)
@@ -299,7 +382,9 @@ class BiDirectionMixerModel(nn.Module):
                     MultiheadAttention(
                         d_model,
                         32,
-                        use_flash_attn=True,
+                        # FlashAttention is only used for the CUDA fp16/bf16 inputs it can take
+                        use_flash_attn=backends.available("flash_attn"),
+                        attn_backend=attn_backend,
                         return_residual=False,
                         rotary_emb_dim=(d_model//32),
                         layer_idx=i
@@ -310,7 +395,7 @@ class BiDirectionMixerModel(nn.Module):
             [nn.Linear( 2* d_model, d_model) for i in range(n_layer)]
         )
 
-        self.norm_f = (nn.LayerNorm if not rms_norm else RMSNorm)(
+        self.norm_f = (nn.LayerNorm if not rms_norm else rms_norm_cls)(
             d_model, eps=norm_epsilon, **factory_kwargs
         )
 
@@ -329,8 +414,176 @@ class BiDirectionMixerModel(nn.Module):
             for i, layer in enumerate(self.layers)
         }
 
-    def forward(self, input_ids, inference_params=None,embedding=None, **mixer_kwargs):
+    def _repr_layers(self, repr_layers, early_exit):
+        """The set of layers to return for repr_layers (see forward) and the number of
+        bidirectional layers to run.
+        """
+        n_layer = len(self.forward_layers)
+        if early_exit and not repr_layers:
+            raise ValueError("early_exit requires at least one layer in repr_layers")
+        if repr_layers is None:
+            return set(), n_layer
+        layers = set()
+        for layer in repr_layers:
+            if not -(n_layer + 1) <= layer <= n_layer:
+                raise ValueError(f"repr_layers must be in [{-(n_layer + 1)}, {n_layer}], got {layer}")
+            layers.add(layer % (n_layer + 1))
+        return layers, max(layers) if early_exit else n_layer
+
+    def _forward_chunked(self, input_ids, seq_chunk_len, repr_layers=None, early_exit=False):
+        """forward for long inputs. Each direction of each layer runs over seq_chunk_len
+        tokens at a time, carrying its conv and SSM state from one chunk to the next, and the
+        attention is computed block by block. Between layers only the layer input and the
+        forward branch output are kept at full length; the forward output is overwritten
+        in place with the merged result as the backward chunks come in.
+        """
+        layers, num_layers = self._repr_layers(repr_layers, early_exit)
+        batch, seqlen = input_ids.shape
+        key_padding_mask = None
+        if self.padding_idx is not None:
+            key_padding_mask = input_ids.ne(self.padding_idx)
+            if key_padding_mask.all():
+                key_padding_mask = None
+        if key_padding_mask is None:
+            reverse_index = torch.arange(seqlen - 1, -1, -1, device=input_ids.device).expand(batch, seqlen)
+        else:
+            reverse_index = _reverse_index(key_padding_mask)
+        chunk_starts = range(0, seqlen, seq_chunk_len)
+
+        def gather(x, index):
+            return x.gather(1, index.expand(-1, -1, x.shape[-1]))
+
+        hidden_states, residual = self.embedding(input_ids), None
+        representations = {0: hidden_states} if 0 in layers else {}
+        for i, (f_layer, b_layer, h_fc) in enumerate(itertools.islice(zip(
+                self.forward_layers, self.backward_layers, self.hidden_fc
+        ), num_layers)):
+            state = None
+            for start in chunk_starts:
+                end = start + seq_chunk_len
+                hidden_chunk, residual_chunk, state = mamba2_torch.block_forward_with_state(
+                    f_layer,
+                    hidden_states[:, start:end],
+                    residual[:, start:end] if residual is not None else None,
+                    state,
+                )
+                if start == 0:
+                    hidden_states_f = hidden_chunk.new_empty(batch, seqlen, hidden_chunk.shape[-1])
+                    residual_f = residual_chunk.new_empty(batch, seqlen, residual_chunk.shape[-1])
+                hidden_states_f[:, start:end] = hidden_chunk
+                residual_f[:, start:end] = residual_chunk
+            state = None
+            # Chunks of the reversed sequences; index maps them back to the original positions
+            for start in chunk_starts:
+                index = reverse_index[:, start : start + seq_chunk_len, None]
+                hidden_chunk, residual_chunk, state = mamba2_torch.block_forward_with_state(
+                    b_layer,
+                    gather(hidden_states, index),
+                    gather(residual, index) if residual is not None else None,
+                    state,
+                )
+                hidden_chunk_f = gather(hidden_states_f, index)
+                merged = h_fc(torch.cat([hidden_chunk_f, hidden_chunk], dim=-1)) + hidden_chunk_f
+                hidden_states_f.scatter_(1, index.expand_as(merged), merged)
+                merged = 0.5 * (gather(residual_f, index) + residual_chunk)
+                residual_f.scatter_(1, index.expand_as(merged), merged)
+            hidden_states, residual = hidden_states_f, residual_f
+            del hidden_states_f, residual_f
+            if i + 1 in layers:
+                representations[i + 1] = hidden_states + residual
+        if early_exit:
+            return None, representations
+        hidden_states = self.attn_layers[0].chunked_forward(
+            hidden_states, key_padding_mask=key_padding_mask, chunk_size=seq_chunk_len
+        )
+        hidden_states = self._final_norm(hidden_states, residual)
+        return hidden_states if repr_layers is None else (hidden_states, representations)
+
+    def _run_directions(self, run_forward, run_backward):
+        """Run the two (independent) branches of a layer and return both outputs.
+        With concurrent_directions, the backward branch is queued on a side CUDA stream while
+        the forward branch runs on the current one. On CPU each branch runs in its own
+        thread and both share torch's intra-op thread pool, whose size (and so the setting
+        of the caller and of every other model of the process) is left unchanged.
+        """
+        if not self.concurrent_directions:
+            return run_forward(), run_backward()
+        device = self.embedding.weight.device
+        if device.type == "cuda":
+            current = torch.cuda.current_stream(device)
+            side = _side_stream(device)
+            side.wait_stream(current)
+            with torch.cuda.stream(side):
+                outputs_b = run_backward()
+            outputs_f = run_forward()
+            current.wait_stream(side)
+            for t in outputs_b:
+                # Allocated on the side stream, consumed on the current one
+                t.record_stream(current)
+            return outputs_f, outputs_b
+        # Grad and inference mode are thread-local, carry them over to the workers
+        grad_enabled, inference_mode = torch.is_grad_enabled(), torch.is_inference_mode_enabled()
+
+        def call(fn):
+            with torch.set_grad_enabled(grad_enabled), torch.inference_mode(inference_mode):
+                return fn()
+
+        pool = _direction_pool()
+        futures = [pool.submit(call, fn) for fn in (run_forward, run_backward)]
+        return tuple(future.result() for future in futures)
+
+    def forward(self, input_ids, inference_params=None,embedding=None, cu_seqlens=None, seq_chunk_len=None, repr_layers=None, early_exit=False, **mixer_kwargs):
+        """
+        input_ids: (B, L), or (1, total) when cu_seqlens is given. Batches of different
+            lengths are right-padded with padding_idx: the backward branch reverses only the
+            valid prefix of every row and the attention layer masks the padding, so each
+            sequence gets the same output as if it were run alone.
+        cu_seqlens: (num_seqs + 1,) int32 cumulative lengths of the sequences packed in the
+            single row of input_ids (see DGRNA.data.PackedBatchConverter). Both Mamba2
+            directions reset their state at every sequence start and the attention layer
+            only attends within a sequence, so each sequence gets the same output as if it
+            were run alone, without computing anything on padding.
+        seq_chunk_len: long-input mode for inputs longer than seq_chunk_len tokens, see
+            _forward_chunked. Same result, with memory bounded by the chunk length instead of
+            the sequence length (apart from a few (B, L, D) tensors).
+        repr_layers: ESM-style intermediate outputs. Layer 0 is the embedding and layer i
+            (1..n_layer) the residual stream after bidirectional layer i (its merged hidden
+            states plus residual), before the attention layer and norm_f; negative indices
+            count from the end. Only these are kept, and forward returns a (hidden_states,
+            {layer: (B, L, D)}) tuple.
+        early_exit: with repr_layers, stop after the deepest requested layer and skip the
+            remaining layers, the attention layer and norm_f; hidden_states is then None.
+        """
+        if seq_chunk_len is not None and input_ids.shape[1] > seq_chunk_len:
+            if cu_seqlens is not None or inference_params is not None:
+                raise ValueError("seq_chunk_len cannot be combined with cu_seqlens or inference_params")
+            return self._forward_chunked(input_ids, seq_chunk_len, repr_layers, early_exit)
+        layers, num_layers = self._repr_layers(repr_layers, early_exit)
         hidden_states = self.embedding(input_ids)
+        representations = {0: hidden_states} if 0 in layers else {}
+        f_kwargs, b_kwargs, attn_kwargs = {}, {}, {}
+        reverse_index = None
+        if cu_seqlens is None and self.padding_idx is not None:
+            key_padding_mask = input_ids.ne(self.padding_idx)
+            if not key_padding_mask.all():
+                reverse_index = _reverse_index(key_padding_mask).unsqueeze(-1)
+                attn_kwargs["key_padding_mask"] = key_padding_mask
+
+        def flip(x):
+            if reverse_index is None:
+                return x.flip([1])
+            return x.gather(1, reverse_index.expand_as(x))
+
+        if cu_seqlens is not None:
+            if input_ids.shape[0] != 1:
+                raise ValueError("Packed input_ids must have shape (1, total) when cu_seqlens is given")
+            seq_idx = mamba2_torch.seq_idx_from_cu_seqlens(cu_seqlens)
+            f_kwargs["seq_idx"] = seq_idx
+            # The flipped row holds the sequences in reverse order; renumber them so the
+            # ids still increase along the row.
+            b_kwargs["seq_idx"] = (len(cu_seqlens) - 2) - seq_idx.flip([1])
+            attn_kwargs["cu_seqlens"] = cu_seqlens
+            attn_kwargs["max_seqlen"] = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
         #hidden_states_r = self.attn_layers[0](hidden_states)
         # embedding = torch.zeros_like(hidden_states) if embedding is None else embedding # BxLxD
         # gate = self.gate(torch.cat([hidden_states, embedding], dim=-1)).sigmoid()
@@ -338,28 +591,61 @@ class BiDirectionMixerModel(nn.Module):
         # contact = self.gate(contact).sigmoid().squeeze(-1) # BxLxD
         # hidden_states = hidden_states + contact# + embedding * (1 - gate)
         residual = None
-        for f_layer, b_layer, h_fc in zip(
+        stage = self._stage
+        for i, (f_layer, b_layer, h_fc) in enumerate(itertools.islice(zip(
                 self.forward_layers, self.backward_layers, self.hidden_fc
-        ):
-            hidden_states_f, residual_f = f_layer(
-                hidden_states, residual, inference_params=inference_params
-            )
-            flip_residual = residual.flip([1]) if residual is not None else None
-            hidden_states_b, residual_b = b_layer(
-                hidden_states.flip([1]), flip_residual, inference_params=inference_params
+        ), num_layers)):
+            def run_forward():
+                with stage("forward_block", i, f_layer, hidden_states):
+                    return f_layer(hidden_states, residual, inference_params=inference_params, **f_kwargs)
+
+            def run_backward():
+                with stage("flip", i, None, hidden_states):
+                    flip_hidden_states = flip(hidden_states)
+                    flip_residual = flip(residual) if residual is not None else None
+                with stage("backward_block", i, b_layer, hidden_states):
+                    return b_layer(
+                        flip_hidden_states, flip_residual, inference_params=inference_params, **b_kwargs
+                    )
+
+            (hidden_states_f, residual_f), (hidden_states_b, residual_b) = self._run_directions(
+                run_forward, run_backward
             )
-            hidden_states = h_fc(torch.cat([hidden_states_f, hidden_states_b.flip([1])], dim=-1)) + hidden_states_f
+            with stage("flip", i, None, hidden_states):
+                hidden_states_b, residual_b = flip(hidden_states_b), flip(residual_b)
+            with stage("hidden_fc", i, h_fc, hidden_states_b):
+                hidden_states = h_fc(torch.cat([hidden_states_f, hidden_states_b], dim=-1)) + hidden_states_f
             #hidden_states = gates*hidden_states_f + (1-gates)*hidden_states_b.flip([1])
-            residual = 0.5 * (residual_f + residual_b.flip([1]))
+            residual = 0.5 * (residual_f + residual_b)
+            if i + 1 in layers:
+                representations[i + 1] = hidden_states + residual
+        if early_exit:
+            return None, representations
         #hidden_states = self.norm_f(self.gmlp(hidden_states))
-        hidden_states = self.attn_layers[0](hidden_states)# + hidden_states_r
-
+        with stage("attention", None, self.attn_layers[0], hidden_states):
+            if cu_seqlens is None:
+                hidden_states = self.attn_layers[0](hidden_states, **attn_kwargs)# + hidden_states_r
+            else:
+                hidden_states = self.attn_layers[0](hidden_states.squeeze(0), **attn_kwargs).unsqueeze(0)
+
+        with stage("norm_f", None, self.norm_f, hidden_states):
+            hidden_states = self._final_norm(hidden_states, residual)
+        return hidden_states if repr_layers is None else (hidden_states, representations)
+
+    def _stage(self, name, layer=None, module=None, x=None):
+        """Context recording a forward stage on the attached profiler, if any."""
+        if self.profiler is None:
+            return _NO_STAGE
+        return self.profiler.stage(name, layer, module, x)
+
+    def _final_norm(self, hidden_states, residual):
         if not self.fused_add_norm:
             residual = (hidden_states + residual) if residual is not None else hidden_states
             hidden_states = self.norm_f(residual.to(dtype=self.norm_f.weight.dtype))
         else:
             # Set prenorm=False here since we don't need the residual
-            hidden_states = layer_norm_fn(
+            triton_norm = backends.require("triton_norm")
+            hidden_states = triton_norm.layer_norm_fn(
                 hidden_states,
                 self.norm_f.weight,
                 self.norm_f.bias,
@@ -367,11 +653,14 @@ class BiDirectionMixerModel(nn.Module):
                 residual=residual,
                 prenorm=False,
                 residual_in_fp32=self.residual_in_fp32,
-                is_rms_norm=isinstance(self.norm_f, RMSNorm)
+                is_rms_norm=isinstance(self.norm_f, triton_norm.RMSNorm)
             )
         return hidden_states
 
 
+OUTPUTS = ("hidden", "logits", "both")
+
+
 class MambaLMHeadModel(nn.Module):
 
     def __init__(
@@ -379,10 +668,13 @@ class MambaLMHeadModel(nn.Module):
         config,#: MambaConfig
         dictionary,
         initializer_cfg=None,
+        backend=None,
         device=None,
         dtype=None,
     ) -> None:
         self.config = config
+        # Padding / BOS / EOS conventions of the inputs, for pooling
+        self.dictionary = dictionary
         d_model = config.d_model
         n_layer = config.n_layer
         d_intermediate = config.d_intermediate
@@ -425,6 +717,8 @@ class MambaLMHeadModel(nn.Module):
             initializer_cfg=initializer_cfg,
             fused_add_norm=fused_add_norm,
             residual_in_fp32=residual_in_fp32,
+            backend=backend,
+            padding_idx=dictionary.padding_idx,
             **factory_kwargs,
         )
         # self.lm_head = nn.Linear(d_model, vocab_size, bias=False, **factory_kwargs)
@@ -446,26 +740,93 @@ class MambaLMHeadModel(nn.Module):
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None, **kwargs):
         return self.backbone.allocate_inference_cache(batch_size, max_seqlen, dtype=dtype, **kwargs)
 
-    def forward(self, input_ids, position_ids=None, inference_params=None, num_last_tokens=0, masked_tokens=None, **mixer_kwargs):
+    def forward(self, input_ids, position_ids=None, inference_params=None, num_last_tokens=0, masked_tokens=None, output="hidden", out_dtype=None, repr_layers=None, early_exit=False, pooling=None, **mixer_kwargs):
         """
         "position_ids" is just to be compatible with Transformer generation. We don't use it.
+        output: what to compute and return. The LM head only runs when logits are requested.
+            "hidden": the final hidden states (B, L, D).
+            "logits": the LM head logits (B, L, V).
+            "both": a (hidden_states, logits) tuple.
+        masked_tokens: boolean (B, L). If given, logits are only computed at these
+            positions and have shape (N, V), N = masked_tokens.sum().
         num_last_tokens: if > 0, only return the logits for the last n tokens
+        out_dtype: dtype of the returned hidden states and logits. By default the hidden
+            states are in the dtype of norm_f (fp32 after cast_for_inference).
+        cu_seqlens: packed input mode, input_ids is (1, total); see BiDirectionMixerModel.forward.
+        seq_chunk_len: long-input mode, see BiDirectionMixerModel.forward.
+        repr_layers, early_exit: intermediate layer outputs, see BiDirectionMixerModel.forward.
+            With repr_layers, a dict is returned: "representations" ({layer: (B, L, D)}) and,
+            depending on output, "hidden_states" and "logits". early_exit only returns
+            "representations" and requires output="hidden".
+        pooling: return one (B, D) embedding per sequence instead of the (B, L, D) hidden
+            states (and representations), pooled on the device over the residues, without
+            padding, BOS and EOS: "mean", "max", "bos" or a module such as
+            DGRNA.pooling.AttentionPooling. Requires output="hidden" and a padded batch.
         """
-        hidden_states = self.backbone(input_ids, inference_params=inference_params, **mixer_kwargs)
-
-        # if num_last_tokens > 0:
-        #     hidden_states = hidden_states[:, -num_last_tokens:]
-        # lm_logits = self.lm_head(hidden_states, masked_tokens)
-        lm_logits = self.lm_head(hidden_states)
+        if output not in OUTPUTS:
+            raise ValueError(f"Unknown output: {output}, only support {', '.join(OUTPUTS)}")
+        if early_exit and output != "hidden":
+            raise ValueError("early_exit skips the last layers and the LM head, use output='hidden'")
+        if pooling is not None and (output != "hidden" or mixer_kwargs.get("cu_seqlens") is not None):
+            raise ValueError("pooling requires output='hidden' and a padded (B, L) batch")
+        if pooling == "bos" and not self.dictionary.prepend_bos:
+            raise ValueError("bos pooling requires an alphabet that prepends a BOS token")
+        stage = self.backbone._stage
+        with stage("backbone", None, None, input_ids):
+            hidden_states = self.backbone(
+                input_ids, inference_params=inference_params, repr_layers=repr_layers, early_exit=early_exit, **mixer_kwargs
+            )
+        representations = None
+        if repr_layers is not None:
+            hidden_states, representations = hidden_states
+        if pooling is not None:
+            mask = token_mask(input_ids, self.dictionary)
+            if hidden_states is not None:
+                hidden_states = pool(hidden_states, mask, pooling)
+            if representations is not None:
+                representations = {layer: pool(x, mask, pooling) for layer, x in representations.items()}
+        if representations is not None:
+            if out_dtype is not None:
+                representations = {layer: x.to(out_dtype) for layer, x in representations.items()}
+            if early_exit:
+                return {"representations": representations}
+        if output == "hidden":
+            hidden_states = hidden_states if out_dtype is None else hidden_states.to(out_dtype)
+            if representations is not None:
+                return {"hidden_states": hidden_states, "representations": representations}
+            return hidden_states
+
+        features = hidden_states
+        # The head's layer_norm, unlike dense, keeps a weight tensor under int8 quantization
+        head_dtype = self.lm_head.layer_norm.weight.dtype
+        if features.dtype != head_dtype:
+            # fp32 norm_f output into a half precision head
+            features = features.to(head_dtype)
+        if num_last_tokens > 0:
+            features = features[:, -num_last_tokens:]
+            if masked_tokens is not None:
+                masked_tokens = masked_tokens[:, -num_last_tokens:]
+        with stage("lm_head", None, self.lm_head, features):
+            lm_logits = self.lm_head(features, masked_tokens)
+        if out_dtype is not None:
+            hidden_states, lm_logits = hidden_states.to(out_dtype), lm_logits.to(out_dtype)
         # CausalLMOutput = namedtuple("CausalLMOutput", ["logits"])
-        return hidden_states#CausalLMOutput(logits=lm_logits)
+        if representations is not None:
+            result = {"logits": lm_logits, "representations": representations}
+            if output == "both":
+                result["hidden_states"] = hidden_states
+            return result
+        if output == "logits":
+            return lm_logits
+        return hidden_states, lm_logits
 
     @classmethod
     def from_pretrained(cls, pretrained_model_name, device=None, dtype=None, **kwargs):
-        config_data = load_config_hf(pretrained_model_name)
-        config = MambaConfig(**config_data)
+        ssm = backends.require("mamba_ssm")
+        config_data = ssm.load_config_hf(pretrained_model_name)
+        config = ssm.MambaConfig(**config_data)
         model = cls(config, device=device, dtype=dtype, **kwargs)
-        model.load_state_dict(load_state_dict_hf(pretrained_model_name, device=device, dtype=dtype))
+        model.load_state_dict(ssm.load_state_dict_hf(pretrained_model_name, device=device, dtype=dtype))
         return model
 
     def save_pretrained(self, save_directory):
@@ -521,27 +882,40 @@ def _has_regression_weights(model_name):
     return not ("esm1v" in model_name or "esm_if" in model_name or "270K" in model_name or "500K" in model_name)
 
 
-def load_model_and_alphabet(model_name):
+def load_model_and_alphabet(model_name, backend=None, dtype=None):
+    """dtype: e.g. torch.float16 or torch.bfloat16 for half precision inference, see cast_for_inference."""
     if model_name.endswith(".pt"):  # treat as filepath
-        return load_model_and_alphabet_local(model_name)
+        return load_model_and_alphabet_local(model_name, backend=backend, dtype=dtype)
     else:
-        return load_model_and_alphabet_hub(model_name)
+        return load_model_and_alphabet_hub(model_name, backend=backend, dtype=dtype)
+
+
+# torch >= 2.1: torch.load(mmap=True) and load_state_dict(assign=True)
+_FAST_LOADING = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def load_checkpoint(path):
+    """torch.load a checkpoint onto the CPU. When supported, the file is memory-mapped
+    instead of read: tensors are paged in when used, and entries that are never used
+    (e.g. the optimizer state) never enter memory.
+    """
+    if _FAST_LOADING:
+        try:
+            return torch.load(str(path), map_location="cpu", mmap=True, weights_only=False)
+        except RuntimeError:
+            # Files in the legacy (non-zip) serialization format cannot be memory-mapped
+            pass
+    return torch.load(str(path), map_location="cpu")
 
 
 def load_hub_workaround(url, download_name=None):
-    try:
-        data = torch.hub.load_state_dict_from_url(url, progress=True, map_location='cpu', file_name=download_name)
-    except RuntimeError:
-        # Pytorch version issue - see https://github.com/pytorch/pytorch/issues/43106
-        if download_name == None:
-            fn = Path(url).name
-        else:
-            fn = download_name
-        data = torch.load(
-            f"{torch.hub.get_dir()}/checkpoints/{fn}",
-            map_location="cpu",
-        )
-    return data
+    """Download url into the torch hub checkpoint directory (once) and load it."""
+    file_name = download_name if download_name is not None else Path(url).name
+    path = Path(torch.hub.get_dir()) / "checkpoints" / file_name
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.hub.download_url_to_file(url, str(path), progress=True)
+    return load_checkpoint(path)
 
 
 def load_regression_hub(model_name):
@@ -560,22 +934,25 @@ def _download_model_and_regression_data(model_name):
     return model_data, regression_data
 
 
-def load_model_and_alphabet_hub(model_name):
+def load_model_and_alphabet_hub(model_name, backend=None, dtype=None):
     model_data, regression_data = _download_model_and_regression_data(model_name)
-    return load_model_and_alphabet_core(model_name, model_data, regression_data)
+    return load_model_and_alphabet_core(model_name, model_data, regression_data, backend=backend, dtype=dtype)
 
 
-def load_model_and_alphabet_local(model_location):
+def load_model_and_alphabet_local(model_location, backend=None, dtype=None):
     """Load from local path. The regression weights need to be co-located"""
     model_location = Path(model_location)
-    model_data = torch.load(str(model_location), map_location="cpu")
+    model_data = load_checkpoint(model_location)
     model_name = model_location.stem
-    if _has_regression_weights(model_name):
+    if _is_artifact(model_data):
+        # Self-contained, see convert_checkpoint
+        regression_data = None
+    elif _has_regression_weights(model_name):
         regression_location = str(model_location.with_suffix("")) + "-contact-regression.pt"
-        regression_data = torch.load(regression_location, map_location="cpu")
+        regression_data = load_checkpoint(regression_location)
     else:
         regression_data = None
-    return load_model_and_alphabet_core(model_name, model_data, regression_data)
+    return load_model_and_alphabet_core(model_name, model_data, regression_data, backend=backend, dtype=dtype)
 
 
 def has_emb_layer_norm_before(model_state):
@@ -583,19 +960,104 @@ def has_emb_layer_norm_before(model_state):
     return any(k.startswith("emb_layer_norm_before") for k, param in model_state.items())
 
 
-def _load_model_and_alphabet_core_v2(model_data):
-    def upgrade_state_dict(state_dict):
-        """Removes prefixes 'model.encoder.sentence_encoder.' and 'model.encoder.'."""
-        prefixes = ["encoder.sentence_encoder.", "encoder."]
-        pattern = re.compile("^" + "|".join(prefixes))
-        state_dict = {pattern.sub("", name): param for name, param in state_dict.items()}
-        return state_dict
-
-    cfg = model_data["cfg"]["model"]
+def upgrade_state_dict(state_dict):
+    """Removes prefixes 'model.encoder.sentence_encoder.' and 'model.encoder.'."""
+    prefixes = ["encoder.sentence_encoder.", "encoder."]
+    pattern = re.compile("^" + "|".join(prefixes))
+    state_dict = {pattern.sub("", name): param for name, param in state_dict.items()}
+    return state_dict
+
+
+ARTIFACT_FORMAT = "dgrna-inference"
+# Config fields read by MambaLMHeadModel
+MODEL_CFG_KEYS = (
+    "d_model",
+    "n_layer",
+    "d_intermediate",
+    "ssm_cfg",
+    "attn_layer_idx",
+    "attn_cfg",
+    "rms_norm",
+    "residual_in_fp32",
+    "fused_add_norm",
+    "pad_vocab_size_multiple",
+    "activation_fn",
+    "tie_embeddings",
+)
+# Small, precision sensitive SSM parameters that stay in fp32 when an artifact is cast
+_FP32_PARAMS = ("A_log", "D", "dt_bias")
+
+
+def _keep_fp32(name):
+    """Whether parameter name stays in fp32 in half precision: the _FP32_PARAMS and norm_f."""
+    parts = name.split(".")
+    return parts[-1] in _FP32_PARAMS or "norm_f" in parts[:-1]
+
+
+def _is_artifact(model_data):
+    return isinstance(model_data, dict) and model_data.get("format") == ARTIFACT_FORMAT
+
+
+def _to_plain(value):
+    """Namespace / DictConfig / ListConfig -> dict / list, so the artifact unpickles with weights_only."""
+    if isinstance(value, argparse.Namespace):
+        value = vars(value)
+    if hasattr(value, "items"):
+        return {str(k): _to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "ListConfig":
+        return [_to_plain(v) for v in value]
+    return value
+
+
+def _model_cfg(model_data):
+    if _is_artifact(model_data):
+        return argparse.Namespace(**model_data["cfg"])
+    return model_data["cfg"]["model"]
+
+
+def convert_checkpoint(model_data, dtype=None):
+    """Inference artifact from a fairseq training checkpoint: only the model config, the
+    alphabet spec and the (prefix-upgraded) weights, without optimizer or trainer state.
+    dtype: cast floating point weights (except the SSM A_log, D and dt_bias and norm_f)
+        to it; the loaders cast the model with cast_for_inference accordingly.
+    Tensors shared in the checkpoint (the tied embedding / LM head) stay shared.
+    The result is what torch.save writes and what the load_model_and_alphabet* loaders read.
+    """
+    cfg = _model_cfg(model_data)
+    cfg = {key: _to_plain(getattr(cfg, key)) for key in MODEL_CFG_KEYS}
+    state_dict = upgrade_state_dict(model_data["model"])
+    if _is_artifact(model_data):
+        alphabet = model_data["alphabet"]
+    else:
+        alphabet = DGdata.Alphabet.from_architecture("ESM-1b").to_dict()
+    converted, seen = {}, {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if key not in seen:
+            keep = not tensor.is_floating_point() or _keep_fp32(name)
+            tensor = tensor if dtype is None or keep else tensor.to(dtype)
+            # Compact copy, a view would drag its whole storage into the file
+            seen[key] = tensor.clone(memory_format=torch.contiguous_format)
+        converted[name] = seen[key]
+    return {
+        "format": ARTIFACT_FORMAT,
+        "version": 1,
+        "cfg": cfg,
+        "alphabet": alphabet,
+        "dtype": str(dtype).replace("torch.", "") if dtype is not None else None,
+        "model": converted,
+    }
+
+
+def _load_model_and_alphabet_core_v2(model_data, backend=None):
+    cfg = _model_cfg(model_data)
     state_dict = model_data["model"]
     # print("state_dict: ",state_dict)
     state_dict = upgrade_state_dict(state_dict)
-    alphabet = DGdata.Alphabet.from_architecture("ESM-1b")
+    if _is_artifact(model_data):
+        alphabet = DGdata.Alphabet.from_dict(model_data["alphabet"])
+    else:
+        alphabet = DGdata.Alphabet.from_architecture("ESM-1b")
     # print("alphabet: ",len(alphabet))
     # model = ESM2(
     #     num_layers=cfg.encoder_layers,
@@ -611,12 +1073,51 @@ def _load_model_and_alphabet_core_v2(model_data):
     #     alphabet=alphabet,
     #     token_dropout=True, #cfg.token_dropout
     # )
-    model = MambaLMHeadModel(cfg, alphabet)
+    if _FAST_LOADING:
+        # Parameters without storage: no allocation and no random init, the checkpoint
+        # tensors are assigned in place by load_model_and_alphabet_core
+        with torch.device("meta"):
+            model = MambaLMHeadModel(cfg, alphabet, backend=backend)
+    else:
+        model = MambaLMHeadModel(cfg, alphabet, backend=backend)
 
     return model, alphabet, state_dict
 
 
-def load_model_and_alphabet_core(model_name, model_data, regression_data=None):
+def _materialize_non_persistent_buffers(model, device="cpu"):
+    """Buffers that are not in the state dict (the rotary inv_freq) are still on the meta
+    device after load_state_dict(assign=True); recompute them.
+    """
+    for module in model.modules():
+        inv_freq = getattr(module, "inv_freq", None)
+        if isinstance(inv_freq, torch.Tensor) and inv_freq.is_meta:
+            module.inv_freq = module._compute_inv_freq(device)
+
+
+def cast_for_inference(model, dtype):
+    """Half precision inference: cast the weights of a MambaLMHeadModel to dtype once, in
+    place, with a controlled fp32 residual stream.
+    Stay in fp32: the SSM A_log, D and dt_bias, the final norm_f and the buffers (the rotary
+    inv_freq). Every block accumulates its residual in fp32 (residual_in_fp32), so the
+    backbone output is the fp32 norm_f of an fp32 residual sum; only the layer inputs and
+    the matmuls run in dtype.
+    """
+    dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+    backbone = model.backbone
+    for name, param in model.named_parameters():
+        if not param.is_floating_point():
+            continue
+        fp32 = _keep_fp32(name)
+        # .data keeps the Parameter objects, so the tied embedding / LM head stay tied.
+        # A half precision artifact gets its fp32 parameters back.
+        param.data = param.data.to(torch.float32 if fp32 else dtype)
+    backbone.residual_in_fp32 = True
+    for layer in list(backbone.forward_layers) + list(backbone.backward_layers):
+        layer.residual_in_fp32 = True
+    return model
+
+
+def load_model_and_alphabet_core(model_name, model_data, regression_data=None, backend=None, dtype=None):
     # print("regression_data: ",regression_data)
     if regression_data is not None:
         model_data["model"].update(regression_data["model"])
@@ -628,9 +1129,9 @@ def load_model_and_alphabet_core(model_name, model_data, regression_data=None):
     # model_args = Namespace(**model_args)
     # print(model_data['cfg']["model"])
     # exit(0)
-    model_args = model_data['cfg']["model"]
+    model_args = _model_cfg(model_data)
 
-    model, alphabet, model_state = _load_model_and_alphabet_core_v2(model_data)
+    model, alphabet, model_state = _load_model_and_alphabet_core_v2(model_data, backend=backend)
 
 
     expected_keys = set(model.state_dict().keys())
@@ -676,11 +1177,30 @@ def load_model_and_alphabet_core(model_name, model_data, regression_data=None):
         error_msgs.append(f"Missing key(s) in state_dict: {missing}.")
 
     # model.load_state_dict(model_state, strict=regression_data is not None)
-    model.load_state_dict(model_state)
+    if _FAST_LOADING:
+        if missing:
+            # Would be left on the meta device
+            raise RuntimeError(
+                "Error(s) in loading state_dict for {}:\n\t{}".format(
+                    model.__class__.__name__, "\n\t".join(error_msgs)
+                )
+            )
+        model.load_state_dict(model_state, assign=True)
+        _materialize_non_persistent_buffers(model)
+        # assign replaced the shared embedding / LM head weight by two separate tensors
+        model.lm_head.weight = model.backbone.embedding.weight
+    else:
+        model.load_state_dict(model_state)
+    if dtype is None and _is_artifact(model_data):
+        # A half precision artifact loads as the model cast_for_inference gives, whether
+        # assign kept its dtype or load_state_dict copied it into fp32 parameters
+        dtype = model_data.get("dtype")
+    if dtype is not None:
+        cast_for_inference(model, dtype)
     return model, alphabet, model_args
 
 
-def load_mamba2_model_and_alphabet_hub(model_name):
+def load_mamba2_model_and_alphabet_hub(model_name, backend=None, dtype=None):
     if model_name == "rna_fm_t12":
         url = f"https://proj.cse.cuhk.edu.hk/rnafm/api/download?filename=checkpoint_best_100M.pt"
         model_data = load_hub_workaround(url, download_name="checkpoint_best_100M.pt")
@@ -690,15 +1210,15 @@ def load_mamba2_model_and_alphabet_hub(model_name):
 
     else:
         raise Exception("Unknown model name: {}".format(model_name))
-    return load_model_and_alphabet_core(model_name, model_data, regression_data)
+    return load_model_and_alphabet_core(model_name, model_data, regression_data, backend=backend, dtype=dtype)
 
 
-def rna_mamba2_L24(model_location=None):
+def rna_mamba2_L24(model_location=None, backend=None, dtype=None):
     # if model_location is not None and os.path.exists(model_location):
     #     # local
     #     return load_model_and_alphabet_local(model_location, theme="rna")  # "./pretrained/RNA-FM_pretrained.pth"
     # else:
-        return load_mamba2_model_and_alphabet_hub("rna_fm_t12")
+        return load_mamba2_model_and_alphabet_hub("rna_fm_t12", backend=backend, dtype=dtype)
 
 
 
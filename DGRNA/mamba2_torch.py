@@ -0,0 +1,529 @@
+# Copyright (c) 2024, Tri Dao, Albert Gu.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+"""Pure-PyTorch implementation of the Mamba2 block.
+
+The modules in this file mirror ``mamba_ssm.modules.mamba2.Mamba2``,
+``mamba_ssm.modules.block.Block``, ``mamba_ssm.modules.mlp.GatedMLP`` and the
+Triton ``RMSNorm`` parameter for parameter, so a state dict saved from the
+CUDA model loads unchanged. The selective scan is computed with the chunked
+SSD (state space dual) algorithm: quadratic attention-like products inside
+each chunk and a linear recurrence over chunk boundaries.
+"""
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange
+
+
+def segsum(x):
+    """Stable segment sum.
+    out[..., i, j] = x[..., j + 1] + ... + x[..., i] for i >= j, -inf above the diagonal.
+    Computed with a masked cumsum instead of a difference of cumsums, so -inf entries
+    in x (used to reset the state) never produce NaNs.
+    """
+    T = x.size(-1)
+    x = x[..., None].expand(*x.shape, T)
+    mask = torch.tril(torch.ones(T, T, device=x.device, dtype=torch.bool), diagonal=-1)
+    x = x.masked_fill(~mask, 0)
+    x_segsum = torch.cumsum(x, dim=-2)
+    mask = torch.tril(torch.ones(T, T, device=x.device, dtype=torch.bool), diagonal=0)
+    return x_segsum.masked_fill(~mask, -math.inf)
+
+
+def ssd_chunk_scan(
+    x,
+    dt,
+    A,
+    B,
+    C,
+    chunk_size,
+    D=None,
+    z=None,
+    initial_states=None,
+    seq_idx=None,
+    return_final_states=False,
+):
+    """Chunked SSD scan, the reference counterpart of ``mamba_chunk_scan_combined``.
+    Arguments:
+        x: (batch, seqlen, nheads, headdim)
+        dt: (batch, seqlen, nheads), after softplus and dt_limit.
+        A: (nheads,)
+        B, C: (batch, seqlen, ngroups, dstate)
+        chunk_size: int. Only affects speed and memory, not the result.
+        D: (nheads,) or (nheads, headdim)
+        z: (batch, seqlen, nheads, headdim). If not None, the output is gated by silu(z).
+        initial_states: (batch, nheads, headdim, dstate)
+        seq_idx: (batch, seqlen) integer. The state is reset wherever seq_idx changes.
+    Returns:
+        out: (batch, seqlen, nheads, headdim), in the dtype of x
+        final_states: (batch, nheads, headdim, dstate), if return_final_states
+    """
+    dtype = x.dtype
+    batch, seqlen, nheads, headdim = x.shape
+    ngroups = B.shape[2]
+    x, dt, B, C = x.float(), dt.float(), B.float(), C.float()
+    dA = dt * A.float()
+    if seq_idx is not None:
+        seq_start = torch.zeros_like(seq_idx, dtype=torch.bool)
+        seq_start[:, 1:] = seq_idx[:, 1:] != seq_idx[:, :-1]
+        # exp(-inf) = 0: nothing decays across a sequence boundary
+        dA = dA.masked_fill(seq_start.unsqueeze(-1), -math.inf)
+    xdt = x * dt.unsqueeze(-1)
+    pad = (-seqlen) % chunk_size
+    if pad > 0:
+        # dA = 0 and x * dt = 0 past the end, so the padding leaves the state untouched
+        xdt = F.pad(xdt, (0, 0, 0, 0, 0, pad))
+        dA = F.pad(dA, (0, 0, 0, pad))
+        B = F.pad(B, (0, 0, 0, 0, 0, pad))
+        C = F.pad(C, (0, 0, 0, 0, 0, pad))
+    nchunks = (seqlen + pad) // chunk_size
+
+    xdt = rearrange(xdt, "b (c l) (g j) p -> b c l g j p", l=chunk_size, g=ngroups)
+    B = rearrange(B, "b (c l) g n -> b c l g n", l=chunk_size)
+    C = rearrange(C, "b (c l) g n -> b c l g n", l=chunk_size)
+    dA = rearrange(dA, "b (c l) (g j) -> b g j c l", l=chunk_size, g=ngroups)
+    dA_cumsum = torch.cumsum(dA, dim=-1)
+
+    # 1. Outputs from inputs of the same chunk (diagonal blocks)
+    L = torch.exp(segsum(dA))  # (b, g, j, c, l, s)
+    CB = torch.einsum("bclgn,bcsgn->bgcls", C, B)
+    y = torch.einsum("bgjcls,bcsgjp->bclgjp", L * CB.unsqueeze(2), xdt)
+
+    # 2. State at the end of every chunk, as if each chunk started from zero
+    decay_states = rearrange(L[..., -1, :], "b g j c s -> b c s g j 1")
+    states = torch.einsum("bcsgn,bcsgjp->bcgjpn", B, xdt * decay_states)
+
+    # 3. Propagate the states over the chunk boundaries
+    chunk_decay = torch.exp(dA_cumsum[..., -1])  # (b, g, j, c)
+    if initial_states is None:
+        state = torch.zeros_like(states[:, 0])
+    else:
+        state = rearrange(initial_states.float(), "b (g j) p n -> b g j p n", g=ngroups)
+    prev_states = []
+    for c in range(nchunks):
+        prev_states.append(state)
+        state = state * chunk_decay[..., c, None, None] + states[:, c]
+    prev_states = torch.stack(prev_states, dim=1)
+
+    # 4. Outputs from the state carried into each chunk (off-diagonal blocks)
+    state_decay_out = rearrange(torch.exp(dA_cumsum), "b g j c l -> b c l g j 1")
+    y = y + torch.einsum("bclgn,bcgjpn->bclgjp", C, prev_states) * state_decay_out
+
+    y = rearrange(y, "b c l g j p -> b (c l) (g j) p")[:, :seqlen]
+    if D is not None:
+        D = D.float()
+        y = y + x * (D if D.dim() == 2 else D[:, None])
+    if z is not None:
+        y = y * F.silu(z.float())
+    y = y.to(dtype)
+    if not return_final_states:
+        return y
+    return y, rearrange(state, "b g j p n -> b (g j) p n")
+
+
+def causal_conv1d(x, weight, bias=None, seq_idx=None, activation=None):
+    """Depthwise causal conv1d, the reference counterpart of ``causal_conv1d_fn``.
+    Arguments:
+        x: (batch, seqlen, dim)
+        weight: (dim, width)
+        bias: (dim,)
+        seq_idx: (batch, seqlen) integer. Inputs from another sequence are treated as zeros.
+    Returns:
+        out: (batch, seqlen, dim)
+    """
+    seqlen, width = x.shape[1], weight.shape[-1]
+    if seq_idx is None:
+        out = F.conv1d(
+            rearrange(x, "b l d -> b d l"),
+            rearrange(weight, "d w -> d 1 w"),
+            bias,
+            padding=width - 1,
+            groups=weight.shape[0],
+        )[..., :seqlen]
+        out = rearrange(out, "b d l -> b l d")
+    else:
+        out = x * weight[:, -1]
+        for k in range(width - 1):
+            shift = width - 1 - k
+            x_shifted = F.pad(x, (0, 0, shift, 0))[:, :seqlen]
+            same_seq = F.pad(seq_idx, (shift, 0), value=-1)[:, :seqlen] == seq_idx
+            out = out + x_shifted * same_seq.unsqueeze(-1).to(x.dtype) * weight[:, k]
+        if bias is not None:
+            out = out + bias
+    if activation in ["silu", "swish"]:
+        out = F.silu(out)
+    return out
+
+
+def seq_idx_from_cu_seqlens(cu_seqlens):
+    """(num_seqs + 1,) cumulative lengths -> (1, total) int32 index of the sequence of every
+    packed token, the seq_idx expected by Mamba2 (both backends).
+    """
+    seqlens = cu_seqlens[1:] - cu_seqlens[:-1]
+    seq_idx = torch.repeat_interleave(
+        torch.arange(len(seqlens), dtype=torch.int32, device=cu_seqlens.device), seqlens
+    )
+    return seq_idx.unsqueeze(0)
+
+
+def mamba2_forward(mixer, u, seq_idx=None, state=None, return_state=False):
+    """Mamba2 forward computed from the parameters of ``mixer``, which can be the Mamba2
+    of this file or the one of ``mamba_ssm``.
+    Arguments:
+        u: (batch, seqlen, d_model)
+        seq_idx: (batch, seqlen) integer, marks packed sequences that must not see each other.
+        state: (conv_state, ssm_state) at the end of the previous part of the sequence, as
+            returned with return_state, or None at the start of the sequence.
+            conv_state: (batch, d_conv - 1, conv_dim), the last inputs of the conv.
+            ssm_state: (batch, nheads, headdim, d_state)
+    Returns:
+        out: (batch, seqlen, d_model)
+        state: the state at the end of u, if return_state
+    """
+    zxbcdt = mixer.in_proj(u)  # (B, L, d_in_proj)
+    A = -torch.exp(mixer.A_log.float())  # (nheads)
+    d_mlp = (zxbcdt.shape[-1] - 2 * mixer.d_ssm - 2 * mixer.ngroups * mixer.d_state - mixer.nheads) // 2
+    z0, x0, z, xBC, dt = torch.split(
+        zxbcdt,
+        [d_mlp, d_mlp, mixer.d_ssm, mixer.d_ssm + 2 * mixer.ngroups * mixer.d_state, mixer.nheads],
+        dim=-1,
+    )
+    dt = F.softplus(dt.float() + mixer.dt_bias.float())
+    if mixer.dt_limit != (0.0, float("inf")):
+        dt = dt.clamp(min=mixer.dt_limit[0], max=mixer.dt_limit[1])
+
+    conv_state, ssm_state = (None, None) if state is None else state
+    num_prev = 0
+    if conv_state is not None or return_state:
+        assert seq_idx is None, "seq_idx cannot be combined with a carried state"
+        width = mixer.conv1d.weight.shape[-1]
+        if conv_state is None:
+            conv_state = xBC.new_zeros(xBC.shape[0], width - 1, xBC.shape[-1])
+        # The previous inputs take the place of the zero padding of the causal conv
+        xBC = torch.cat([conv_state, xBC], dim=1)
+        num_prev = conv_state.shape[1]
+        conv_state = xBC[:, xBC.shape[1] - (width - 1) :]
+    xBC = causal_conv1d(
+        xBC,
+        rearrange(mixer.conv1d.weight, "d 1 w -> d w"),
+        mixer.conv1d.bias,
+        seq_idx=seq_idx,
+        activation=mixer.activation,
+    )[:, num_prev:]
+    x, B, C = torch.split(
+        xBC, [mixer.d_ssm, mixer.ngroups * mixer.d_state, mixer.ngroups * mixer.d_state], dim=-1
+    )
+    y = ssd_chunk_scan(
+        rearrange(x, "b l (h p) -> b l h p", p=mixer.headdim),
+        dt,
+        A,
+        rearrange(B, "b l (g n) -> b l g n", g=mixer.ngroups),
+        rearrange(C, "b l (g n) -> b l g n", g=mixer.ngroups),
+        mixer.chunk_size,
+        D=rearrange(mixer.D, "(h p) -> h p", p=mixer.headdim) if mixer.D_has_hdim else mixer.D,
+        z=rearrange(z, "b l (h p) -> b l h p", p=mixer.headdim) if not mixer.rmsnorm else None,
+        initial_states=ssm_state,
+        seq_idx=seq_idx,
+        return_final_states=return_state,
+    )
+    if return_state:
+        y, ssm_state = y
+    y = rearrange(y, "b l h p -> b l (h p)")
+    if mixer.rmsnorm:
+        y = mixer.norm(y, z)
+    if d_mlp > 0:
+        y = torch.cat([F.silu(z0) * x0, y], dim=-1)
+    out = mixer.out_proj(y)
+    if not return_state:
+        return out
+    return out, (conv_state, ssm_state)
+
+
+def block_forward_with_state(block, hidden_states, residual=None, state=None):
+    """Unfused Block forward (of either backend, with a Mamba2 mixer) on the next part of a
+    sequence, carrying the mixer state from the previous part, see mamba2_forward.
+    Running a sequence part by part gives the same result as running it at once.
+    Returns:
+        hidden_states, residual, state
+    """
+    residual = (hidden_states + residual) if residual is not None else hidden_states
+    hidden_states = block.norm(residual.to(dtype=block.norm.weight.dtype))
+    if block.residual_in_fp32:
+        residual = residual.to(torch.float32)
+    hidden_states, state = mamba2_forward(block.mixer, hidden_states, state=state, return_state=True)
+
+    if block.mlp is not None:
+        residual = hidden_states + residual
+        hidden_states = block.norm2(residual.to(dtype=block.norm2.weight.dtype))
+        if block.residual_in_fp32:
+            residual = residual.to(torch.float32)
+        hidden_states = block.mlp(hidden_states)
+
+    return hidden_states, residual, state
+
+
+class RMSNorm(nn.Module):
+    """Same parameters as ``mamba_ssm.ops.triton.layer_norm.RMSNorm``."""
+
+    def __init__(self, hidden_size, eps=1e-5, dropout_p=0.0, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.eps = eps
+        if dropout_p > 0.0:
+            self.drop = nn.Dropout(dropout_p)
+        else:
+            self.drop = None
+        self.weight = nn.Parameter(torch.empty(hidden_size, **factory_kwargs))
+        self.register_parameter("bias", None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.ones_(self.weight)
+
+    def forward(self, x):
+        dtype = x.dtype
+        if self.drop is not None:
+            x = self.drop(x)
+        x = x.float()
+        x = x * torch.rsqrt(x.pow(2).mean(dim=-1, keepdim=True) + self.eps)
+        return (x * self.weight.float()).to(dtype)
+
+
+class RMSNormGated(nn.Module):
+    """Same parameters as ``mamba_ssm.ops.triton.layernorm_gated.RMSNorm``."""
+
+    def __init__(self, hidden_size, eps=1e-5, group_size=None, norm_before_gate=True, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.empty(hidden_size, **factory_kwargs))
+        self.register_parameter("bias", None)
+        self.group_size = group_size
+        self.norm_before_gate = norm_before_gate
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.ones_(self.weight)
+
+    def forward(self, x, z=None):
+        """If z is not None, we do norm(x) * silu(z) if norm_before_gate, else norm(x * silu(z))"""
+        dtype = x.dtype
+        x = x.float()
+        if z is not None and not self.norm_before_gate:
+            x = x * F.silu(z.float())
+        group_size = x.shape[-1] if self.group_size is None else self.group_size
+        x = rearrange(x, "... (g d) -> ... g d", d=group_size)
+        x = x * torch.rsqrt(x.pow(2).mean(dim=-1, keepdim=True) + self.eps)
+        x = rearrange(x, "... g d -> ... (g d)") * self.weight.float()
+        if z is not None and self.norm_before_gate:
+            x = x * F.silu(z.float())
+        return x.to(dtype)
+
+
+class GatedMLP(nn.Module):
+    """Same parameters as ``mamba_ssm.modules.mlp.GatedMLP``."""
+
+    def __init__(
+        self,
+        in_features,
+        hidden_features=None,
+        out_features=None,
+        activation=F.silu,
+        bias=False,
+        multiple_of=128,
+        device=None,
+        dtype=None,
+    ):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        out_features = out_features if out_features is not None else in_features
+        hidden_features = (
+            hidden_features if hidden_features is not None else int(8 * in_features / 3)
+        )
+        hidden_features = (hidden_features + multiple_of - 1) // multiple_of * multiple_of
+        self.fc1 = nn.Linear(in_features, 2 * hidden_features, bias=bias, **factory_kwargs)
+        self.activation = activation
+        self.fc2 = nn.Linear(hidden_features, out_features, bias=bias, **factory_kwargs)
+
+    def forward(self, x):
+        y = self.fc1(x)
+        y, gate = y.chunk(2, dim=-1)
+        y = y * self.activation(gate)
+        y = self.fc2(y)
+        return y
+
+
+class Mamba2(nn.Module):
+    """Same constructor and parameters as ``mamba_ssm.modules.mamba2.Mamba2``."""
+
+    def __init__(
+        self,
+        d_model,
+        d_state=128,
+        d_conv=4,
+        conv_init=None,
+        expand=2,
+        headdim=64,
+        d_ssm=None,  # If not None, we only apply SSM on this many dimensions, the rest uses gated MLP
+        ngroups=1,
+        A_init_range=(1, 16),
+        D_has_hdim=False,
+        rmsnorm=True,
+        norm_before_gate=False,
+        dt_min=0.001,
+        dt_max=0.1,
+        dt_init_floor=1e-4,
+        dt_limit=(0.0, float("inf")),
+        bias=False,
+        conv_bias=True,
+        # Fused kernel and sharding options
+        chunk_size=256,
+        use_mem_eff_path=True,
+        layer_idx=None,  # Absorb kwarg for general module
+        process_group=None,
+        sequence_parallel=True,
+        device=None,
+        dtype=None,
+    ):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        if process_group is not None:
+            raise NotImplementedError("The torch backend does not support tensor parallelism")
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.conv_init = conv_init
+        self.expand = expand
+        self.process_group = process_group
+        self.sequence_parallel = sequence_parallel
+        self.world_size = 1
+        self.local_rank = 0
+        self.d_inner = self.expand * self.d_model
+        self.headdim = headdim
+        self.d_ssm = self.d_inner if d_ssm is None else d_ssm
+        self.ngroups = ngroups
+        assert self.d_ssm % self.headdim == 0
+        self.nheads = self.d_ssm // self.headdim
+        self.D_has_hdim = D_has_hdim
+        self.rmsnorm = rmsnorm
+        self.norm_before_gate = norm_before_gate
+        self.dt_limit = dt_limit
+        self.activation = "silu"
+        self.chunk_size = chunk_size
+        self.use_mem_eff_path = use_mem_eff_path
+        self.layer_idx = layer_idx
+
+        # Order: [z, x, B, C, dt]
+        d_in_proj = 2 * self.d_inner + 2 * self.ngroups * self.d_state + self.nheads
+        self.in_proj = nn.Linear(self.d_model, d_in_proj, bias=bias, **factory_kwargs)
+
+        conv_dim = self.d_ssm + 2 * self.ngroups * self.d_state
+        self.conv1d = nn.Conv1d(
+            in_channels=conv_dim,
+            out_channels=conv_dim,
+            bias=conv_bias,
+            kernel_size=d_conv,
+            groups=conv_dim,
+            padding=d_conv - 1,
+            **factory_kwargs,
+        )
+        if self.conv_init is not None:
+            nn.init.uniform_(self.conv1d.weight, -self.conv_init, self.conv_init)
+
+        self.act = nn.SiLU()
+
+        # Initialize log dt bias
+        dt = torch.exp(
+            torch.rand(self.nheads, **factory_kwargs) * (math.log(dt_max) - math.log(dt_min))
+            + math.log(dt_min)
+        )
+        dt = torch.clamp(dt, min=dt_init_floor)
+        # Inverse of softplus: https://github.com/pytorch/pytorch/issues/72759
+        inv_dt = dt + torch.log(-torch.expm1(-dt))
+        self.dt_bias = nn.Parameter(inv_dt)
+        # Just to be explicit. Without this we already don't put wd on dt_bias because of the check
+        # name.endswith("bias") in param_grouping.py
+        self.dt_bias._no_weight_decay = True
+
+        assert A_init_range[0] > 0 and A_init_range[1] >= A_init_range[0]
+        A = torch.empty(self.nheads, dtype=torch.float32, device=device).uniform_(*A_init_range)
+        A_log = torch.log(A).to(dtype=dtype)
+        self.A_log = nn.Parameter(A_log)
+        self.A_log._no_weight_decay = True
+
+        # D "skip" parameter
+        self.D = nn.Parameter(torch.ones(self.d_ssm if self.D_has_hdim else self.nheads, device=device))
+        self.D._no_weight_decay = True
+
+        if self.rmsnorm:
+            self.norm = RMSNormGated(
+                self.d_ssm,
+                eps=1e-5,
+                norm_before_gate=self.norm_before_gate,
+                group_size=self.d_ssm // ngroups,
+                **factory_kwargs,
+            )
+
+        self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias, **factory_kwargs)
+
+    def forward(self, u, seqlen=None, seq_idx=None, cu_seqlens=None, inference_params=None):
+        """
+        u: (batch, seqlen, hidden_dim) if seqlen=None.
+            If seqlen is not None, u is (batch * seqlen, hidden_dim).
+        seq_idx: (batch, seqlen) integer, marks packed sequences that must not see each other.
+        Returns: same shape as u
+        """
+        if inference_params is not None:
+            raise NotImplementedError("The torch backend does not support step-by-step decoding")
+        if seqlen is not None:
+            u = rearrange(u, "(b l) d -> b l d", l=seqlen)
+        out = mamba2_forward(self, u, seq_idx=seq_idx)
+        if seqlen is not None:
+            out = rearrange(out, "b l d -> (b l) d")
+        return out
+
+
+class Block(nn.Module):
+    """Same parameters and (unfused) forward as ``mamba_ssm.modules.block.Block``."""
+
+    def __init__(
+        self, dim, mixer_cls, mlp_cls, norm_cls=nn.LayerNorm, fused_add_norm=False, residual_in_fp32=False
+    ):
+        super().__init__()
+        if fused_add_norm:
+            raise ValueError("fused_add_norm requires the Triton kernels from mamba_ssm")
+        self.residual_in_fp32 = residual_in_fp32
+        self.fused_add_norm = fused_add_norm
+        self.norm = norm_cls(dim)
+        self.mixer = mixer_cls(dim)
+        if mlp_cls is not nn.Identity:
+            self.norm2 = norm_cls(dim)
+            self.mlp = mlp_cls(dim)
+        else:
+            self.mlp = None
+
+    def forward(self, hidden_states, residual=None, inference_params=None, **mixer_kwargs):
+        r"""Pass the input through the encoder layer.
+
+        Args:
+            hidden_states: the sequence to the encoder layer (required).
+            residual: hidden_states = Mixer(LN(residual))
+        """
+        residual = (hidden_states + residual) if residual is not None else hidden_states
+        hidden_states = self.norm(residual.to(dtype=self.norm.weight.dtype))
+        if self.residual_in_fp32:
+            residual = residual.to(torch.float32)
+        hidden_states = self.mixer(hidden_states, inference_params=inference_params, **mixer_kwargs)
+
+        if self.mlp is not None:
+            residual = hidden_states + residual
+            hidden_states = self.norm2(residual.to(dtype=self.norm2.weight.dtype))
+            if self.residual_in_fp32:
+                residual = residual.to(torch.float32)
+            hidden_states = self.mlp(hidden_states)
+
+        return hidden_states, residual
@@ -1,40 +1,341 @@
 # Copyright (c) 2023, Tri Dao.
 
 import math
+import warnings
 from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 
-from flash_attn.utils.distributed import get_dim_for_local_rank
+# flash_attn, its fused layers and ft_attention are imported on first use, see DGRNA.backends
+from . import backends
 
-try:
-    from flash_attn import (
-        flash_attn_kvpacked_func,
-        flash_attn_qkvpacked_func,
-        flash_attn_varlen_kvpacked_func,
-        flash_attn_varlen_qkvpacked_func,
+
+def __getattr__(name):
+    # The flash_attn symbols this module used to import eagerly (None when not installed)
+    if name == "RotaryEmbedding":
+        return rotary_embedding_cls()
+    if name == "ft_attention":
+        return backends.load("ft_attention")
+    for library in ("flash_attn", "flash_attn_fused_dense", "flash_attn_distributed"):
+        if any(name in names for _, names in backends.LIBRARIES[library]):
+            return backends.get(library, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def apply_rotary_emb_qkv_torch(qkv, inv_freq, position_ids, interleaved=False):
+    """Pure-PyTorch rotary embedding, same math as flash_attn's apply_rotary_emb_qkv_.
+    Arguments:
+        qkv: (..., 3, nheads, headdim). The rotation is applied to q and k only.
+        inv_freq: (rotary_dim / 2,)
+        position_ids: integer positions, broadcastable to the leading dims of qkv,
+            e.g. (seqlen,) for a (batch, seqlen, 3, nheads, headdim) input.
+    """
+    rotary_dim = inv_freq.shape[0] * 2
+    freqs = position_ids.to(torch.float32)[..., None] * inv_freq.float()
+    cos = freqs.cos().to(qkv.dtype)[..., None, None, :]
+    sin = freqs.sin().to(qkv.dtype)[..., None, None, :]
+    qk, qk_pass = qkv[..., :2, :, :rotary_dim], qkv[..., :2, :, rotary_dim:]
+    if interleaved:
+        x1, x2 = qk[..., ::2], qk[..., 1::2]
+        qk = torch.stack([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1).flatten(-2)
+    else:
+        x1, x2 = qk.chunk(2, dim=-1)
+        qk = torch.cat([x1 * cos - x2 * sin, x1 * sin + x2 * cos], dim=-1)
+    return torch.cat([torch.cat([qk, qk_pass], dim=-1), qkv[..., 2:, :, :]], dim=-3)
+
+
+class TorchRotaryEmbedding(nn.Module):
+    """Pure-PyTorch stand-in for flash_attn.layers.rotary.RotaryEmbedding, used when
+    flash_attn is not installed. Same buffers, so checkpoints are interchangeable.
+    """
+
+    def __init__(
+        self, dim, base=10000.0, interleaved=False, scale_base=None, pos_idx_in_fp32=True, device=None
+    ):
+        super().__init__()
+        if scale_base is not None:
+            raise NotImplementedError("XPos scaling is not supported without flash_attn")
+        self.dim = dim
+        self.base = float(base)
+        self.interleaved = interleaved
+        self.scale_base = scale_base
+        self.pos_idx_in_fp32 = pos_idx_in_fp32
+        self.register_buffer("inv_freq", self._compute_inv_freq(device), persistent=False)
+
+    def _compute_inv_freq(self, device=None):
+        return 1.0 / (
+            self.base
+            ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.float32) / self.dim)
+        )
+
+    def forward(self, qkv, kv=None, seqlen_offset=0, max_seqlen=None):
+        """
+        qkv: (batch, seqlen, 3, nheads, headdim)
+        seqlen_offset: int, position of the first token.
+        """
+        assert kv is None, "TorchRotaryEmbedding only supports packed qkv"
+        position_ids = torch.arange(qkv.shape[1], device=qkv.device) + seqlen_offset
+        return apply_rotary_emb_qkv_torch(qkv, self.inv_freq, position_ids, self.interleaved)
+
+
+def rotary_embedding_cls():
+    """flash_attn's RotaryEmbedding if it is installed, else TorchRotaryEmbedding."""
+    return backends.get("flash_attn_rotary", "RotaryEmbedding") or TorchRotaryEmbedding
+
+
+def packed_indices(cu_seqlens):
+    """For packed sequences with cumulative lengths cu_seqlens (batch_size + 1,), the
+    sequence index and the position within its sequence of every token, both (total,).
+    """
+    seqlens = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+    batch_idx = torch.repeat_interleave(
+        torch.arange(len(seqlens), device=cu_seqlens.device), seqlens
+    )
+    position_ids = torch.arange(len(batch_idx), device=cu_seqlens.device) - cu_seqlens.long()[batch_idx]
+    return batch_idx, position_ids
+
+
+def pad_packed(x, cu_seqlens, max_seqlen):
+    """(total, ...) packed rows -> (batch_size, max_seqlen, ...) zero-padded batch and the
+    (batch_size, max_seqlen) key_padding_mask, True for real tokens. padded[mask] == x.
+    """
+    batch_idx, position_ids = packed_indices(cu_seqlens)
+    batch_size = len(cu_seqlens) - 1
+    padded = x.new_zeros(batch_size, max_seqlen, *x.shape[1:])
+    padded[batch_idx, position_ids] = x
+    mask = torch.zeros(batch_size, max_seqlen, dtype=torch.bool, device=x.device)
+    mask[batch_idx, position_ids] = True
+    return padded, mask
+
+
+def chunked_attention(
+    q, k, v, key_padding_mask=None, causal=False, softmax_scale=None, dropout_p=0.0, chunk_size=1024
+):
+    """Softmax attention computed over (chunk_size, chunk_size) blocks with an online
+    softmax, so the memory for the scores is O(chunk_size^2) per head instead of
+    O(seqlen^2). Same result as SelfAttention / CrossAttention up to rounding.
+    Arguments:
+        q: (batch, seqlen_q, nheads, headdim)
+        k, v: (batch, seqlen_k, nheads, headdim)
+        key_padding_mask: (batch, seqlen_k) boolean, True means to keep.
+        causal: query i attends to keys up to i + seqlen_k - seqlen_q.
+    Returns:
+        out: (batch, seqlen_q, nheads, headdim)
+    """
+    softmax_scale = softmax_scale or 1.0 / math.sqrt(q.shape[-1])
+    seqlen_q, seqlen_k = q.shape[1], k.shape[1]
+    if key_padding_mask is not None:
+        # Additive mask as in SelfAttention, keeps fully masked blocks finite
+        padding_bias = torch.full(key_padding_mask.shape, -10000.0, device=q.device)
+        padding_bias.masked_fill_(key_padding_mask, 0.0)
+    out = torch.empty_like(q)
+    for i in range(0, seqlen_q, chunk_size):
+        q_i = q[:, i : i + chunk_size].float() * softmax_scale
+        row_max = q_i.new_full((q_i.shape[0], q_i.shape[2], q_i.shape[1]), -math.inf)
+        row_sum = torch.zeros_like(row_max)
+        acc = torch.zeros_like(q_i)
+        for j in range(0, seqlen_k, chunk_size):
+            if causal and j > i + q_i.shape[1] - 1 + seqlen_k - seqlen_q:
+                break  # this and the following key blocks are entirely in the future
+            k_j, v_j = k[:, j : j + chunk_size].float(), v[:, j : j + chunk_size].float()
+            scores = torch.einsum("bthd,bshd->bhts", q_i, k_j)
+            if key_padding_mask is not None:
+                scores = scores + rearrange(padding_bias[:, j : j + chunk_size], "b s -> b 1 1 s")
+            if causal:
+                row_idx = torch.arange(i, i + q_i.shape[1], device=q.device)
+                col_idx = torch.arange(j, j + k_j.shape[1], device=q.device)
+                future = col_idx[None, :] > row_idx[:, None] + seqlen_k - seqlen_q
+                scores = scores.masked_fill(future, -10000.0)
+            new_max = torch.maximum(row_max, scores.amax(dim=-1))
+            probs = torch.exp(scores - new_max.unsqueeze(-1))
+            correction = torch.exp(row_max - new_max)
+            row_sum = row_sum * correction + probs.sum(dim=-1)
+            if dropout_p > 0.0:
+                # dropout(probs / row_sum) == dropout(probs) / row_sum
+                probs = F.dropout(probs, dropout_p)
+            acc = acc * rearrange(correction, "b h t -> b t h 1") + torch.einsum(
+                "bhts,bshd->bthd", probs, v_j
+            )
+            row_max = new_max
+        out[:, i : i + chunk_size] = acc / rearrange(row_sum, "b h t -> b t h 1")
+    return out
+
+
+def sdpa_attention(
+    q, k, v, key_padding_mask=None, causal=False, softmax_scale=None, dropout_p=0.0, chunk_size=None
+):
+    """F.scaled_dot_product_attention, non-causal only. Same arguments and shapes as
+    chunked_attention; chunk_size is unused.
+    """
+    assert not causal, "sdpa_attention does not support causal attention"
+    if softmax_scale is not None:
+        # Folded into q so that torch < 2.1 (no scale argument) gives the same result
+        q = q * (softmax_scale * math.sqrt(q.shape[-1]))
+    attn_mask = None if key_padding_mask is None else rearrange(key_padding_mask, "b s -> b 1 1 s")
+    out = F.scaled_dot_product_attention(
+        q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask=attn_mask, dropout_p=dropout_p
+    )
+    return out.transpose(1, 2)
+
+
+def flash_attention(
+    q,
+    k,
+    v,
+    key_padding_mask=None,
+    causal=False,
+    softmax_scale=None,
+    dropout_p=0.0,
+    chunk_size=None,
+    cu_seqlens=None,
+    max_seqlen=None,
+):
+    """FlashAttention on CUDA fp16/bf16 inputs. Same arguments and shapes as
+    chunked_attention; chunk_size is unused. With a key_padding_mask, the kept keys of
+    every row are packed and attended with the varlen kernel. Packed (total, nheads,
+    headdim) inputs with cu_seqlens and max_seqlen go to the varlen kernel as they are.
+    """
+    if cu_seqlens is not None:
+        return backends.get("flash_attn", "flash_attn_varlen_kvpacked_func")(
+            q,
+            torch.stack([k, v], dim=1),
+            cu_seqlens,
+            cu_seqlens,
+            max_seqlen,
+            max_seqlen,
+            dropout_p,
+            softmax_scale=softmax_scale,
+            causal=causal,
+        )
+    kv = torch.stack([k, v], dim=2)
+    if key_padding_mask is None:
+        return backends.get("flash_attn", "flash_attn_kvpacked_func")(
+            q, kv, dropout_p, softmax_scale=softmax_scale, causal=causal
+        )
+    batch_size, seqlen_q = q.shape[0], q.shape[1]
+    seqlens_k = key_padding_mask.sum(-1, dtype=torch.int32)
+    cu_seqlens_k = F.pad(torch.cumsum(seqlens_k, 0, dtype=torch.int32), (1, 0))
+    cu_seqlens_q = torch.arange(
+        0, (batch_size + 1) * seqlen_q, seqlen_q, dtype=torch.int32, device=q.device
+    )
+    out = backends.get("flash_attn", "flash_attn_varlen_kvpacked_func")(
+        rearrange(q, "b s h d -> (b s) h d"),
+        kv[key_padding_mask],
+        cu_seqlens_q,
+        cu_seqlens_k,
+        seqlen_q,
+        int(seqlens_k.max()),
+        dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+    )
+    return rearrange(out, "(b s) h d -> b s h d", b=batch_size)
+
+
+# Attention implementations with the chunked_attention interface, fastest first (the
+# order of DGRNA.backends.IMPLEMENTATIONS["attention"]), see select_attention_backend
+ATTENTION_BACKENDS = {
+    "flash": flash_attention,
+    "sdpa": sdpa_attention,
+    "chunked": chunked_attention,
+}
+
+
+def attention_backend_usable(
+    name, q, k, key_padding_mask=None, causal=False, chunk_size=1024, max_seqlen=None
+):
+    """Whether attention backend name can take these inputs without materializing more
+    than a (chunk_size, chunk_size) score block per head. max_seqlen is given for packed
+    inputs, see attention.
+    """
+    if not backends.usable("attention", name, q.device):
+        return False
+    packed = max_seqlen is not None
+    if name == "flash":
+        # fp16/bf16 only (autocast included, q is the output of the autocast projection).
+        # With a mask the varlen kernel aligns the causal diagonal per row, unlike the others
+        return (
+            q.dtype in (torch.float16, torch.bfloat16)
+            and q.shape[-1] <= 256
+            and not (causal and key_padding_mask is not None)
+        )
+    if name == "sdpa":
+        if not hasattr(F, "scaled_dot_product_attention") or causal:
+            return False
+        # On CPU a masked input (packed inputs are padded and masked) can fall back to the
+        # math kernel and its full score matrix, which only pays off while it fits in one
+        # chunked_attention block
+        seqlen_k = max_seqlen if packed else k.shape[1]
+        return (key_padding_mask is None and not packed) or q.is_cuda or seqlen_k <= chunk_size
+    return True
+
+
+def select_attention_backend(
+    q, k, key_padding_mask=None, causal=False, chunk_size=1024, attn_backends=None, max_seqlen=None
+):
+    """The first of attn_backends (default: all of ATTENTION_BACKENDS) usable for these
+    inputs, picked from their device, dtype, key length and mask.
+    """
+    candidates = ATTENTION_BACKENDS if attn_backends is None else attn_backends
+    for name in candidates:
+        if name not in ATTENTION_BACKENDS:
+            raise ValueError(
+                f"Unknown attention backend: {name}, only support {', '.join(ATTENTION_BACKENDS)}"
+            )
+        if attention_backend_usable(name, q, k, key_padding_mask, causal, chunk_size, max_seqlen):
+            return name
+    raise RuntimeError(
+        f"No usable attention backend among {', '.join(candidates)} for "
+        f"{q.device.type} {q.dtype} inputs (causal={causal}, "
+        f"key_padding_mask={key_padding_mask is not None})"
     )
-except ImportError:
-    flash_attn_varlen_qkvpacked_func, flash_attn_varlen_kvpacked_func = None, None
-    flash_attn_qkvpacked_func, flash_attn_kvpacked_func = None, None
 
-try:
-    from flash_attn.ops.fused_dense import ColumnParallelLinear, FusedDense, RowParallelLinear
-except ImportError:
-    FusedDense, ColumnParallelLinear, RowParallelLinear = None, None, None
 
-from flash_attn.layers.rotary import RotaryEmbedding
-try:
-     from flash_attn.layers.rotary import RotaryEmbedding
-except ImportError:
-     RotaryEmbedding = None
+def attention(
+    q,
+    k,
+    v,
+    key_padding_mask=None,
+    causal=False,
+    softmax_scale=None,
+    dropout_p=0.0,
+    chunk_size=1024,
+    attn_backends=None,
+    cu_seqlens=None,
+    max_seqlen=None,
+):
+    """Softmax attention with the backend select_attention_backend picks for this call.
+    Same arguments and shapes as chunked_attention.
+    cu_seqlens, max_seqlen: packed self-attention, q, k and v are (total, nheads, headdim)
+        and every sequence only attends within itself. FlashAttention takes them as they
+        are; the other backends run on the padded batch and the kept rows are gathered back.
+    """
+    if cu_seqlens is not None:
+        assert key_padding_mask is None and max_seqlen is not None
+    name = select_attention_backend(
+        q, k, key_padding_mask, causal, chunk_size, attn_backends, max_seqlen if cu_seqlens is not None else None
+    )
+    if cu_seqlens is None:
+        return ATTENTION_BACKENDS[name](
+            q, k, v, key_padding_mask, causal, softmax_scale, dropout_p, chunk_size
+        )
+    if name == "flash":
+        return flash_attention(
+            q, k, v, None, causal, softmax_scale, dropout_p, cu_seqlens=cu_seqlens, max_seqlen=max_seqlen
+        )
+    q, key_padding_mask = pad_packed(q, cu_seqlens, max_seqlen)
+    k, v = pad_packed(k, cu_seqlens, max_seqlen)[0], pad_packed(v, cu_seqlens, max_seqlen)[0]
+    out = ATTENTION_BACKENDS[name](
+        q, k, v, key_padding_mask, causal, softmax_scale, dropout_p, chunk_size
+    )
+    return out[key_padding_mask]
+
 
-try:
-    import ft_attention
-except ImportError:
-    ft_attention = None
+# Kept for compatibility, the backend is picked per call
+memory_efficient_attention = attention
 
 
 class FlashSelfAttention(nn.Module):
@@ -50,8 +351,7 @@ class FlashSelfAttention(nn.Module):
 
     def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0):
         super().__init__()
-        assert flash_attn_varlen_qkvpacked_func is not None, "FlashAttention is not installed"
-        assert flash_attn_qkvpacked_func is not None, "FlashAttention is not installed"
+        assert backends.available("flash_attn"), "FlashAttention is not installed"
         self.causal = causal
         self.softmax_scale = softmax_scale
         self.drop = nn.Dropout(attention_dropout)
@@ -81,7 +381,7 @@ class FlashSelfAttention(nn.Module):
             assert cu_seqlens.dtype == torch.int32
             assert max_seqlen is not None
             assert isinstance(max_seqlen, int)
-            return flash_attn_varlen_qkvpacked_func(
+            return backends.get("flash_attn", "flash_attn_varlen_qkvpacked_func")(
                 qkv,
                 cu_seqlens,
                 max_seqlen,
@@ -90,7 +390,7 @@ class FlashSelfAttention(nn.Module):
                 causal=causal,
             )
         else:
-            return flash_attn_qkvpacked_func(
+            return backends.get("flash_attn", "flash_attn_qkvpacked_func")(
                 qkv,
                 self.drop.p if self.training else 0.0,
                 softmax_scale=self.softmax_scale,
@@ -111,8 +411,7 @@ class FlashCrossAttention(nn.Module):
 
     def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0):
         super().__init__()
-        assert flash_attn_varlen_kvpacked_func is not None, "FlashAttention is not installed"
-        assert flash_attn_kvpacked_func is not None, "FlashAttention is not installed"
+        assert backends.available("flash_attn"), "FlashAttention is not installed"
         self.causal = causal
         self.softmax_scale = softmax_scale
         self.drop = nn.Dropout(attention_dropout)
@@ -152,7 +451,7 @@ class FlashCrossAttention(nn.Module):
             assert cu_seqlens_k.dtype == torch.int32
             assert max_seqlen_k is not None
             assert isinstance(max_seqlen, int)
-            return flash_attn_varlen_kvpacked_func(
+            return backends.get("flash_attn", "flash_attn_varlen_kvpacked_func")(
                 q,
                 kv,
                 cu_seqlens,
@@ -167,7 +466,7 @@ class FlashCrossAttention(nn.Module):
             batch_size, seqlen_q = q.shape[0], q.shape[1]
             seqlen_k = kv.shape[1]
             assert kv.shape[0] == batch_size and kv.shape[4] == q.shape[3]
-            return flash_attn_kvpacked_func(
+            return backends.get("flash_attn", "flash_attn_kvpacked_func")(
                 q,
                 kv,
                 self.drop.p if self.training else 0.0,
@@ -290,6 +589,73 @@ class CrossAttention(nn.Module):
         return output
 
 
+class MemEffSelfAttention(SelfAttention):
+    """SelfAttention computed with attention: same interface and result, without the
+    (B, H, S, S) score tensor. The backend is picked per call among attn_backends.
+    """
+
+    def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0, chunk_size=1024):
+        super().__init__(causal=causal, softmax_scale=softmax_scale, attention_dropout=attention_dropout)
+        self.chunk_size = chunk_size
+
+    def forward(
+        self, qkv, causal=None, key_padding_mask=None, cu_seqlens=None, max_seqlen=None, attn_backends=None
+    ):
+        """
+        qkv: (B, S, 3, H, D), or (total, 3, H, D) with cu_seqlens and max_seqlen (see attention).
+        key_padding_mask: (B, S), True means to keep.
+        attn_backends: the candidate backends, see select_attention_backend.
+        """
+        q, k, v = qkv.unbind(dim=-3)
+        return attention(
+            q,
+            k,
+            v,
+            key_padding_mask,
+            causal=self.causal if causal is None else causal,
+            softmax_scale=self.softmax_scale,
+            dropout_p=self.drop.p if self.training else 0.0,
+            chunk_size=self.chunk_size,
+            attn_backends=attn_backends,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
+        )
+
+
+class MemEffCrossAttention(CrossAttention):
+    """CrossAttention computed with attention, see MemEffSelfAttention."""
+
+    def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0, chunk_size=1024):
+        super().__init__(causal=causal, softmax_scale=softmax_scale, attention_dropout=attention_dropout)
+        self.chunk_size = chunk_size
+
+    def forward(self, q, kv, causal=None, key_padding_mask=None, attn_backends=None):
+        """
+        q: (B, Sq, H, D)
+        kv: (B, Sk, 2, H_k, D)
+        key_padding_mask: (B, Sk), True means to keep.
+        attn_backends: the candidate backends, see select_attention_backend.
+        """
+        causal = self.causal if causal is None else causal
+        if causal and key_padding_mask is not None:
+            # The causal offset depends on the number of kept keys of every row
+            return super().forward(q, kv, causal=causal, key_padding_mask=key_padding_mask)
+        if kv.shape[3] != q.shape[2]:  # MQA/GQA
+            kv = repeat(kv, "... hkv d -> ... (hkv g) d", g=q.shape[2] // kv.shape[3])
+        k, v = kv.unbind(dim=2)
+        return attention(
+            q,
+            k,
+            v,
+            key_padding_mask,
+            causal=causal,
+            softmax_scale=self.softmax_scale,
+            dropout_p=self.drop.p if self.training else 0.0,
+            chunk_size=self.chunk_size,
+            attn_backends=attn_backends,
+        )
+
+
 class LinearResidual(nn.Linear):
     """Wrap nn.Linear to return the residual as well. For compatibility with FusedDense."""
 
@@ -371,7 +737,7 @@ def _apply_rotary_single_query_attention(
     kv: (batch_size, 1, 2, nheads_kv, head_dim)
     """
     assert inference_params.fused_ft_kernel
-    assert ft_attention is not None
+    ft_attention = backends.require("ft_attention")
     if kv is None:
         q, k, v = rearrange(qkv, "b 1 three h d -> b three h d").unbind(dim=1)
     else:
@@ -425,6 +791,7 @@ class MultiheadAttention(nn.Module):
         rotary_emb_interleaved=False,
         fused_bias_fc=False,
         use_flash_attn=False,
+        attn_backend=None,
         return_residual=False,
         checkpointing=False,
         device=None,
@@ -435,6 +802,12 @@ class MultiheadAttention(nn.Module):
         return_residual: whether to return the input x along with the output. This is for
             performance reason: for post-norm architecture, returning the input allows us
             to fuse the backward of nn.Linear with the residual connection.
+        use_flash_attn: make "flash" one of the candidate backends, used for the inputs it
+            can take (CUDA fp16/bf16) when flash_attn is installed.
+        attn_backend: None picks the attention backend per call among the candidates, from
+            the device, dtype, sequence length and mask of the input, see attention. A name
+            of ATTENTION_BACKENDS always uses that backend ("flash" implies use_flash_attn).
+            Can be changed after construction.
         """
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
@@ -444,7 +817,19 @@ class MultiheadAttention(nn.Module):
         self.layer_idx = layer_idx
         self.dwconv = dwconv
         self.rotary_emb_dim = rotary_emb_dim
+        if attn_backend is not None and attn_backend not in ATTENTION_BACKENDS:
+            raise ValueError(
+                f"Unknown attention backend: {attn_backend}, only support {', '.join(ATTENTION_BACKENDS)}"
+            )
+        if attn_backend == "flash":
+            use_flash_attn = True
+        if use_flash_attn and not backends.available("flash_attn"):
+            if attn_backend == "flash":
+                raise ImportError("attn_backend='flash' requires flash_attn")
+            warnings.warn("flash_attn is not installed, using memory-efficient attention instead")
+            use_flash_attn = False
         self.use_flash_attn = use_flash_attn
+        self.attn_backend = attn_backend
         self.return_residual = return_residual
         self.checkpointing = checkpointing
 
@@ -460,8 +845,7 @@ class MultiheadAttention(nn.Module):
 
         if self.rotary_emb_dim > 0:
             assert not cross_attn, "MHA with rotary embedding does not support cross-attention yet"
-            assert RotaryEmbedding is not None, "rotary_emb is not installed"
-            self.rotary_emb = RotaryEmbedding(
+            self.rotary_emb = rotary_embedding_cls()(
                 self.rotary_emb_dim,
                 base=rotary_emb_base,
                 scale_base=rotary_emb_scale_base,
@@ -469,6 +853,7 @@ class MultiheadAttention(nn.Module):
                 device=device,
             )
 
+        FusedDense = backends.get("flash_attn_fused_dense", "FusedDense")
         if fused_bias_fc and FusedDense is None:
             raise ImportError("fused_dense is not installed")
         linear_cls = nn.Linear if not fused_bias_fc else FusedDense
@@ -476,8 +861,6 @@ class MultiheadAttention(nn.Module):
             LinearResidual if not fused_bias_fc else partial(FusedDense, return_residual=True)
         )
         wqkv_cls = linear_cls if not self.return_residual else linear_resid_cls
-        inner_attn_cls = FlashSelfAttention if use_flash_attn else SelfAttention
-        inner_cross_attn_cls = FlashCrossAttention if use_flash_attn else CrossAttention
         if not self.cross_attn:
             self.Wqkv = wqkv_cls(embed_dim, qkv_dim, bias=qkv_proj_bias, **factory_kwargs)
         else:
@@ -493,10 +876,11 @@ class MultiheadAttention(nn.Module):
                     embed_dim, embed_dim, kernel_size=3, padding=2, groups=embed_dim
                 )
                 self.dwconv_kv = nn.Conv1d(kv_dim, kv_dim, kernel_size=3, padding=2, groups=kv_dim)
-        self.inner_attn = inner_attn_cls(
+        # Both pick their backend per call, see _attn_backends
+        self.inner_attn = MemEffSelfAttention(
             causal=causal, softmax_scale=softmax_scale, attention_dropout=dropout
         )
-        self.inner_cross_attn = inner_cross_attn_cls(
+        self.inner_cross_attn = MemEffCrossAttention(
             causal=causal, softmax_scale=softmax_scale, attention_dropout=dropout
         )
         self.out_proj = linear_cls(embed_dim, embed_dim, bias=out_proj_bias, **factory_kwargs)
@@ -557,6 +941,54 @@ class MultiheadAttention(nn.Module):
             else False,
         )
 
+    def _apply_rotary_emb(self, qkv, seqlen_offset=0, cu_seqlens=None):
+        """qkv: (batch_size, seqlen, 3, nheads, head_dim), or (total, 3, nheads, head_dim) when
+        cu_seqlens is given, in which case positions restart at 0 for every packed sequence.
+        The Triton rotary kernel only runs on GPU, and only on padded batches.
+        """
+        if cu_seqlens is not None:
+            _, position_ids = packed_indices(cu_seqlens)
+        elif qkv.is_cuda:
+            return self.rotary_emb(qkv, seqlen_offset=seqlen_offset)
+        else:
+            position_ids = torch.arange(qkv.shape[1], device=qkv.device) + seqlen_offset
+        return apply_rotary_emb_qkv_torch(
+            qkv, self.rotary_emb.inv_freq, position_ids, self.rotary_emb.interleaved
+        )
+
+    def _attn_backends(self):
+        """Candidate attention backends of a call, fastest first, see attention."""
+        if self.attn_backend is not None:
+            return (self.attn_backend,)
+        return tuple(name for name in ATTENTION_BACKENDS if name != "flash" or self.use_flash_attn)
+
+    def chunked_forward(self, x, key_padding_mask=None, chunk_size=1024):
+        """Self-attention over a long (batch, seqlen, hidden_dim) input, with the backends
+        that never materialize more than a (chunk_size, chunk_size) score block per head.
+        Same result as forward.
+        """
+        assert not self.cross_attn and self.num_heads_kv == self.num_heads
+        assert not self.dwconv and not self.inner_attn.causal
+        if not self.return_residual:
+            qkv = self.Wqkv(x)
+        else:
+            qkv, x = self.Wqkv(x)
+        qkv = rearrange(qkv, "... (three h d) -> ... three h d", three=3, d=self.head_dim)
+        if self.rotary_emb_dim > 0:
+            qkv = self._apply_rotary_emb(qkv)
+        q, k, v = qkv.unbind(dim=2)
+        context = attention(
+            q,
+            k,
+            v,
+            key_padding_mask,
+            softmax_scale=self.inner_attn.softmax_scale,
+            chunk_size=chunk_size,
+            attn_backends=self._attn_backends(),
+        )
+        out = self.out_proj(rearrange(context, "... h d -> ... (h d)"))
+        return out if not self.return_residual else (out, x)
+
     def forward(
         self,
         x,
@@ -575,11 +1007,11 @@ class MultiheadAttention(nn.Module):
                 is the is the sum of the sequence lengths in the batch.
             x_kv: (batch, seqlen, hidden_dim), only applicable for cross-attention. If None, use x.
             cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
-                of the sequences in the batch, used to index into x. Only applicable when using
-                FlashAttention.
+                of the sequences in the batch, used to index into x. Self-attention only;
+                backends other than FlashAttention attend the padded rows, see attention.
             max_seqlen: int. Maximum sequence length in the batch.
             key_padding_mask: boolean mask, True means to keep, False means to mask out.
-                (batch, seqlen). Only applicable when not using FlashAttention.
+                (batch, seqlen). The outputs at masked positions are unspecified.
             mixer_subset: for cross-attention only. If not None, will take a subset of x
                 before applying the query projection. Useful for e.g., ViT where we only care
                 about the CLS token in the last layer.
@@ -589,23 +1021,22 @@ class MultiheadAttention(nn.Module):
         if cu_seqlens is not None:
             assert max_seqlen is not None
             assert key_padding_mask is None
-            assert self.use_flash_attn
             assert not self.dwconv
-            assert self.rotary_emb_dim == 0
+            assert (
+                not self.cross_attn and self.num_heads_kv == self.num_heads
+            ), "packed inputs (cu_seqlens) only support self-attention"
         if key_padding_mask is not None:
             assert cu_seqlens is None
             assert max_seqlen is None
-            assert not self.use_flash_attn
         if inference_params is not None:
             assert key_padding_mask is None
             assert cu_seqlens is None and max_seqlen is None
             assert not self.dwconv
 
-        kwargs = (
-            {"cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen, **kwargs}
-            if self.use_flash_attn
-            else {"key_padding_mask": key_padding_mask, **kwargs}
-        )
+        attn_backends = self._attn_backends()
+        kwargs = {"key_padding_mask": key_padding_mask, "attn_backends": attn_backends, **kwargs}
+        if cu_seqlens is not None:
+            kwargs.update(cu_seqlens=cu_seqlens, max_seqlen=max_seqlen)
         seqlen_offset = 0 if inference_params is None else inference_params.sequence_len_offset
         if not self.cross_attn and self.num_heads_kv == self.num_heads:
             assert x_kv is None and mixer_subset is None
@@ -624,7 +1055,9 @@ class MultiheadAttention(nn.Module):
                 or not inference_params.fused_ft_kernel
             ):
                 if self.rotary_emb_dim > 0:
-                    qkv = self.rotary_emb(qkv, seqlen_offset=seqlen_offset)
+                    qkv = self._apply_rotary_emb(
+                        qkv, seqlen_offset=seqlen_offset, cu_seqlens=cu_seqlens
+                    )
                 if inference_params is None:
                     if not self.checkpointing:
                         context = self.inner_attn(qkv, **kwargs)
@@ -633,7 +1066,7 @@ class MultiheadAttention(nn.Module):
                 else:
                     q = qkv[:, :, 0]
                     kv = self._update_kv_cache(qkv[:, :, 1:], inference_params)
-                    context = self.inner_cross_attn(q, kv)
+                    context = self.inner_cross_attn(q, kv, attn_backends=attn_backends)
             else:
                 context = self._apply_rotary_single_query_attention(qkv, inference_params)
         else:
@@ -680,7 +1113,7 @@ class MultiheadAttention(nn.Module):
                         )
                 else:
                     kv = self._update_kv_cache(kv, inference_params)
-                    context = self.inner_cross_attn(q, kv)
+                    context = self.inner_cross_attn(q, kv, attn_backends=attn_backends)
             else:
                 context = self._apply_rotary_single_query_attention(q, inference_params, kv=kv)
         out = self.out_proj(rearrange(context, "... h d -> ... (h d)"))
@@ -732,6 +1165,7 @@ class ParallelMHA(nn.Module):
             self.num_heads % self.num_heads_kv == 0
         ), "num_heads must be divisible by num_heads_kv"
 
+        get_dim_for_local_rank = backends.require("flash_attn_distributed").get_dim_for_local_rank
         self.num_heads_per_rank = get_dim_for_local_rank(
             self.num_heads, self.world_size, self.local_rank
         )
@@ -742,8 +1176,7 @@ class ParallelMHA(nn.Module):
         qkv_dim = self.head_dim * (self.num_heads + 2 * self.num_heads_kv)
 
         if self.rotary_emb_dim > 0:
-            assert RotaryEmbedding is not None, "rotary_emb is not installed"
-            self.rotary_emb = RotaryEmbedding(
+            self.rotary_emb = rotary_embedding_cls()(
                 self.rotary_emb_dim,
                 base=rotary_emb_base,
                 scale_base=rotary_emb_scale_base,
@@ -751,8 +1184,10 @@ class ParallelMHA(nn.Module):
                 device=device,
             )
 
-        if ColumnParallelLinear is None or RowParallelLinear is None:
+        if not backends.available("flash_attn_fused_dense"):
             raise ImportError("fused_dense is not installed")
+        ColumnParallelLinear = backends.get("flash_attn_fused_dense", "ColumnParallelLinear")
+        RowParallelLinear = backends.get("flash_attn_fused_dense", "RowParallelLinear")
         self.Wqkv = ColumnParallelLinear(
             embed_dim,
             qkv_dim,
@@ -0,0 +1,79 @@
+"""One embedding per sequence, pooled on the device the hidden states are on.
+
+The pooled embeddings only cover the residues of each sequence: padding, BOS (``<cls>``)
+and EOS tokens are left out, following the ``prepend_bos`` / ``append_eos`` settings of
+the Alphabet. ``pool`` reduces a (B, L, D) batch to (B, D) with "mean", "max" or "bos"
+(the BOS token). ``AttentionPooling`` weighs the residues with a learned query; it
+starts as mean pooling and is meant to be trained on a downstream task.
+``MambaLMHeadModel.forward(tokens, pooling=...)`` takes any of them.
+"""
+import math
+
+import torch
+import torch.nn as nn
+
+POOLINGS = ("mean", "max", "bos")
+
+
+def token_mask(tokens, alphabet):
+    """(B, L) boolean mask of the residue tokens of a batch from alphabet's batch converter."""
+    mask = tokens.ne(alphabet.padding_idx)
+    if alphabet.prepend_bos:
+        mask &= tokens.ne(alphabet.cls_idx)
+    if alphabet.append_eos:
+        mask &= tokens.ne(alphabet.eos_idx)
+    return mask
+
+
+def mean_pool(hidden_states, mask):
+    mask = mask.unsqueeze(-1).to(hidden_states.dtype)
+    # Sequences without residues get zeros
+    return (hidden_states * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+
+def max_pool(hidden_states, mask):
+    pooled = hidden_states.masked_fill(~mask.unsqueeze(-1), -math.inf).amax(1)
+    return pooled.masked_fill(~mask.any(1, keepdim=True), 0.0)
+
+
+def pool(hidden_states, mask, pooling="mean"):
+    """(B, D) embeddings of the (B, L, D) hidden_states over the residues in mask, see
+    token_mask. pooling is one of POOLINGS or a module called as pooling(hidden_states, mask),
+    e.g. AttentionPooling. "bos" assumes the alphabet prepends a BOS token.
+    """
+    if isinstance(pooling, nn.Module):
+        return pooling(hidden_states, mask)
+    if pooling == "mean":
+        return mean_pool(hidden_states, mask)
+    if pooling == "max":
+        return max_pool(hidden_states, mask)
+    if pooling == "bos":
+        return hidden_states[:, 0]
+    raise ValueError(f"Unknown pooling: {pooling}, only support {', '.join(POOLINGS)} or a module")
+
+
+class AttentionPooling(nn.Module):
+    """Weighted average of the residues, with weights from the softmax of a learned query
+    against projected keys, one query per head over D / num_heads channels.
+    """
+
+    def __init__(self, embed_dim, num_heads=1, device=None, dtype=None):
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        assert embed_dim % num_heads == 0, "embed_dim must be divisible by num_heads"
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.key = nn.Linear(embed_dim, embed_dim, **factory_kwargs)
+        # Zero query: uniform weights, i.e. mean pooling until trained
+        self.query = nn.Parameter(torch.zeros(num_heads, self.head_dim, **factory_kwargs))
+
+    def forward(self, hidden_states, mask):
+        """hidden_states: (B, L, D), mask: (B, L) True at residues. Returns (B, D)."""
+        batch, seqlen, _ = hidden_states.shape
+        keys = self.key(hidden_states.to(self.key.weight.dtype)).reshape(batch, seqlen, self.num_heads, self.head_dim)
+        scores = torch.einsum("blhd,hd->bhl", keys, self.query) / math.sqrt(self.head_dim)
+        scores = scores.float().masked_fill(~mask.unsqueeze(1), -math.inf)
+        # Sequences without residues get zeros instead of NaNs
+        weights = torch.nan_to_num(scores.softmax(-1)).to(hidden_states.dtype)
+        values = hidden_states.reshape(batch, seqlen, self.num_heads, self.head_dim)
+        return torch.einsum("bhl,blhd->bhd", weights, values).reshape(batch, -1)
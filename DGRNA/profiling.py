@@ -0,0 +1,156 @@
+"""Opt-in per-stage instrumentation of the bidirectional backbone.
+
+While a Profiler is attached (``with profile(model) as prof:``), BiDirectionMixerModel
+and MambaLMHeadModel record every stage of their forward: the forward and backward
+Mamba2 blocks of each layer, the flips of the backward branch, the hidden_fc merge
+(concat + Linear), the final attention, norm_f and the LM head. Each record has its wall
+time, a FLOP estimate and, on CUDA, the peak memory allocated during the stage.
+``summary()`` aggregates them per stage and ``export_chrome_trace()`` writes a trace for
+chrome://tracing or https://ui.perfetto.dev.
+
+When no profiler is attached the model only checks an attribute per stage: nothing is
+synchronized, timed or allocated. The long-input mode (seq_chunk_len) is recorded as a
+single backbone stage.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+import torch
+import torch.nn as nn
+
+
+def estimate_flops(module, x):
+    """Approximate forward FLOPs (multiply-adds count 2) of module on x, (B, L, D) or
+    packed (total, D): the matmuls of its Linear layers, plus the conv and SSD scan of
+    Mamba2 mixers and the score / value products of attention layers.
+    """
+    if module is None or x is None:
+        return 0
+    num_tokens = x.numel() // x.shape[-1]
+    flops = 0
+    for m in module.modules():
+        if isinstance(m, nn.Linear):
+            flops += 2 * num_tokens * m.weight.numel()
+        elif hasattr(m, "d_ssm") and hasattr(m, "d_state"):
+            # Mamba2: depthwise conv + state update and readout of the scan
+            flops += 2 * num_tokens * m.conv1d.weight.numel() + 6 * num_tokens * m.d_ssm * m.d_state
+        elif hasattr(m, "Wqkv") and hasattr(m, "head_dim"):
+            seqlen = x.shape[1] if x.dim() == 3 else x.shape[0]
+            flops += 4 * num_tokens * seqlen * m.num_heads * m.head_dim
+    return flops
+
+
+class Profiler(object):
+    """Records the stages of the models it is attached to, see profile."""
+
+    def __init__(self, synchronize=True):
+        """
+        synchronize: wait for the device before and after each stage, so CUDA stages are
+            timed by their execution rather than their launch. Concurrent directions are
+            serialized by it.
+        """
+        self.synchronize = synchronize
+        self.events = []
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def _sync(self, device):
+        if self.synchronize and device is not None and device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    @contextlib.contextmanager
+    def stage(self, name, layer=None, module=None, x=None):
+        """Record the enclosed code as stage name; module and x (its input) give the FLOP estimate."""
+        device = x.device if x is not None else None
+        cuda = device is not None and device.type == "cuda"
+        stack = self._local.__dict__.setdefault("stack", [])
+        if cuda:
+            self._sync(device)
+            if stack:
+                # Keep the peak of the enclosing stage before resetting the counter
+                stack[-1]["peak"] = max(stack[-1]["peak"], torch.cuda.max_memory_allocated(device))
+            torch.cuda.reset_peak_memory_stats(device)
+        frame = {"peak": 0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if cuda:
+                self._sync(device)
+            end = time.perf_counter()
+            stack.pop()
+            event = {
+                "name": name,
+                "layer": layer,
+                "start": start - self._origin,
+                "seconds": end - start,
+                "flops": estimate_flops(module, x),
+                "thread": threading.get_ident(),
+                "peak_memory_bytes": None,
+            }
+            if cuda:
+                event["peak_memory_bytes"] = max(frame["peak"], torch.cuda.max_memory_allocated(device))
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], event["peak_memory_bytes"])
+            self.events.append(event)
+
+    def summary(self):
+        """Per stage name, in order of first appearance: calls, total and mean time, FLOPs,
+        achieved GFLOP/s and the peak memory over all calls.
+        """
+        stages = {}
+        for event in self.events:
+            entry = stages.setdefault(
+                event["name"],
+                {"stage": event["name"], "calls": 0, "seconds": 0.0, "flops": 0, "peak_memory_bytes": None},
+            )
+            entry["calls"] += 1
+            entry["seconds"] += event["seconds"]
+            entry["flops"] += event["flops"]
+            if event["peak_memory_bytes"] is not None:
+                entry["peak_memory_bytes"] = max(entry["peak_memory_bytes"] or 0, event["peak_memory_bytes"])
+        for entry in stages.values():
+            entry["mean_ms"] = 1000 * entry["seconds"] / entry["calls"]
+            entry["gflops_per_s"] = entry["flops"] / entry["seconds"] / 1e9 if entry["seconds"] > 0 else None
+        return list(stages.values())
+
+    def export_chrome_trace(self, path):
+        """Write the events in the Chrome trace event format (complete "X" events)."""
+        threads = {}
+        trace = []
+        for event in self.events:
+            args = {k: event[k] for k in ("layer", "flops", "peak_memory_bytes") if event[k] is not None}
+            trace.append({
+                "name": event["name"] if event["layer"] is None else f"{event['name']}.{event['layer']}",
+                "cat": event["name"],
+                "ph": "X",
+                "ts": 1e6 * event["start"],
+                "dur": 1e6 * event["seconds"],
+                "pid": os.getpid(),
+                "tid": threads.setdefault(event["thread"], len(threads)),
+                "args": args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def clear(self):
+        self.events = []
+
+
+@contextlib.contextmanager
+def profile(model, profiler=None, synchronize=True):
+    """Attach a Profiler to model (a MambaLMHeadModel or a BiDirectionMixerModel) for the
+    duration of the block and yield it.
+    """
+    profiler = profiler if profiler is not None else Profiler(synchronize=synchronize)
+    backbone = getattr(model, "backbone", model)
+    previous = backbone.profiler
+    backbone.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        backbone.profiler = previous
@@ -0,0 +1,108 @@
+"""Dynamic int8 quantization of the Linear layers for CPU inference.
+
+Most of the FLOPs of the bidirectional backbone are Linear layers: the Mamba2
+``in_proj``/``out_proj`` of both directions, ``hidden_fc`` and the ``Wqkv``/``out_proj``
+of the final attention. ``quantize_dynamic_int8`` stores their weights in int8 and
+quantizes the activations on the fly (``torch.ao.quantization.quantize_dynamic``).
+``compare_layers`` measures the error this introduces, layer by layer.
+"""
+import copy
+import io
+
+import torch
+import torch.nn as nn
+
+
+def quantize_dynamic_int8(model, inplace=False):
+    """int8 dynamic quantization of every nn.Linear of a MambaLMHeadModel.
+    Only the "torch" backend can run it: the mamba_ssm kernels read the fp32 weights
+    directly. The model must be an fp32 model on the CPU.
+    """
+    if model.backbone.backend != "torch":
+        raise ValueError("int8 quantization requires the torch backend (backend='torch')")
+    if not inplace:
+        model = copy.deepcopy(model)
+    model = model.to(device="cpu", dtype=torch.float32).eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def model_size_bytes(model):
+    """Size of the serialized state dict, which counts packed int8 weights correctly."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def _report_modules(model):
+    backbone = model.backbone
+    modules = {}
+    for i in range(len(backbone.forward_layers)):
+        modules[f"forward_layers.{i}"] = backbone.forward_layers[i]
+        modules[f"backward_layers.{i}"] = backbone.backward_layers[i]
+        modules[f"hidden_fc.{i}"] = backbone.hidden_fc[i]
+    modules["attn_layers.0"] = backbone.attn_layers[0]
+    modules["norm_f"] = backbone.norm_f
+    return modules
+
+
+def _capture(modules, outputs):
+    handles = []
+    for name, module in modules.items():
+
+        def hook(module, inputs, output, name=name):
+            # Blocks return (hidden_states, residual)
+            outputs[name] = (output[0] if isinstance(output, tuple) else output).detach().float()
+
+        handles.append(module.register_forward_hook(hook))
+    return handles
+
+
+@torch.no_grad()
+def compare_layers(reference, candidate, batches, padding_idx):
+    """Per-layer accuracy of candidate (e.g. the quantized model) against reference.
+    batches: iterable of (B, L) token tensors.
+    Returns one dict per layer output, in forward order, with over the non-padding tokens:
+        rel_error: ||candidate - reference|| / ||reference||
+        cosine: mean token cosine similarity
+    and for the final output "norm_f", also mean_embedding_cosine: mean cosine similarity
+    of the per-sequence mean embeddings.
+    """
+    outputs_ref, outputs_cand = {}, {}
+    handles = _capture(_report_modules(reference), outputs_ref)
+    handles += _capture(_report_modules(candidate), outputs_cand)
+    stats = {}
+    try:
+        for tokens in batches:
+            reference(tokens)
+            candidate(tokens)
+            mask = tokens.ne(padding_idx)
+            for name, ref in outputs_ref.items():
+                ref, cand = ref[mask], outputs_cand[name][mask]
+                entry = stats.setdefault(
+                    name, {"sq_error": 0.0, "sq_norm": 0.0, "cosine": 0.0, "tokens": 0, "seq_cosine": 0.0, "seqs": 0}
+                )
+                entry["sq_error"] += (cand - ref).pow(2).sum().item()
+                entry["sq_norm"] += ref.pow(2).sum().item()
+                entry["cosine"] += torch.cosine_similarity(cand, ref, dim=-1).sum().item()
+                entry["tokens"] += ref.shape[0]
+                if name == "norm_f":
+                    lengths = mask.sum(-1, keepdim=True)
+                    mean_ref = (outputs_ref[name] * mask.unsqueeze(-1)).sum(1) / lengths
+                    mean_cand = (outputs_cand[name] * mask.unsqueeze(-1)).sum(1) / lengths
+                    entry["seq_cosine"] += torch.cosine_similarity(mean_cand, mean_ref, dim=-1).sum().item()
+                    entry["seqs"] += tokens.shape[0]
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    report = []
+    for name, entry in stats.items():
+        row = {
+            "layer": name,
+            "rel_error": (entry["sq_error"] / max(entry["sq_norm"], 1e-30)) ** 0.5,
+            "cosine": entry["cosine"] / max(entry["tokens"], 1),
+        }
+        if entry["seqs"]:
+            row["mean_embedding_cosine"] = entry["seq_cosine"] / entry["seqs"]
+        report.append(row)
+    return report
@@ -0,0 +1,257 @@
+"""Local embedding server with dynamic batching.
+
+A small HTTP/1.1 server on asyncio (standard library only, no network access needed)
+listening on a TCP port or a Unix socket. Sequences of concurrent requests are queued
+and coalesced into token-budget batches: a batch is started when the queued sequences
+reach toks_per_batch tokens or when the oldest one has waited max_wait_ms. The batch is
+split by length exactly like FastaBatchedDataset.get_batch_indices and run by a
+CachedEmbedder in a worker thread, so the event loop keeps accepting requests, and the
+results are routed back to their request.
+
+    POST /embed  {"sequences": [["label", "ACGU..."], ...]}  (or a list of plain strings)
+              -> {"results": [{"label": "label", "mean": [...]}, ...]}
+    GET /stats   batching and cache statistics
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import CachedEmbedder, EmbeddingCache
+
+MAX_BODY_BYTES = 1 << 26
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _parse_sequences(payload):
+    sequences = payload.get("sequences") if isinstance(payload, dict) else None
+    if not isinstance(sequences, list):
+        raise HTTPError(400, 'expected {"sequences": [[label, sequence], ...]}')
+    raw_batch = []
+    for i, item in enumerate(sequences):
+        if isinstance(item, str):
+            item = (str(i), item)
+        if not (isinstance(item, (list, tuple)) and len(item) == 2 and all(isinstance(x, str) for x in item)):
+            raise HTTPError(400, f"sequences[{i}] must be a string or a [label, sequence] pair")
+        raw_batch.append(tuple(item))
+    return raw_batch
+
+
+class EmbeddingServer(object):
+    """Serves a CachedEmbedder (or any callable with its interface) over HTTP."""
+
+    def __init__(self, embedder, toks_per_batch=4096, max_wait_ms=5.0):
+        """
+        embedder: e.g. CachedEmbedder(model, alphabet, EmbeddingCache(max_bytes=0)) to
+            disable caching. Called from a single worker thread.
+        toks_per_batch: token budget of a batch (also the budget of the embedder).
+        max_wait_ms: how long the first queued sequence waits for more to batch with.
+        """
+        self.embedder = embedder
+        self.toks_per_batch = toks_per_batch
+        self.max_wait = max_wait_ms / 1000
+        self.extra_toks_per_seq = int(embedder.alphabet.prepend_bos) + int(embedder.alphabet.append_eos)
+        self._queue = None
+        self._batch_task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dgrna-embed")
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_sequences = 0
+        self.num_tokens = 0
+        self.queue_wait = 0.0
+
+    async def embed(self, raw_batch):
+        """Queue the (label, sequence) items and wait for their embeddings."""
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item in raw_batch:
+            future = loop.create_future()
+            self._queue.put_nowait((item, future, loop.time()))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        pending = [await self._queue.get()]
+        num_tokens = len(pending[0][0][1]) + self.extra_toks_per_seq
+        deadline = pending[0][2] + self.max_wait
+        while num_tokens < self.toks_per_batch:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                entry = self._queue.get_nowait()
+            pending.append(entry)
+            num_tokens += len(entry[0][1]) + self.extra_toks_per_seq
+        return pending, num_tokens
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending, num_tokens = await self._next_batch()
+            now = loop.time()
+            self.num_batches += 1
+            self.num_sequences += len(pending)
+            self.num_tokens += num_tokens
+            self.queue_wait += sum(now - queued for _, _, queued in pending)
+            try:
+                outputs = await loop.run_in_executor(self._executor, self.embedder, [item for item, _, _ in pending])
+            except Exception as e:
+                for _, future, _ in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), output in zip(pending, outputs):
+                if not future.done():  # the client may have gone away
+                    future.set_result(output)
+
+    def stats(self):
+        stats = {
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "sequences": self.num_sequences,
+            "tokens": self.num_tokens,
+            "mean_batch_size": self.num_sequences / max(self.num_batches, 1),
+            "mean_queue_wait_ms": 1000 * self.queue_wait / max(self.num_sequences, 1),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+        if hasattr(self.embedder, "stats"):
+            stats["cache"] = self.embedder.stats()
+        return stats
+
+    async def _handle(self, method, path, body):
+        if path == "/stats":
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            return self.stats()
+        if path != "/embed":
+            raise HTTPError(404, f"unknown path {path}")
+        if method != "POST":
+            raise HTTPError(405, "use POST")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise HTTPError(400, "invalid JSON")
+        raw_batch = _parse_sequences(payload)
+        self.num_requests += 1
+        outputs = await self.embed(raw_batch)
+        return {
+            "results": [
+                {"label": label, **{k: v.tolist() for k, v in output.items()}}
+                for (label, _), output in zip(raw_batch, outputs)
+            ]
+        }
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    method, path, _ = request_line.decode("latin-1").split()
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    method, path, length = None, None, -1
+                try:
+                    if not 0 <= length <= MAX_BODY_BYTES:
+                        # The body cannot be skipped reliably, so the connection is closed
+                        keep_alive = False
+                        if length < 0:
+                            raise HTTPError(400, "malformed request")
+                        raise HTTPError(413, f"body larger than {MAX_BODY_BYTES} bytes")
+                    body = await reader.readexactly(length)
+                    status, payload = 200, await self._handle(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except asyncio.IncompleteReadError:
+                    raise
+                except Exception as e:
+                    status, payload = 500, {"error": repr(e)}
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8000, unix_socket=None):
+        """Start listening and batching; returns the asyncio server."""
+        self._queue = asyncio.Queue()
+        self._batch_task = asyncio.ensure_future(self._batch_loop())
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self._serve_connection, path=unix_socket)
+        return await asyncio.start_server(self._serve_connection, host, port)
+
+    async def serve_forever(self, host="127.0.0.1", port=8000, unix_socket=None):
+        server = await self.start(host, port, unix_socket)
+        async with server:
+            await server.serve_forever()
+
+
+def create_server(model, alphabet, include=("mean",), toks_per_batch=4096, max_wait_ms=5.0, cache=None, **forward_kwargs):
+    """EmbeddingServer around a CachedEmbedder of model. cache: an EmbeddingCache, by
+    default none (EmbeddingCache(max_bytes=0) keeps nothing).
+    """
+    embedder = CachedEmbedder(
+        model,
+        alphabet,
+        cache=cache if cache is not None else EmbeddingCache(max_bytes=0),
+        include=include,
+        toks_per_batch=toks_per_batch,
+        fingerprint=None if cache is not None else "uncached",
+        **forward_kwargs,
+    )
+    return EmbeddingServer(embedder, toks_per_batch=toks_per_batch, max_wait_ms=max_wait_ms)
+
+
+async def post_json(reader, writer, path, payload):
+    """Minimal keep-alive HTTP client for the server (used by the benchmarks)."""
+    data = json.dumps(payload).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
@@ -0,0 +1,90 @@
+"""Time of each attention backend across sequence lengths, and where the fastest changes.
+
+Runs the attention backends of DGRNA.multihead_attention_mha (flash, sdpa, chunked) on
+random (batch, seqlen, heads, head_dim) inputs, with and without a key padding mask
+(the last quarter of every row masked out). Backends that cannot take an input (no
+flash_attn, CPU, fp32, ...) are skipped. Besides one row per backend and length, every
+device / dtype / mask setting gets a "crossover" row with the fastest backend per length,
+the lengths where it changes and the lengths where select_attention_backend picks a
+slower one.
+
+    python -m benchmarks.bench_attention --device cuda --dtypes float16 float32 --lengths 128 512 2048 8192
+"""
+import argparse
+
+import torch
+
+from DGRNA.multihead_attention_mha import ATTENTION_BACKENDS, attention, attention_backend_usable, select_attention_backend
+
+from .common import add_common_args, benchmark, dump, setup
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[128, 256, 512, 1024, 2048, 4096])
+    parser.add_argument("--num-heads", type=int, default=32)
+    parser.add_argument("--head-dim", type=int, default=16, help="the DGRNA attention layer uses d_model / 32")
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=list(DTYPES))
+    parser.add_argument("--chunk-size", type=int, default=1024, help="block size of the chunked backend")
+    args = parser.parse_args()
+    setup(args)
+
+    results = []
+    with torch.no_grad():
+        for dtype_name in args.dtypes:
+            for masked in (False, True):
+                timings, selected = {}, {}
+                for seqlen in args.lengths:
+                    shape = (3, args.batch_size, seqlen, args.num_heads, args.head_dim)
+                    q, k, v = torch.randn(shape, device=args.device, dtype=DTYPES[dtype_name]).unbind(0)
+                    mask = None
+                    if masked:
+                        mask = torch.ones(args.batch_size, seqlen, dtype=torch.bool, device=args.device)
+                        mask[:, seqlen - seqlen // 4 :] = False
+                    for name in ATTENTION_BACKENDS:
+                        # Run every backend that works, also past the lengths select_attention_backend allows
+                        if not attention_backend_usable(name, q, k, mask, chunk_size=seqlen):
+                            continue
+                        seconds = benchmark(
+                            lambda: attention(q, k, v, mask, chunk_size=args.chunk_size, attn_backends=(name,)),
+                            args.warmup,
+                            args.repeat,
+                            args.device,
+                        )
+                        timings.setdefault(seqlen, {})[name] = seconds
+                        results.append({
+                            "benchmark": "attention",
+                            "backend": name,
+                            "device": torch.device(args.device).type,
+                            "dtype": dtype_name,
+                            "masked": masked,
+                            "batch_size": args.batch_size,
+                            "seqlen": seqlen,
+                            "seconds": seconds,
+                            "tokens_per_s": args.batch_size * seqlen / seconds,
+                        })
+                    selected[seqlen] = select_attention_backend(q, k, mask, chunk_size=args.chunk_size)
+                fastest = {seqlen: min(row, key=row.get) for seqlen, row in timings.items()}
+                results.append({
+                    "benchmark": "crossover",
+                    "device": torch.device(args.device).type,
+                    "dtype": dtype_name,
+                    "masked": masked,
+                    "fastest": fastest,
+                    "crossovers": [
+                        {"seqlen": seqlen, "from": fastest[prev], "to": fastest[seqlen]}
+                        for prev, seqlen in zip(args.lengths, args.lengths[1:])
+                        if fastest[seqlen] != fastest[prev]
+                    ],
+                    "selected_slower": {
+                        seqlen: name for seqlen, name in selected.items() if name != fastest[seqlen]
+                    },
+                })
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
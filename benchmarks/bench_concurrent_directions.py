@@ -0,0 +1,56 @@
+"""Per-layer latency of the bidirectional backbone, sequential vs concurrent directions.
+
+One layer step is the forward and backward Mamba2 blocks of a layer, which are
+independent until hidden_fc merges them. With concurrent directions they run on two
+CUDA streams, or on CPU in two threads sharing the intra-op threads.
+
+    python -m benchmarks.bench_concurrent_directions --batch-sizes 1 16 --seqlen 512
+"""
+import argparse
+
+import torch
+
+from .common import add_common_args, benchmark, dump, model_config, random_model, setup
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--seqlen", type=int, default=512)
+    parser.add_argument("--backend", default=None, choices=["cuda", "torch"])
+    args = parser.parse_args()
+    setup(args)
+
+    model, _ = random_model(model_config(args.d_model, args.n_layer), backend=args.backend, device=args.device)
+    backbone = model.backbone
+    f_layer, b_layer = backbone.forward_layers[0], backbone.backward_layers[0]
+    results = []
+    for batch_size in args.batch_sizes:
+        hidden_states = torch.randn(batch_size, args.seqlen, args.d_model, device=args.device)
+        residual = torch.randn_like(hidden_states)
+
+        def layer_step():
+            return backbone._run_directions(
+                lambda: f_layer(hidden_states, residual),
+                lambda: b_layer(hidden_states.flip([1]), residual.flip([1])),
+            )
+
+        for concurrent in (False, True):
+            backbone.concurrent_directions = concurrent
+            with torch.no_grad():
+                seconds = benchmark(layer_step, args.warmup, args.repeat, args.device)
+            results.append({
+                "benchmark": "layer_step",
+                "mode": "concurrent" if concurrent else "sequential",
+                "backend": backbone.backend,
+                "batch_size": batch_size,
+                "seqlen": args.seqlen,
+                "threads": torch.get_num_threads(),
+                "seconds": seconds,
+            })
+        results[-1]["speedup"] = results[-2]["seconds"] / results[-1]["seconds"]
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""CPU benchmark suite for the data path and the backbone, in one JSON report.
+
+Runs on a randomly initialized model of configurable size with the "torch" backend, so
+no checkpoint, GPU or network is needed:
+    fasta: read_fasta and FastaBatchedDataset.from_file on a generated FASTA file
+    tokenize: BatchConverter on token-budget batches
+    layer: one bidirectional layer split into its stages (forward block, backward
+        block, hidden_fc) and the final attention and norm, per batch size x length
+    end_to_end: MambaLMHeadModel forward tokens/s, per batch size x length
+
+    python -m benchmarks.bench_cpu_suite --batch-sizes 1 8 --lengths 128 512 2048 --output cpu.json
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+
+from DGRNA.data import BatchConverter, FastaBatchedDataset, read_fasta
+
+from .common import add_common_args, benchmark, dump, model_config, random_model, random_sequences, random_tokens, setup
+
+
+def bench_fasta(args, results):
+    data = random_sequences(args.num_seqs, args.min_len, args.max_len)
+    num_residues = sum(len(seq) for _, seq in data)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.fasta")
+        with open(path, "w") as f:
+            for label, seq in data:
+                f.write(f">{label}\n")
+                for i in range(0, len(seq), 80):
+                    f.write(seq[i : i + 80] + "\n")
+        size = os.path.getsize(path)
+        for name, fn in [
+            ("read_fasta", lambda: sum(1 for _ in read_fasta(path))),
+            ("FastaBatchedDataset.from_file", lambda: FastaBatchedDataset.from_file(path)),
+        ]:
+            seconds = benchmark(fn, args.warmup, args.repeat)
+            results.append({
+                "benchmark": "fasta",
+                "function": name,
+                "num_seqs": len(data),
+                "residues": num_residues,
+                "seconds": seconds,
+                "seqs_per_s": len(data) / seconds,
+                "mb_per_s": size / seconds / 1e6,
+            })
+    return data
+
+
+def bench_tokenize(args, results, alphabet, data):
+    dataset = FastaBatchedDataset([label for label, _ in data], [seq for _, seq in data])
+    batches = [[dataset[i] for i in batch] for batch in dataset.get_batch_indices(args.toks_per_batch, 2)]
+    converter = BatchConverter(alphabet)
+    seconds = benchmark(lambda: [converter(batch) for batch in batches], args.warmup, args.repeat)
+    num_residues = sum(len(seq) for _, seq in data)
+    results.append({
+        "benchmark": "tokenize",
+        "function": "BatchConverter",
+        "num_seqs": len(data),
+        "batches": len(batches),
+        "residues": num_residues,
+        "seconds": seconds,
+        "tokens_per_s": num_residues / seconds,
+    })
+
+
+def bench_layers(args, results, model, alphabet, batch_size, seqlen):
+    backbone = model.backbone
+    f_layer, b_layer, h_fc = backbone.forward_layers[0], backbone.backward_layers[0], backbone.hidden_fc[0]
+    tokens = random_tokens(alphabet, batch_size, seqlen)
+    hidden_states = backbone.embedding(tokens)
+    residual = torch.randn_like(hidden_states)
+    flipped, flipped_residual = hidden_states.flip([1]), residual.flip([1])
+    merged = torch.cat([hidden_states, hidden_states], dim=-1)
+    stages = [
+        ("embedding", lambda: backbone.embedding(tokens)),
+        ("forward_block", lambda: f_layer(hidden_states, residual)),
+        ("backward_block", lambda: b_layer(flipped, flipped_residual)),
+        ("flip", lambda: (hidden_states.flip([1]), residual.flip([1]))),
+        ("hidden_fc", lambda: h_fc(merged)),
+        ("attention", lambda: backbone.attn_layers[0](hidden_states)),
+        ("norm_f", lambda: backbone._final_norm(hidden_states, residual)),
+    ]
+    for stage, fn in stages:
+        seconds = benchmark(fn, args.warmup, args.repeat)
+        results.append({
+            "benchmark": "layer",
+            "stage": stage,
+            "batch_size": batch_size,
+            "seqlen": seqlen,
+            "seconds": seconds,
+            "tokens_per_s": batch_size * seqlen / seconds,
+        })
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[128, 512, 2048])
+    parser.add_argument("--num-seqs", type=int, default=2000, help="sequences of the FASTA / tokenization runs")
+    parser.add_argument("--min-len", type=int, default=50)
+    parser.add_argument("--max-len", type=int, default=1000)
+    parser.add_argument("--toks-per-batch", type=int, default=4096)
+    parser.add_argument(
+        "--only", nargs="+", choices=["fasta", "tokenize", "layer", "end_to_end"], default=None, help="run only these"
+    )
+    args = parser.parse_args()
+    setup(args)
+    only = set(args.only) if args.only is not None else {"fasta", "tokenize", "layer", "end_to_end"}
+
+    model, alphabet = random_model(model_config(args.d_model, args.n_layer), backend="torch")
+    results = [{
+        "benchmark": "config",
+        "d_model": args.d_model,
+        "n_layer": args.n_layer,
+        "parameters": sum(p.numel() for p in model.parameters()),
+        "threads": torch.get_num_threads(),
+        "torch": torch.__version__,
+    }]
+    if "fasta" in only or "tokenize" in only:
+        data = bench_fasta(args, results) if "fasta" in only else random_sequences(args.num_seqs, args.min_len, args.max_len)
+        if "tokenize" in only:
+            bench_tokenize(args, results, alphabet, data)
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            for seqlen in args.lengths:
+                if "layer" in only:
+                    bench_layers(args, results, model, alphabet, batch_size, seqlen)
+                if "end_to_end" in only:
+                    tokens = random_tokens(alphabet, batch_size, seqlen)
+                    seconds = benchmark(lambda: model(tokens), args.warmup, args.repeat)
+                    results.append({
+                        "benchmark": "end_to_end",
+                        "batch_size": batch_size,
+                        "seqlen": seqlen,
+                        "seconds": seconds,
+                        "tokens_per_s": batch_size * seqlen / seconds,
+                    })
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Tokens/s of the bidirectional backbone per Mamba2 backend across sequence lengths.
+
+The "torch" backend (chunked SSD scan) is always measured; "cuda" is added when
+mamba_ssm is installed and --device is a GPU. The scan section compares the chunked
+scan with a step-by-step recurrence to show what the chunking buys on CPU.
+
+    python -m benchmarks.bench_mamba2_backends --lengths 256 1024 4096 --batch-size 4
+"""
+import argparse
+
+import torch
+
+from DGRNA import mamba2_pretrained
+from DGRNA.mamba2_torch import ssd_chunk_scan
+
+from .common import add_common_args, benchmark, dump, model_config, random_model, random_tokens, setup
+
+
+def sequential_scan(x, dt, A, B, C, D):
+    """h_t = exp(dt_t * A) h_{t-1} + dt_t * x_t B_t^T, y_t = h_t C_t + D x_t"""
+    batch, seqlen, nheads, headdim = x.shape
+    B = B.repeat_interleave(nheads // B.shape[2], dim=2)
+    C = C.repeat_interleave(nheads // C.shape[2], dim=2)
+    state = x.new_zeros(batch, nheads, headdim, B.shape[-1])
+    ys = []
+    for t in range(seqlen):
+        decay = torch.exp(dt[:, t] * A)[..., None, None]
+        state = state * decay + torch.einsum("bhp,bhn->bhpn", x[:, t] * dt[:, t, :, None], B[:, t])
+        ys.append(torch.einsum("bhpn,bhn->bhp", state, C[:, t]))
+    return torch.stack(ys, dim=1) + x * D[:, None]
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[256, 1024, 4096])
+    parser.add_argument("--chunk-size", type=int, default=256, help="SSD chunk size")
+    parser.add_argument("--skip-sequential", action="store_true", help="skip the step-by-step scan")
+    args = parser.parse_args()
+    setup(args)
+
+    backends = ["torch"]
+    if torch.device(args.device).type == "cuda" and mamba2_pretrained.backends.available("mamba_ssm"):
+        backends.append("cuda")
+    config = model_config(args.d_model, args.n_layer, ssm_cfg={"chunk_size": args.chunk_size})
+    results = []
+    for backend in backends:
+        model, alphabet = random_model(config, backend=backend, device=args.device)
+        for seqlen in args.lengths:
+            tokens = random_tokens(alphabet, args.batch_size, seqlen, device=args.device)
+            with torch.no_grad():
+                seconds = benchmark(
+                    lambda: model.backbone(tokens), args.warmup, args.repeat, args.device
+                )
+            results.append({
+                "benchmark": "backbone",
+                "backend": backend,
+                "batch_size": args.batch_size,
+                "seqlen": seqlen,
+                "seconds": seconds,
+                "tokens_per_s": args.batch_size * seqlen / seconds,
+            })
+
+    mixer = model.backbone.forward_layers[0].mixer
+    nheads, headdim, d_state = mixer.nheads, mixer.headdim, mixer.d_state
+    A = -torch.exp(mixer.A_log.float()).detach()
+    for seqlen in args.lengths:
+        x = torch.randn(args.batch_size, seqlen, nheads, headdim, device=args.device)
+        dt = torch.rand(args.batch_size, seqlen, nheads, device=args.device) * 0.1
+        B = torch.randn(args.batch_size, seqlen, 1, d_state, device=args.device)
+        C = torch.randn(args.batch_size, seqlen, 1, d_state, device=args.device)
+        D = torch.ones(nheads, device=args.device)
+        scans = {"chunked": lambda: ssd_chunk_scan(x, dt, A, B, C, args.chunk_size, D=D)}
+        if not args.skip_sequential:
+            scans["sequential"] = lambda: sequential_scan(x, dt, A, B, C, D)
+        for name, fn in scans.items():
+            seconds = benchmark(fn, args.warmup, args.repeat, args.device)
+            results.append({
+                "benchmark": "scan",
+                "scan": name,
+                "batch_size": args.batch_size,
+                "seqlen": seqlen,
+                "seconds": seconds,
+                "tokens_per_s": args.batch_size * seqlen / seconds,
+            })
+        if not args.skip_sequential:
+            err = (scans["chunked"]() - scans["sequential"]()).abs().max().item()
+            results[-1]["max_abs_diff_vs_chunked"] = err
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Accuracy, throughput and memory of half precision inference vs fp32.
+
+The half precision models come from cast_for_inference: weights in float16 / bfloat16,
+fp32 residual stream and final norm. Per-layer accuracy compares them with the fp32
+model on the sequences of a validation FASTA (random sequences if --fasta is omitted).
+Use --model-location for the pretrained weights; a random model is used otherwise.
+
+    python -m benchmarks.bench_precision --device cuda --fasta valid.fasta --model-location dgrna_L24.pt
+"""
+import argparse
+import copy
+
+import torch
+
+from DGRNA import mamba2_pretrained
+from DGRNA.data import BatchConverter, FastaBatchedDataset
+from DGRNA.quantization import compare_layers
+
+from .common import add_common_args, benchmark, dump, model_config, random_model, random_sequences, setup
+
+
+def parameter_bytes(model):
+    return sum(param.numel() * param.element_size() for param in model.parameters())
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--fasta", default=None, help="validation FASTA file")
+    parser.add_argument("--model-location", default=None, help="checkpoint or inference artifact (.pt)")
+    parser.add_argument("--backend", default=None, choices=["cuda", "torch"])
+    parser.add_argument("--dtypes", nargs="+", default=["bfloat16", "float16"], choices=["bfloat16", "float16"])
+    parser.add_argument("--num-seqs", type=int, default=64, help="number of sequences used")
+    parser.add_argument("--min-len", type=int, default=50)
+    parser.add_argument("--max-len", type=int, default=500)
+    parser.add_argument("--toks-per-batch", type=int, default=4096)
+    args = parser.parse_args()
+    setup(args)
+
+    if args.model_location is not None:
+        model, alphabet, _ = mamba2_pretrained.load_model_and_alphabet(args.model_location, backend=args.backend)
+        model = model.to(device=args.device, dtype=torch.float32).eval()
+    else:
+        model, alphabet = random_model(
+            model_config(args.d_model, args.n_layer), backend=args.backend, device=args.device
+        )
+    if args.fasta is not None:
+        dataset = FastaBatchedDataset.from_file(args.fasta)
+        data = [dataset[i] for i in range(min(len(dataset), args.num_seqs))]
+    else:
+        data = random_sequences(args.num_seqs, args.min_len, args.max_len)
+    dataset = FastaBatchedDataset([label for label, _ in data], [seq for _, seq in data])
+    converter = BatchConverter(alphabet)
+    batches = [
+        converter([dataset[i] for i in batch])[2].to(args.device)
+        for batch in dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=2)
+    ]
+    num_tokens = sum(int(tokens.ne(alphabet.padding_idx).sum()) for tokens in batches)
+
+    def run(m):
+        for tokens in batches:
+            m(tokens)
+
+    cuda = torch.device(args.device).type == "cuda"
+    results = []
+    for name in ["float32"] + args.dtypes:
+        if name == "float32":
+            candidate = model
+        else:
+            candidate = mamba2_pretrained.cast_for_inference(copy.deepcopy(model), name)
+            results += [
+                {"benchmark": "precision_accuracy", "dtype": name, **row}
+                for row in compare_layers(model, candidate, batches, alphabet.padding_idx)
+            ]
+        if cuda:
+            # The fp32 reference stays resident: report the peak above the current usage
+            torch.cuda.reset_peak_memory_stats(args.device)
+            allocated = torch.cuda.memory_allocated(args.device)
+        with torch.no_grad():
+            seconds = benchmark(lambda: run(candidate), args.warmup, args.repeat, args.device)
+        results.append({
+            "benchmark": "precision_speed",
+            "dtype": name,
+            "backend": candidate.backbone.backend,
+            "device": args.device,
+            "num_seqs": len(data),
+            "tokens": num_tokens,
+            "seconds": seconds,
+            "tokens_per_s": num_tokens / seconds,
+            "parameter_bytes": parameter_bytes(candidate),
+            "peak_activation_bytes": torch.cuda.max_memory_allocated(args.device) - allocated if cuda else None,
+        })
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Per-stage breakdown of a forward pass: time, FLOP estimate, GFLOP/s and peak memory.
+
+Profiles --repeat forward passes (after --warmup) with DGRNA.profiling and prints the
+per-stage summary as JSON. --trace also writes a Chrome trace of every stage.
+
+    python -m benchmarks.bench_profile --batch-size 8 --seqlen 1024 --trace trace.json
+"""
+import argparse
+
+import torch
+
+from DGRNA.profiling import profile
+
+from .common import add_common_args, dump, model_config, random_model, random_tokens, setup
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--seqlen", type=int, default=1024)
+    parser.add_argument("--backend", default=None, choices=["cuda", "torch"])
+    parser.add_argument("--trace", default=None, help="write a Chrome trace (chrome://tracing, Perfetto) here")
+    args = parser.parse_args()
+    setup(args)
+
+    model, alphabet = random_model(model_config(args.d_model, args.n_layer), backend=args.backend, device=args.device)
+    tokens = random_tokens(alphabet, args.batch_size, args.seqlen, device=args.device)
+    with torch.no_grad():
+        for _ in range(args.warmup):
+            model(tokens)
+        with profile(model) as profiler:
+            for _ in range(args.repeat):
+                model(tokens)
+    if args.trace is not None:
+        profiler.export_chrome_trace(args.trace)
+    results = [
+        {
+            "benchmark": "profile",
+            "backend": model.backbone.backend,
+            "batch_size": args.batch_size,
+            "seqlen": args.seqlen,
+            **row,
+        }
+        for row in profiler.summary()
+    ]
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
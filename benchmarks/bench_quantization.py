@@ -0,0 +1,76 @@
+"""Accuracy, throughput and size of the int8 dynamic-quantized model vs fp32 on CPU.
+
+Per-layer accuracy compares every layer output of the int8 model with the fp32 one on
+the sequences of a validation FASTA (random sequences if --fasta is omitted). Use
+--model-location for the pretrained weights; a random model is used otherwise.
+
+    python -m benchmarks.bench_quantization --fasta valid.fasta --model-location dgrna_L24.pt
+"""
+import argparse
+
+import torch
+
+from DGRNA import mamba2_pretrained
+from DGRNA.data import BatchConverter, FastaBatchedDataset
+from DGRNA.quantization import compare_layers, model_size_bytes, quantize_dynamic_int8
+
+from .common import add_common_args, benchmark, dump, model_config, random_model, random_sequences, setup
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--fasta", default=None, help="validation FASTA file")
+    parser.add_argument("--model-location", default=None, help="checkpoint or inference artifact (.pt)")
+    parser.add_argument("--num-seqs", type=int, default=64, help="number of sequences used")
+    parser.add_argument("--min-len", type=int, default=50)
+    parser.add_argument("--max-len", type=int, default=500)
+    parser.add_argument("--toks-per-batch", type=int, default=4096)
+    args = parser.parse_args()
+    setup(args)
+
+    if args.model_location is not None:
+        model, alphabet, _ = mamba2_pretrained.load_model_and_alphabet(args.model_location, backend="torch")
+        model = model.float().eval()
+    else:
+        model, alphabet = random_model(model_config(args.d_model, args.n_layer), backend="torch")
+    if args.fasta is not None:
+        dataset = FastaBatchedDataset.from_file(args.fasta)
+        data = [dataset[i] for i in range(min(len(dataset), args.num_seqs))]
+    else:
+        data = random_sequences(args.num_seqs, args.min_len, args.max_len)
+    dataset = FastaBatchedDataset([label for label, _ in data], [seq for _, seq in data])
+    converter = BatchConverter(alphabet)
+    batches = [
+        converter([dataset[i] for i in batch])[2]
+        for batch in dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=2)
+    ]
+    num_tokens = sum(int(tokens.ne(alphabet.padding_idx).sum()) for tokens in batches)
+
+    quantized = quantize_dynamic_int8(model)
+    results = [
+        {"benchmark": "int8_accuracy", **row}
+        for row in compare_layers(model, quantized, batches, alphabet.padding_idx)
+    ]
+
+    def run(m):
+        for tokens in batches:
+            m(tokens)
+
+    for name, m in [("fp32", model), ("int8", quantized)]:
+        with torch.no_grad():
+            seconds = benchmark(lambda: run(m), args.warmup, args.repeat)
+        results.append({
+            "benchmark": "int8_speed",
+            "model": name,
+            "num_seqs": len(data),
+            "tokens": num_tokens,
+            "threads": torch.get_num_threads(),
+            "seconds": seconds,
+            "tokens_per_s": num_tokens / seconds,
+            "model_bytes": model_size_bytes(m),
+        })
+    dump(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
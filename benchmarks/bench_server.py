@@ -0,0 +1,114 @@
+"""Latency and throughput of the embedding server under concurrent load.
+
+Starts the server in-process on a random model (or connects to a running one with
+--port) and, for each concurrency level, runs that many clients that each send
+--requests-per-client requests of one random sequence over a keep-alive connection.
+Reports p50/p99 request latency, requests/s, tokens/s and the mean server batch size.
+
+    python -m benchmarks.bench_server --concurrency 1 4 16 64 --max-wait-ms 5
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from DGRNA.server import create_server, post_json
+
+from .common import add_common_args, dump, model_config, random_model, random_sequences, setup
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_level(host, port, sequences, concurrency, requests_per_client):
+    latencies = []
+
+    async def client(c):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for r in range(requests_per_client):
+                label, seq = sequences[(c * requests_per_client + r) % len(sequences)]
+                start = time.perf_counter()
+                status, _ = await post_json(reader, writer, "/embed", {"sequences": [[label, seq]]})
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError(f"server returned {status}")
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(c) for c in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+async def get_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"GET /stats HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def main_async(args):
+    server = None
+    host, port = args.host, args.port
+    if port is None:
+        model, alphabet = random_model(model_config(args.d_model, args.n_layer), backend=args.backend, device=args.device)
+        embedding_server = create_server(
+            model, alphabet, toks_per_batch=args.toks_per_batch, max_wait_ms=args.max_wait_ms
+        )
+        server = await embedding_server.start(host, 0)
+        port = server.sockets[0].getsockname()[1]
+
+    num_requests = max(args.concurrency) * args.requests_per_client
+    sequences = random_sequences(num_requests, args.min_len, args.max_len)
+    results = []
+    # Warm up the model and the connections
+    await run_level(host, port, sequences, 1, args.warmup)
+    for concurrency in args.concurrency:
+        before = await get_stats(host, port)
+        latencies, seconds = await run_level(host, port, sequences, concurrency, args.requests_per_client)
+        after = await get_stats(host, port)
+        num_seqs = len(latencies)
+        batches = after["batches"] - before["batches"]
+        tokens = after["tokens"] - before["tokens"]
+        results.append({
+            "benchmark": "server",
+            "concurrency": concurrency,
+            "requests": num_seqs,
+            "max_wait_ms": args.max_wait_ms,
+            "p50_latency_ms": 1000 * percentile(latencies, 50),
+            "p99_latency_ms": 1000 * percentile(latencies, 99),
+            "mean_latency_ms": 1000 * statistics.mean(latencies),
+            "requests_per_s": num_seqs / seconds,
+            "tokens_per_s": tokens / seconds,
+            "mean_batch_size": (after["sequences"] - before["sequences"]) / max(batches, 1),
+        })
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    return results
+
+
+def main():
+    parser = add_common_args(argparse.ArgumentParser(description=__doc__))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests-per-client", type=int, default=16)
+    parser.add_argument("--min-len", type=int, default=50)
+    parser.add_argument("--max-len", type=int, default=500)
+    parser.add_argument("--toks-per-batch", type=int, default=4096)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--backend", default=None, choices=["cuda", "torch"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="benchmark a running server instead")
+    args = parser.parse_args()
+    setup(args)
+    dump(asyncio.run(main_async(args)), args.output)
+
+
+if __name__ == "__main__":
+    main()
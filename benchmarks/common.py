@@ -0,0 +1,105 @@
+"""Helpers shared by the benchmark scripts.
+
+Every benchmark runs on randomly initialized models, so no checkpoint or network is
+needed. Run them from the repository root, e.g.
+
+    python -m benchmarks.bench_mamba2_backends --lengths 256 1024 4096
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import torch
+
+from DGRNA.data import Alphabet
+from DGRNA.mamba2_pretrained import MambaLMHeadModel
+
+
+def model_config(d_model=256, n_layer=4, d_intermediate=0, ssm_cfg=None, rms_norm=False):
+    """Same fields as the ``cfg.model`` namespace stored in the pretrained checkpoint."""
+    return argparse.Namespace(
+        d_model=d_model,
+        n_layer=n_layer,
+        d_intermediate=d_intermediate,
+        ssm_cfg={} if ssm_cfg is None else ssm_cfg,
+        attn_layer_idx=[],
+        attn_cfg={},
+        rms_norm=rms_norm,
+        residual_in_fp32=False,
+        fused_add_norm=False,
+        pad_vocab_size_multiple=8,
+        activation_fn="gelu",
+        tie_embeddings=True,
+    )
+
+
+def random_model(config, backend=None, device="cpu", dtype=None):
+    alphabet = Alphabet.from_architecture("ESM-1b")
+    model = MambaLMHeadModel(config, alphabet, backend=backend)
+    model = model.to(device=device, dtype=dtype).eval()
+    return model, alphabet
+
+
+def random_tokens(alphabet, batch_size, seqlen, device="cpu", generator=None):
+    """(batch_size, seqlen) tokens: BOS followed by random nucleotides."""
+    nucleotides = torch.tensor([alphabet.get_idx(tok) for tok in "ACGU"])
+    tokens = nucleotides[torch.randint(0, 4, (batch_size, seqlen), generator=generator)]
+    if alphabet.prepend_bos:
+        tokens[:, 0] = alphabet.cls_idx
+    return tokens.to(device)
+
+
+def random_sequences(n, min_len, max_len, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(min_len, max_len + 1, (n,), generator=generator).tolist()
+    return [
+        (f"seq{i}", "".join("ACGU"[j] for j in torch.randint(0, 4, (length,), generator=generator).tolist()))
+        for i, length in enumerate(lengths)
+    ]
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark(fn, warmup=1, repeat=5, device="cpu"):
+    """Median wall time of fn() in seconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def add_common_args(parser):
+    parser.add_argument("--d-model", type=int, default=256)
+    parser.add_argument("--n-layer", type=int, default=4)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    return parser
+
+
+def setup(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+
+def dump(results, path=None):
+    text = json.dumps(results, indent=2)
+    if path is None:
+        sys.stdout.write(text + "\n")
+    else:
+        with open(path, "w") as f:
+            f.write(text + "\n")
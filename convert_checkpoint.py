@@ -0,0 +1,40 @@
+import argparse
+import os
+
+import torch
+
+from DGRNA.mamba2_pretrained import convert_checkpoint, load_checkpoint
+
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert a DGRNA training checkpoint to a compact inference artifact "
+        "(config, alphabet and weights only), loadable with DGRNA.mamba2_pretrained.load_model_and_alphabet"
+    )
+    parser.add_argument(
+        "checkpoint",
+        type=str,
+        help="training checkpoint, e.g. ~/.cache/torch/hub/checkpoints/checkpoint_best_100M.pt",
+    )
+    parser.add_argument("output", type=str, help="output file, e.g. dgrna_L24_fp16.pt")
+    parser.add_argument(
+        "--dtype", type=str, default=None, choices=sorted(DTYPES), help="cast the weights to this dtype"
+    )
+    return parser
+
+
+def main(args):
+    model_data = load_checkpoint(os.path.expanduser(args.checkpoint))
+    artifact = convert_checkpoint(model_data, dtype=DTYPES.get(args.dtype))
+    torch.save(artifact, args.output)
+    num_params = sum(t.numel() for t in {id(t): t for t in artifact["model"].values()}.values())
+    print(f"Wrote {args.output}: {num_params} parameters, {os.path.getsize(args.output) / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,22 +1,254 @@
-import DGRNA
+import argparse
+import json
+import os
+import pathlib
+
 import torch
 
-device = torch.device("cuda:2")
-model, alphabet, _ = DGRNA.mamba2_pretrained.rna_mamba2_L24()
-model = model.to(device)
-
-batch_converter = alphabet.get_batch_converter()
-model.eval()
-
-
-data = [
-    ("RNA1", "GGGUGCGAUCAUACCAGCACUAAUGCCCUCCUGGGAAGUCCUCGUGUUGCACCCCU"),
-    ("RNA2", "GGGUGUCGCUCAGUUGGUAGAGUGCUUGCCUGGCAUGCAAGAAACCUUGGUUCAAUCCCCAGCACUGCA"),
-    ("RNA3", "CGAUUCNCGUUCCC--CCGCCUCCA"),
-]
-batch_labels, batch_strs, batch_tokens = batch_converter(data)
-batch_tokens = batch_tokens.to(device)
-with torch.no_grad():
-    #with torch.cuda.device(batch_tokens.device):
-        results = model(batch_tokens)
-        print(results)
+import DGRNA
+from DGRNA.cache import sequence_outputs
+from DGRNA.data import IndexedFastaDataset, batch_indices_by_length
+from DGRNA.quantization import quantize_dynamic_int8
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Extract embeddings for the sequences of a FASTA file into numbered output parts. "
+        "The job can be split across machines with --shard and resumes from its manifest after a crash."
+    )
+    parser.add_argument("fasta_file", type=pathlib.Path, help="FASTA file on which to extract embeddings")
+    parser.add_argument("output_dir", type=pathlib.Path, help="output directory for the parts and manifest")
+    parser.add_argument(
+        "--model_location",
+        type=str,
+        default=None,
+        help="path to a checkpoint (.pt); the pretrained DGRNA weights are downloaded if omitted",
+    )
+    parser.add_argument("--toks_per_batch", type=int, default=4096, help="maximum batch size in tokens")
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default="0/1",
+        help="i/N: process the i-th of N contiguous ranges of the FASTA file (0-based)",
+    )
+    parser.add_argument(
+        "--seqs_per_part", type=int, default=10000, help="approximate number of sequences per output part"
+    )
+    parser.add_argument(
+        "--include",
+        type=str,
+        nargs="+",
+        choices=["mean", "max", "per_tok", "bos"],
+        default=["mean"],
+        help="specify which representations to return",
+    )
+    parser.add_argument(
+        "--repr_layer",
+        type=int,
+        default=None,
+        help="embed the output of this bidirectional layer (0: the embedding, negative: from the end) instead of "
+        "the final output; the layers after it and the attention layer are skipped",
+    )
+    parser.add_argument("--backend", type=str, default=None, choices=["cuda", "torch"], help="Mamba2 backend")
+    parser.add_argument(
+        "--seq_chunk_len",
+        type=int,
+        default=None,
+        help="run sequences longer than this in chunks, bounding memory by the chunk length",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["int8"],
+        help="int8 dynamic quantization of the Linear layers (CPU, torch backend)",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default=None,
+        choices=["float16", "bfloat16"],
+        help="half precision inference, with an fp32 residual stream and fp32 output embeddings",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="embed identical sequences of a batch once and copy the result to each label",
+    )
+    parser.add_argument("--num_workers", type=int, default=2, help="tokenization worker processes")
+    parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
+    return parser
+
+
+def parse_shard(shard):
+    index, num_shards = (int(x) for x in shard.split("/"))
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+    return index, num_shards
+
+
+def plan_parts(dataset, shard_index, num_shards, toks_per_batch, extra_toks_per_seq, seqs_per_part):
+    """Deterministic split of the shard into token-budget batches, grouped into parts."""
+    start = len(dataset) * shard_index // num_shards
+    end = len(dataset) * (shard_index + 1) // num_shards
+    batches = batch_indices_by_length(
+        dataset.sequence_lengths[start:end], toks_per_batch, extra_toks_per_seq
+    )
+    parts, part, part_size = [], [], 0
+    for batch in batches:
+        part.append((batch + start).tolist())
+        part_size += len(batch)
+        if part_size >= seqs_per_part:
+            parts.append(part)
+            part, part_size = [], 0
+    if part:
+        parts.append(part)
+    return parts
+
+
+def load_manifest(path, job):
+    if not path.exists():
+        return {"job": job, "completed": {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest["job"] != job:
+        raise RuntimeError(
+            f"{path} was written by a job with different settings:\n{manifest['job']}\nvs\n{job}"
+        )
+    return manifest
+
+
+def atomic_write(path, write_fn):
+    tmp_path = path.with_name(path.name + ".tmp")
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_part(path, labels, results):
+    atomic_write(path, lambda tmp: torch.save({"labels": labels, **results}, tmp))
+
+
+def run(args):
+    shard_index, num_shards = parse_shard(args.shard)
+    if args.quantize is not None and args.dtype is not None:
+        raise ValueError("--quantize and --dtype cannot be combined")
+    if args.quantize is not None:
+        args.backend, args.nogpu = "torch", True
+    if args.model_location is not None:
+        model, alphabet, _ = DGRNA.mamba2_pretrained.load_model_and_alphabet(
+            args.model_location, backend=args.backend, dtype=args.dtype
+        )
+    else:
+        model, alphabet, _ = DGRNA.mamba2_pretrained.rna_mamba2_L24(backend=args.backend, dtype=args.dtype)
+    model.eval()
+    if args.quantize == "int8":
+        model = quantize_dynamic_int8(model.float(), inplace=True)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.nogpu else "cpu")
+    model = model.to(device)
+    print(f"Transferred model to {device}")
+
+    dataset = IndexedFastaDataset(args.fasta_file)
+    extra_toks_per_seq = int(alphabet.prepend_bos) + int(alphabet.append_eos)
+    parts = plan_parts(
+        dataset, shard_index, num_shards, args.toks_per_batch, extra_toks_per_seq, args.seqs_per_part
+    )
+
+    shard_dir = args.output_dir / f"shard-{shard_index:05d}-of-{num_shards:05d}"
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = shard_dir / "manifest.json"
+    job = {
+        "fasta_file": str(args.fasta_file.resolve()),
+        "fasta_size": os.path.getsize(args.fasta_file),
+        "model_location": args.model_location,
+        "shard": [shard_index, num_shards],
+        "toks_per_batch": args.toks_per_batch,
+        "seqs_per_part": args.seqs_per_part,
+        "include": sorted(args.include),
+        "repr_layer": args.repr_layer,
+        "quantize": args.quantize,
+        "dtype": args.dtype,
+        "num_parts": len(parts),
+    }
+    manifest = load_manifest(manifest_path, job)
+    todo = [
+        part_id
+        for part_id in range(len(parts))
+        if str(part_id) not in manifest["completed"]
+        or not (shard_dir / manifest["completed"][str(part_id)]["file"]).exists()
+    ]
+    print(f"Shard {shard_index}/{num_shards}: {len(parts)} parts, {len(parts) - len(todo)} already done")
+
+    batch_part_ids = [part_id for part_id in todo for _ in parts[part_id]]
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=[batch for part_id in todo for batch in parts[part_id]],
+        collate_fn=alphabet.get_batch_converter(dedup=args.dedup),
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+    )
+
+    def _flush_current_part():
+        file_name = f"part-{current_part:06d}.pt"
+        save_part(
+            shard_dir / file_name,
+            labels,
+            {k: v if k == "per_tok" else torch.stack(v) for k, v in results.items()},
+        )
+        manifest["completed"][str(current_part)] = {"file": file_name, "num_sequences": len(labels)}
+        atomic_write(manifest_path, lambda tmp: tmp.write_text(json.dumps(manifest, indent=2)))
+        print(f"Wrote {shard_dir / file_name} ({len(labels)} sequences)")
+
+    current_part, labels, results = None, [], {}
+    bos = int(alphabet.prepend_bos)
+    num_seqs = num_toks = computed_seqs = computed_toks = 0
+    with torch.no_grad():
+        for part_id, batch in zip(batch_part_ids, data_loader):
+            if args.dedup:
+                # strs and toks hold the unique sequences, see DedupBatchConverter
+                batch_labels, strs, toks, inverse = batch
+                inverse = inverse.tolist()
+            else:
+                batch_labels, strs, toks = batch
+                inverse = range(len(strs))
+            if part_id != current_part:
+                if current_part is not None:
+                    _flush_current_part()
+                current_part, labels, results = part_id, [], {k: [] for k in args.include}
+            toks = toks.to(device, non_blocking=True)
+            if args.repr_layer is None:
+                hidden_states = model(toks, seq_chunk_len=args.seq_chunk_len, out_dtype=torch.float32)
+            else:
+                out = model(
+                    toks,
+                    seq_chunk_len=args.seq_chunk_len,
+                    out_dtype=torch.float32,
+                    repr_layers=[args.repr_layer],
+                    early_exit=True,
+                )
+                (hidden_states,) = out["representations"].values()
+            outputs = sequence_outputs(hidden_states, strs, args.include, bos)
+            for label, j in zip(batch_labels, inverse):
+                labels.append(label)
+                for k, v in outputs[j].items():
+                    results[k].append(v)
+            num_seqs += len(batch_labels)
+            num_toks += sum(len(strs[j]) for j in inverse)
+            computed_seqs += len(strs)
+            computed_toks += sum(len(seq_str) for seq_str in strs)
+        if current_part is not None:
+            _flush_current_part()
+    if args.dedup and num_seqs:
+        print(
+            f"Dedup: embedded {computed_seqs} unique of {num_seqs} sequences, "
+            f"{num_toks - computed_toks} of {num_toks} tokens ({1 - computed_toks / max(num_toks, 1):.1%}) saved"
+        )
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
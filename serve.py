@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+
+import torch
+
+import DGRNA
+from DGRNA.cache import EmbeddingCache
+from DGRNA.server import create_server
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Serve DGRNA embeddings over HTTP on a local port or Unix socket. "
+        "Concurrent requests are coalesced into token-budget batches, see DGRNA/server.py."
+    )
+    parser.add_argument(
+        "--model_location",
+        type=str,
+        default=None,
+        help="path to a checkpoint (.pt); the pretrained DGRNA weights are downloaded if omitted",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help="listen on this Unix socket instead of a port")
+    parser.add_argument(
+        "--include",
+        type=str,
+        nargs="+",
+        choices=["mean", "max", "per_tok", "bos"],
+        default=["mean"],
+        help="specify which representations to return",
+    )
+    parser.add_argument("--toks_per_batch", type=int, default=4096, help="maximum batch size in tokens")
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=5.0, help="how long a request waits for others to batch with"
+    )
+    parser.add_argument("--cache_bytes", type=int, default=0, help="in-memory embedding cache size (0: no cache)")
+    parser.add_argument("--cache_dir", type=str, default=None, help="on-disk embedding cache directory")
+    parser.add_argument("--backend", type=str, default=None, choices=["cuda", "torch"], help="Mamba2 backend")
+    parser.add_argument("--dtype", type=str, default=None, choices=["float16", "bfloat16"], help="half precision inference")
+    parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
+    return parser
+
+
+def main(args):
+    if args.model_location is not None:
+        model, alphabet, _ = DGRNA.mamba2_pretrained.load_model_and_alphabet(
+            args.model_location, backend=args.backend, dtype=args.dtype
+        )
+    else:
+        model, alphabet, _ = DGRNA.mamba2_pretrained.rna_mamba2_L24(backend=args.backend, dtype=args.dtype)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.nogpu else "cpu")
+    model = model.to(device).eval()
+
+    cache = None
+    if args.cache_bytes > 0 or args.cache_dir is not None:
+        cache = EmbeddingCache(max_bytes=args.cache_bytes, directory=args.cache_dir)
+    server = create_server(
+        model, alphabet, include=args.include, toks_per_batch=args.toks_per_batch, max_wait_ms=args.max_wait_ms, cache=cache
+    )
+    where = args.unix_socket if args.unix_socket is not None else f"http://{args.host}:{args.port}"
+    print(f"Serving on {where} ({device})")
+    asyncio.run(server.serve_forever(args.host, args.port, args.unix_socket))
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,30 @@
+import argparse
+
+from DGRNA.data import Alphabet, write_tokenized_corpus
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert a FASTA file to the pre-tokenized memory-mapped format read by DGRNA.data.TokenizedDataset"
+    )
+    parser.add_argument("fasta_file", type=str, help="FASTA file to tokenize")
+    parser.add_argument("output_prefix", type=str, help="prefix of the output files")
+    parser.add_argument(
+        "--architecture", type=str, default="ESM-1b", help="alphabet architecture of the model"
+    )
+    parser.add_argument("--to_upper", action="store_true", help="tokenize lowercase residues as uppercase")
+    parser.add_argument("--t_to_u", action="store_true", help="tokenize T as U (DNA input)")
+    return parser
+
+
+def main(args):
+    alphabet = Alphabet.from_architecture(args.architecture)
+    write_tokenized_corpus(
+        args.fasta_file, args.output_prefix, alphabet, to_upper=args.to_upper, t_to_u=args.t_to_u
+    )
+
+
+if __name__ == "__main__":
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)